@@ -1,35 +1,144 @@
+import io
 import os
+import re
+import json
+import math
+import time
+import uuid
 import shutil
 import queue
+import zipfile
 import argparse
+import mimetypes
 import threading
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
+from contextlib import contextmanager
+try:
+    import fcntl  # travas da pasta base e dos lotes em andamento; ausente no Windows
+except ImportError:
+    fcntl = None
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 from flask_cors import CORS
 
-from seu_script_de_extracao import run_extraction_process_web_mode
+from seu_script_de_extracao import (
+    PipelineExtracao, TokenCancelamento, ExtracaoCancelada, EscalonadorJusto, FilaDistribuida,
+    AcervoResultados, escalonador_compartilhado, hashes_conhecidos, renderizar_relatorio, carregar_previa,
+    limpar_journais,
+    nome_arquivo_perfil, PASTA_FILA_DISTRIBUIDA, PASTA_ACERVO, LIMITE_PAGINAS_PARTICAO,
+    RELATORIOS, MODELO_RELATORIO, NOME_RASTRO,
+)
 
 
 ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
 
-# Delay (em segundos) antes de apagar uploads/relatórios gerados após conclusão
-# Pode ser sobrescrito pela variável de ambiente `EXTRACTION_CLEANUP_SECONDS`
+# Nome do pacote ZIP com todos os relatórios (gerado sob demanda em /download_bundle)
+BUNDLE_NAME = 'relatorios.zip'
+# Relatórios já comprimidos não ganham nada com deflate dentro do ZIP
+STORED_EXTENSIONS = {'.xlsx', '.zip', '.gz'}
+
+# Tempo (em segundos) que os relatórios de um lote ficam disponíveis depois
+# da conclusão ou do último download. Pode ser sobrescrito pela variável de
+# ambiente `EXTRACTION_CLEANUP_SECONDS`
 CLEANUP_DELAY_SECONDS = int(os.getenv('EXTRACTION_CLEANUP_SECONDS', '120'))
+# Espaço máximo em disco para as áreas de trabalho dos lotes (uploads e
+# relatórios); ao passar dele, os lotes concluídos usados há mais tempo são
+# apagados primeiro (LRU)
+DISK_QUOTA_BYTES = int(os.getenv('EXTRACTION_DISK_QUOTA_MB', '2048')) * 1024 * 1024
+# Intervalo entre as passadas da limpeza em segundo plano
+JANITOR_INTERVAL_SECONDS = int(os.getenv('EXTRACTION_JANITOR_SECONDS', '30'))
+# Journals de execuções interrompidas (queda, cancelamento) não retomados em
+# EXTRACTION_JOURNAL_DAYS dias são apagados pela limpeza, assim como os mais
+# antigos quando juntos passam de EXTRACTION_JOURNAL_QUOTA_MB
+JOURNAL_RETENTION_SECONDS = float(os.getenv('EXTRACTION_JOURNAL_DAYS', '7')) * 24 * 3600
+JOURNAL_QUOTA_BYTES = int(os.getenv('EXTRACTION_JOURNAL_QUOTA_MB', '256')) * 1024 * 1024
+
+# Processos usados para extrair os PDFs em paralelo (padrão: número de CPUs)
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '0')) or None
+# Os processos de extração sobem aquecidos junto com o servidor e atendem
+# todos os lotes; cada um é trocado por outro depois de
+# EXTRACTION_WORKER_MAX_TASKS PDFs ou quando sua memória residente passa de
+# EXTRACTION_WORKER_MAX_RSS_MB (0 desliga o limite)
+WORKER_MAX_TASKS = int(os.getenv('EXTRACTION_WORKER_MAX_TASKS', '500')) or None
+WORKER_MAX_RSS_MB = int(os.getenv('EXTRACTION_WORKER_MAX_RSS_MB', '1024')) or None
+# PDFs com pelo menos EXTRACTION_PAGE_SHARD_THRESHOLD páginas são divididos em
+# trechos de páginas extraídos em paralelo (0 desliga)
+PAGE_SHARD_THRESHOLD = int(os.getenv('EXTRACTION_PAGE_SHARD_THRESHOLD', str(LIMITE_PAGINAS_PARTICAO)))
+
+# Modo distribuído: com EXTRACTION_DISTRIBUTED=1 o servidor não extrai; os
+# PDFs vão para uma fila em <pasta base>/fila, consumida por worker.py em
+# qualquer máquina que monte a pasta base. EXTRACTION_DISTRIBUTED_INFLIGHT
+# limita quantos PDFs ficam na fila ao mesmo tempo (o resto espera no
+# escalonador, que mantém a divisão justa entre os lotes).
+# EXTRACTION_DISTRIBUTED_WORKERS é o total de processos worker.py (somando
+# todas as máquinas) e dimensiona o Retry-After e a divisão de PDFs longos
+DISTRIBUTED_MODE = os.getenv('EXTRACTION_DISTRIBUTED', '0') in ('1', 'true', 'on', 'yes')
+DISTRIBUTED_INFLIGHT = int(os.getenv('EXTRACTION_DISTRIBUTED_INFLIGHT', '64'))
+DISTRIBUTED_WORKERS = int(os.getenv('EXTRACTION_DISTRIBUTED_WORKERS', '0')) or os.cpu_count() or 1
+
+# Controle de admissão: no máximo EXTRACTION_MAX_JOBS lotes em andamento no
+# servidor e EXTRACTION_MAX_JOBS_PER_CLIENT por cliente (endereço IP). Acima
+# disso o upload é recusado com 429 e Retry-After.
+MAX_ACTIVE_JOBS = int(os.getenv('EXTRACTION_MAX_JOBS', '8'))
+MAX_JOBS_PER_CLIENT = int(os.getenv('EXTRACTION_MAX_JOBS_PER_CLIENT', '2'))
+# Um /progress aberto antes do upload espera o lote com aquele job_id por até
+# EXTRACTION_PROGRESS_WAIT_SECONDS; no máximo EXTRACTION_MAX_PENDING_PROGRESS
+# streams esperam assim ao mesmo tempo (acima disso, 429)
+PROGRESS_WAIT_SECONDS = int(os.getenv('EXTRACTION_PROGRESS_WAIT_SECONDS', '60'))
+MAX_PENDING_PROGRESS = int(os.getenv('EXTRACTION_MAX_PENDING_PROGRESS', '64'))
+
+# Rastreamento opcional dos lotes (formato Chrome trace, baixado em
+# /jobs/<job_id>/trace): ligado para todos os lotes com EXTRACTION_TRACE=1 ou
+# por upload com ?trace=1. PDFs que levarem mais de
+# EXTRACTION_PROFILE_THRESHOLD_SECONDS ganham também um perfil cProfile.
+TRACE_ALL_JOBS = os.getenv('EXTRACTION_TRACE', '0') in ('1', 'true', 'on', 'yes')
+PROFILE_THRESHOLD_SECONDS = float(os.getenv('EXTRACTION_PROFILE_THRESHOLD_SECONDS', '5'))
+
+# Modo sem disco (opcional): os PDFs enviados ficam em memória e vão direto
+# para a extração; só os relatórios são gravados. Cada job pode manter até
+# EXTRACTION_MEMORY_BUDGET_MB em memória; o que passar disso vai para o disco.
+DISKLESS_MODE = os.getenv('EXTRACTION_DISKLESS', '0') in ('1', 'true', 'on', 'yes')
+DISKLESS_MEMORY_BUDGET = int(os.getenv('EXTRACTION_MEMORY_BUDGET_MB', '256')) * 1024 * 1024
+
+# Acervo de resultados por hash SHA-256 do PDF (<pasta base>/resultados): o
+# navegador pergunta em /known_files quais PDFs o servidor já extraiu e só
+# envia os que faltam. Resultados sem uso há EXTRACTION_RESULT_CACHE_DAYS
+# dias são apagados (0 desliga o acervo)
+RESULT_CACHE_DAYS = float(os.getenv('EXTRACTION_RESULT_CACHE_DAYS', '30'))
+# Máximo de hashes por consulta a /known_files
+MAX_KNOWN_QUERY = 10000
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Pré-visualização dos resultados (GET /jobs/<job_id>/preview): alunos por
+# página (padrão e máximo), ordenações e filtros aceitos, com os nomes da
+# API mapeados para os campos de PreviaRelatorio
+PREVIEW_PAGE_SIZE = 50
+MAX_PREVIEW_PAGE_SIZE = 500
+PREVIEW_SORT_FIELDS = {
+    'seq': 'seq', 'matricula': 'matricula', 'name': 'nome', 'components': 'componentes',
+    'pending_hours': 'ch_total', 'percentage': 'percentual', 'file': 'arquivo',
+}
+PREVIEW_FILTERS = {'q': 'q', 'matricula': 'matricula', 'name': 'nome', 'component': 'componente'}
 
 
 def make_app(base_dir: str):
     upload_folder = os.path.join(base_dir, 'uploads')
     generated_folder = os.path.join(base_dir, 'generated_reports')
+    journal_folder = os.path.join(base_dir, 'journals')
 
     app = Flask(__name__, static_folder='static')
     CORS(app)
 
     app.config['UPLOAD_FOLDER'] = upload_folder
     app.config['GENERATED_REPORTS_FOLDER'] = generated_folder
+    app.config['JOURNAL_FOLDER'] = journal_folder
+    app.config['COST_MODEL_PATH'] = os.path.join(base_dir, 'modelo_custo.json')
     app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
 
     os.makedirs(upload_folder, exist_ok=True)
     os.makedirs(generated_folder, exist_ok=True)
+    os.makedirs(journal_folder, exist_ok=True)
 
     return app
 
@@ -45,183 +154,62 @@ def get_base_dir_from_args_or_env():
 BASE_DIR = get_base_dir_from_args_or_env()
 app = make_app(BASE_DIR)
 
-# Fila para comunicação de progresso
-progress_queue = queue.Queue()
-
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-
-@app.route('/')
-def index():
-    return send_from_directory(app.static_folder, 'index.html')
-
-
-@app.route('/progress')
-def progress():
-    def generate():
-        while True:
-            try:
-                message = progress_queue.get(timeout=30)
-                if message == 'DONE':
-                    yield f"data: {message}\n\n"
-                    break
-                yield f"data: {message}\n\n"
-            except queue.Empty:
-                yield f"data: ping\n\n"
-    return Response(generate(), mimetype='text/event-stream')
-
-
-@app.route('/upload_and_extract', methods=['POST'])
-def upload_and_extract():
-    skip_percentuais = request.form.get('skip_percentuals') in ('1', 'true', 'on', 'yes')
-
-    if 'pdf_files' not in request.files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF enviado."}), 400
-
-    pdf_files = request.files.getlist('pdf_files')
-    excel_file = request.files.get('excel_file') if 'excel_file' in request.files else None
-
-    if not pdf_files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF selecionado."}), 400
-
-    if not skip_percentuais and not excel_file:
-        return jsonify({"status": "error", "message": "Nenhum arquivo Excel de percentuais selecionado."}), 400
-
-    # limpa pastas temporárias
-    for folder in [app.config['UPLOAD_FOLDER'], app.config['GENERATED_REPORTS_FOLDER']]:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-        os.makedirs(folder, exist_ok=True)
-
-    # salva PDFs
-    for pdf in pdf_files:
-        if pdf and allowed_file(pdf.filename):
-            filename = secure_filename(pdf.filename)
-            pdf.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        else:
-            return jsonify({"status": "error", "message": f"Tipo de arquivo PDF não permitido: {pdf.filename}"}), 400
-
-    excel_path = None
-    if excel_file:
-        if allowed_file(excel_file.filename):
-            excel_filename = secure_filename(excel_file.filename)
-            excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-            excel_file.save(excel_path)
-        else:
-            return jsonify({"status": "error", "message": "Tipo de arquivo Excel não permitido ou nome inválido."}), 400
-
-    try:
-        # limpa fila de progresso
-        while not progress_queue.empty():
-            progress_queue.get()
-
-        total_pdfs = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.pdf')])
-        progress_queue.put(f"0/{total_pdfs}")
-
-        output_files = run_extraction_process_web_mode(
-            pdf_upload_folder=app.config['UPLOAD_FOLDER'],
-            excel_percentual_path=excel_path,
-            output_report_folder=app.config['GENERATED_REPORTS_FOLDER'],
-            progress_callback=lambda current, total: progress_queue.put(f"{current}/{total}")
-        )
-
-        progress_queue.put('DONE')
-
-        response_data = {
-            "status": "success",
-            "message": "Extração e geração de relatórios concluídas com sucesso!",
-            "download_links": {}
-        }
-        for key, filename in output_files.items():
-            response_data["download_links"][key] = f"/download/{filename}"
-
-        # Agende limpeza dos uploads e dos arquivos gerados após um delay
+# Processos de extração compartilhados por todos os lotes, com fila justa
+# entre eles (ver EscalonadorJusto)
+if DISTRIBUTED_MODE:
+    scheduler = EscalonadorJusto(
+        DISTRIBUTED_INFLIGHT, executor=FilaDistribuida(os.path.join(BASE_DIR, PASTA_FILA_DISTRIBUIDA)),
+        paralelismo=DISTRIBUTED_WORKERS)
+else:
+    scheduler = escalonador_compartilhado(
+        EXTRACTION_WORKERS, max_tarefas_worker=WORKER_MAX_TASKS, max_rss_worker_mb=WORKER_MAX_RSS_MB)
+
+result_store = (AcervoResultados(os.path.join(BASE_DIR, PASTA_ACERVO), retencao=RESULT_CACHE_DAYS * 24 * 3600)
+                if RESULT_CACHE_DAYS > 0 else None)
+
+# Lotes conhecidos (em andamento ou concluídos há pouco) e as filas de
+# progresso de cada um; o cliente escolhe o job_id para poder abrir o
+# /progress antes de começar o upload
+JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+ACTIVE_STATUSES = ('receiving', 'processing')
+jobs = {}
+progress_queues = {}
+pending_progress = {}  # job_id ainda sem lote -> quando o /progress o abriu
+jobs_lock = threading.RLock()
+
+
+class KeyedLocks:
+    """Uma trava por chave, criada no primeiro uso e descartada quando
+    ninguém mais a segura ou espera por ela."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}  # chave -> [trava, requisições usando]
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
         try:
-            upload_folder = app.config['UPLOAD_FOLDER']
-            generated_folder = app.config['GENERATED_REPORTS_FOLDER']
-            def cleanup_dirs(u_folder, g_folder):
-                try:
-                    for folder in (u_folder, g_folder):
-                        if os.path.exists(folder):
-                            shutil.rmtree(folder)
-                        os.makedirs(folder, exist_ok=True)
-                    print(f"Limpeza concluída: {u_folder}, {g_folder}")
-                except Exception as e:
-                    print(f"Erro durante limpeza programada: {e}")
-
-            def schedule_cleanup(delay, u_folder, g_folder):
-                t = threading.Timer(delay, cleanup_dirs, args=(u_folder, g_folder))
-                t.daemon = True
-                t.start()
-                print(f"Agendada limpeza em {delay}s para: {u_folder}, {g_folder}")
-
-            schedule_cleanup(CLEANUP_DELAY_SECONDS, upload_folder, generated_folder)
-        except Exception as e:
-            print(f"Não foi possível agendar limpeza: {e}")
-
-        return jsonify(response_data), 200
-
-    except Exception as e:
-        print(f"Erro durante a extração: {e}")
-        progress_queue.put('DONE')
-        return jsonify({"status": "error", "message": f"Erro interno durante a extração: {str(e)}"}), 500
-
-
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['GENERATED_REPORTS_FOLDER'], filename, as_attachment=True)
-
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
 
-if __name__ == '__main__':
-    print(f"\nServidor rodando! Base dir: {BASE_DIR}")
-    print("Acesse http://127.0.0.1:5000 no seu navegador.\n")
-    app.run(debug=False, port=5000, use_reloader=False)
-import os
-import shutil
-import queue
-import argparse
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
-from flask_cors import CORS
 
-from seu_script_de_extracao import run_extraction_process_web_mode
-
-
-ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
+# Evita que duas requisições montem o mesmo ZIP ou renderizem o mesmo
+# relatório ao mesmo tempo, sem que um lote espere pelo de outro: uma trava
+# por pasta (ZIP) e por (pasta, relatório)
+bundle_locks = KeyedLocks()
+render_locks = KeyedLocks()
 
-
-def make_app(base_dir: str):
-    upload_folder = os.path.join(base_dir, 'uploads')
-    generated_folder = os.path.join(base_dir, 'generated_reports')
-
-    app = Flask(__name__, static_folder='static')
-    CORS(app)
-
-    app.config['UPLOAD_FOLDER'] = upload_folder
-    app.config['GENERATED_REPORTS_FOLDER'] = generated_folder
-    app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
-
-    os.makedirs(upload_folder, exist_ok=True)
-    os.makedirs(generated_folder, exist_ok=True)
-
-    return app
-
-
-def get_base_dir_from_args_or_env():
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('--base-dir', dest='base_dir', help='Pasta base para uploads e reports')
-    args, _ = parser.parse_known_args()
-    base_dir = args.base_dir or os.getenv('EXTRACTION_BASE_DIR') or os.getcwd()
-    return os.path.abspath(base_dir)
-
-
-BASE_DIR = get_base_dir_from_args_or_env()
-app = make_app(BASE_DIR)
-
-# Fila para comunicação de progresso
-progress_queue = queue.Queue()
+# Acertos/falhas do cache de templates de layout, somados entre os lotes
+layout_metrics = {"acertos": 0, "falhas": 0}
+metrics_lock = threading.Lock()
 
 
 def allowed_file(filename):
@@ -233,179 +221,301 @@ def index():
     return send_from_directory(app.static_folder, 'index.html')
 
 
-@app.route('/progress')
-def progress():
-    def generate():
+def folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+# Marcador do processo dono de um lote em andamento (ver StorageManager)
+WORKSPACE_OWNER_NAME = '.dono.lock'
+
+
+class Workspace:
+    """Área de trabalho de um lote, como vista pelo StorageManager."""
+
+    def __init__(self, job_id, created, finished=None, downloadable=False):
+        self.job_id = job_id
+        self.created = created
+        self.finished = finished
+        self.last_access = finished or created
+        self.downloadable = downloadable
+        self.size = 0
+        self.readers = 0       # downloads em andamento
+        self.evicting = False
+        self.owner = None      # marcador travado enquanto o lote está em andamento
+
+
+class StorageManager:
+    """Ciclo de vida das áreas de trabalho dos lotes (uploads/<job_id> e
+    generated_reports/<job_id>). Uma única thread de limpeza apaga os lotes
+    concluídos cujo último uso (conclusão ou download) passou de `ttl` e,
+    se o espaço ocupado passar da cota, os usados há mais tempo (LRU). Lotes
+    em andamento e relatórios sendo baixados nunca são apagados.
+    O último uso fica registrado no mtime da pasta de relatórios, de modo que
+    as áreas de trabalho sobrevivem (e continuam expirando) após reiniciar."""
+
+    def __init__(self, upload_root, report_root, ttl, quota, interval, reserve, on_evict=None, on_sweep=None):
+        self.upload_root = upload_root
+        self.report_root = report_root
+        self.ttl = ttl
+        self.quota = quota
+        self.interval = interval
+        # espaço reservado para um lote em andamento (o tamanho máximo do upload)
+        self.reserve = reserve
+        self.on_evict = on_evict
+        # chamado a cada passada da limpeza (p.ex. para expirar o acervo de resultados)
+        self.on_sweep = on_sweep
+        self.workspaces = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._janitor, daemon=True)
+
+    def upload_folder(self, job_id):
+        return os.path.join(self.upload_root, job_id)
+
+    def report_folder(self, job_id):
+        return os.path.join(self.report_root, job_id)
+
+    def start(self):
+        self._recover()
+        self.thread.start()
+        return self
+
+    # Cada lote em andamento tem em uploads/<job_id> um marcador com o pid do
+    # processo dono, travado (flock) enquanto o lote não termina. A trava cai
+    # junto com o processo, de modo que _recover só reclama áreas de trabalho
+    # de lotes cujo processo já não existe.
+
+    def _mark_owner(self, job_id):
+        if fcntl is None:
+            return None
+        marker = open(os.path.join(self.upload_folder(job_id), WORKSPACE_OWNER_NAME), 'w')
+        fcntl.flock(marker, fcntl.LOCK_EX)
+        marker.write(str(os.getpid()))
+        marker.flush()
+        return marker
+
+    def _owner_alive(self, job_id):
+        """True se o processo dono do lote ainda o mantém travado."""
+        path = os.path.join(self.upload_folder(job_id), WORKSPACE_OWNER_NAME)
+        if fcntl is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path) as marker:
+                fcntl.flock(marker, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def _recover(self):
+        """Reconhece as áreas de trabalho deixadas por uma execução anterior.
+        Uploads de lotes cujo processo morreu são descartados; relatórios de
+        lotes concluídos voltam a poder ser baixados até expirarem. Lotes
+        ainda em andamento em outro processo não são tocados."""
+        live = set()
+        for name in os.listdir(self.upload_root):
+            if self._owner_alive(name):
+                live.add(name)
+                continue
+            shutil.rmtree(os.path.join(self.upload_root, name), ignore_errors=True)
+        if live:
+            print(f"Armazenamento: {len(live)} lote(s) em andamento em outro processo mantido(s).")
+        for name in os.listdir(self.report_root):
+            folder = os.path.join(self.report_root, name)
+            if not os.path.isdir(folder) or not JOB_ID_PATTERN.match(name) or name in live:
+                continue
+            if not os.path.exists(os.path.join(folder, MODELO_RELATORIO)):
+                shutil.rmtree(folder, ignore_errors=True)
+                continue
+            mtime = os.path.getmtime(folder)
+            workspace = Workspace(name, created=mtime, finished=mtime, downloadable=True)
+            workspace.size = folder_size(folder)
+            self.workspaces[name] = workspace
+        if self.workspaces:
+            print(f"Armazenamento: {len(self.workspaces)} lote(s) de uma execução anterior disponíveis para download.")
+
+    # --- uso pelos lotes e downloads ---
+
+    def exists(self, job_id):
+        """True se o job_id já tem área de trabalho, registrada (inclusive
+        relatórios recuperados após reiniciar) ou ainda no disco."""
+        with self.lock:
+            if job_id in self.workspaces:
+                return True
+        return os.path.exists(self.upload_folder(job_id)) or os.path.exists(self.report_folder(job_id))
+
+    def create(self, job_id):
+        """Cria a área de trabalho de um lote que acabou de ser admitido (o
+        job_id não pode estar em uso; ver exists)."""
+        for folder in (self.upload_folder(job_id), self.report_folder(job_id)):
+            os.makedirs(folder)
+        workspace = Workspace(job_id, created=time.time())
+        workspace.owner = self._mark_owner(job_id)
+        with self.lock:
+            self.workspaces[job_id] = workspace
+
+    def finish(self, job_id, downloadable):
+        """Lote terminou: os uploads não são mais necessários; os relatórios
+        ficam disponíveis até expirarem."""
+        with self.lock:
+            workspace = self.workspaces.get(job_id)
+            owner = workspace.owner if workspace else None
+            if workspace:
+                workspace.owner = None
+        if owner is not None:
+            owner.close()
+        shutil.rmtree(self.upload_folder(job_id), ignore_errors=True)
+        report_folder = self.report_folder(job_id)
+        size = folder_size(report_folder)
+        with self.lock:
+            workspace = self.workspaces.get(job_id)
+            if workspace is None:
+                return
+            workspace.finished = workspace.last_access = time.time()
+            workspace.downloadable = downloadable
+            workspace.size = size
+        self.wakeup.set()
+
+    def acquire(self, job_id):
+        """Protege os relatórios do lote durante um download. Retorna a pasta
+        de relatórios, ou None se o lote não existe (ou já foi apagado)."""
+        with self.lock:
+            workspace = self.workspaces.get(job_id) if job_id else None
+            if workspace is None or not workspace.downloadable or workspace.evicting:
+                return None
+            workspace.readers += 1
+            workspace.last_access = time.time()
+        return self.report_folder(job_id)
+
+    def release(self, job_id):
+        folder = self.report_folder(job_id)
+        size = folder_size(folder)  # o download pode ter renderizado relatórios
+        with self.lock:
+            workspace = self.workspaces.get(job_id)
+            if workspace is None:
+                return
+            workspace.readers -= 1
+            workspace.last_access = time.time()
+            workspace.size = size
+        try:
+            os.utime(folder)
+        except OSError:
+            pass
+
+    def usage(self):
+        """(bytes ocupados, bytes comprometidos). Cada lote em andamento conta
+        como no mínimo `reserve`, o tamanho máximo que o upload pode atingir."""
+        with self.lock:
+            workspaces = list(self.workspaces.values())
+        used = sum(w.size for w in workspaces)
+        committed = sum(w.size if w.finished else max(w.size, self.reserve) for w in workspaces)
+        return used, committed
+
+    def make_room(self):
+        """Garante espaço para mais um lote dentro da cota, apagando lotes
+        concluídos por LRU se preciso. Retorna False se não houver como."""
+        self._evict(extra=self.reserve)
+        return self.usage()[1] + self.reserve <= self.quota
+
+    # --- limpeza ---
+
+    def _janitor(self):
         while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
             try:
-                message = progress_queue.get(timeout=30)
-                if message == 'DONE':
-                    yield f"data: {message}\n\n"
+                self._refresh_sizes()
+                self._evict()
+                if self.on_sweep:
+                    self.on_sweep()
+            except Exception as e:
+                print(f"Erro durante a limpeza do armazenamento: {e}")
+
+    def _refresh_sizes(self):
+        with self.lock:
+            job_ids = [w.job_id for w in self.workspaces.values() if not w.finished]
+        for job_id in job_ids:
+            size = folder_size(self.upload_folder(job_id)) + folder_size(self.report_folder(job_id))
+            with self.lock:
+                if job_id in self.workspaces:
+                    self.workspaces[job_id].size = size
+
+    def _evict(self, extra=0):
+        now = time.time()
+        victims = []
+        with self.lock:
+            idle = sorted((w for w in self.workspaces.values()
+                           if w.finished and not w.readers and not w.evicting),
+                          key=lambda w: w.last_access)
+            committed = sum(w.size if w.finished else max(w.size, self.reserve) for w in self.workspaces.values())
+            for workspace in idle:
+                expired = now - workspace.last_access >= self.ttl
+                if not expired and committed + extra <= self.quota:
                     break
-                yield f"data: {message}\n\n"
-            except queue.Empty:
-                yield f"data: ping\n\n"
-    return Response(generate(), mimetype='text/event-stream')
-
-
-@app.route('/upload_and_extract', methods=['POST'])
-def upload_and_extract():
-    skip_percentuais = request.form.get('skip_percentuals') in ('1', 'true', 'on', 'yes')
-
-    if 'pdf_files' not in request.files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF enviado."}), 400
-
-    pdf_files = request.files.getlist('pdf_files')
-    excel_file = request.files.get('excel_file') if 'excel_file' in request.files else None
-
-    if not pdf_files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF selecionado."}), 400
-
-    if not skip_percentuais and not excel_file:
-        return jsonify({"status": "error", "message": "Nenhum arquivo Excel de percentuais selecionado."}), 400
-
-    # limpa pastas temporárias
-    for folder in [app.config['UPLOAD_FOLDER'], app.config['GENERATED_REPORTS_FOLDER']]:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-        os.makedirs(folder, exist_ok=True)
-
-    # salva PDFs
-    for pdf in pdf_files:
-        if pdf and allowed_file(pdf.filename):
-            filename = secure_filename(pdf.filename)
-            pdf.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        else:
-            return jsonify({"status": "error", "message": f"Tipo de arquivo PDF não permitido: {pdf.filename}"}), 400
-
-    excel_path = None
-    if excel_file:
-        if allowed_file(excel_file.filename):
-            excel_filename = secure_filename(excel_file.filename)
-            excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-            excel_file.save(excel_path)
-        else:
-            return jsonify({"status": "error", "message": "Tipo de arquivo Excel não permitido ou nome inválido."}), 400
-
-    try:
-        # limpa fila de progresso
-        while not progress_queue.empty():
-            progress_queue.get()
-
-        total_pdfs = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.pdf')])
-        progress_queue.put(f"0/{total_pdfs}")
-
-        output_files = run_extraction_process_web_mode(
-            pdf_upload_folder=app.config['UPLOAD_FOLDER'],
-            excel_percentual_path=excel_path,
-            output_report_folder=app.config['GENERATED_REPORTS_FOLDER'],
-            progress_callback=lambda current, total: progress_queue.put(f"{current}/{total}")
-        )
-
-        progress_queue.put('DONE')
-
-        response_data = {
-            "status": "success",
-            "message": "Extração e geração de relatórios concluídas com sucesso!",
-            "download_links": {}
-        }
-        for key, filename in output_files.items():
-            response_data["download_links"][key] = f"/download/{filename}"
-
-        return jsonify(response_data), 200
-
-    except Exception as e:
-        print(f"Erro durante a extração: {e}")
-        progress_queue.put('DONE')
-        return jsonify({"status": "error", "message": f"Erro interno durante a extração: {str(e)}"}), 500
-
-
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['GENERATED_REPORTS_FOLDER'], filename, as_attachment=True)
-
-
-if __name__ == '__main__':
-    print(f"\nServidor rodando! Base dir: {BASE_DIR}")
-    print("Acesse http://127.0.0.1:5000 no seu navegador.\n")
-    app.run(debug=True, port=5000, use_reloader=False)
-import os
-import shutil
-import queue
-import argparse
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
-from flask_cors import CORS
-
-from seu_script_de_extracao import run_extraction_process_web_mode
-
-
-ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
-
-
-def make_app(base_dir: str):
-    upload_folder = os.path.join(base_dir, 'uploads')
-    generated_folder = os.path.join(base_dir, 'generated_reports')
-
-    app = Flask(__name__, static_folder='static')
-    CORS(app)
-import os
-import shutil
-import queue
-import argparse
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
-from flask_cors import CORS
-
-from seu_script_de_extracao import run_extraction_process_web_mode
-
-
-ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
-
-
-def make_app(base_dir: str):
-    upload_folder = os.path.join(base_dir, 'uploads')
-    generated_folder = os.path.join(base_dir, 'generated_reports')
-
-    app = Flask(__name__, static_folder='static')
-    CORS(app)
-
-    app.config['UPLOAD_FOLDER'] = upload_folder
-    app.config['GENERATED_REPORTS_FOLDER'] = generated_folder
-    app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
-
-    os.makedirs(upload_folder, exist_ok=True)
-    os.makedirs(generated_folder, exist_ok=True)
-
-    return app
-
-
-def get_base_dir_from_args_or_env():
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('--base-dir', dest='base_dir', help='Pasta base para uploads e reports')
-    args, _ = parser.parse_known_args()
-    base_dir = args.base_dir or os.getenv('EXTRACTION_BASE_DIR') or os.getcwd()
-    return os.path.abspath(base_dir)
-
-
-BASE_DIR = get_base_dir_from_args_or_env()
-app = make_app(BASE_DIR)
-
-# Fila para comunicação de progresso
-progress_queue = queue.Queue()
-
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-
-@app.route('/')
-def index():
-    return send_from_directory(app.static_folder, 'index.html')
+                workspace.evicting = True
+                committed -= workspace.size
+                victims.append(workspace)
+        for workspace in victims:
+            for folder in (self.upload_folder(workspace.job_id), self.report_folder(workspace.job_id)):
+                shutil.rmtree(folder, ignore_errors=True)
+            with self.lock:
+                self.workspaces.pop(workspace.job_id, None)
+            if self.on_evict:
+                self.on_evict(workspace.job_id)
+            print(f"Limpeza concluída: lote {workspace.job_id} ({workspace.size / (1024 * 1024):.1f} MB)")
+
+
+def progress_queue_for(job_id):
+    """Fila de progresso de um lote admitido (a mesma que um /progress aberto
+    antes do upload já esteja ouvindo)."""
+    with jobs_lock:
+        pending_progress.pop(job_id, None)
+        return progress_queues.setdefault(job_id, queue.Queue())
+
+
+def expire_pending_progress():
+    """Descarta as filas de job_ids cujo upload não chegou a tempo."""
+    now = time.monotonic()
+    with jobs_lock:
+        for job_id, opened in list(pending_progress.items()):
+            if now - opened > PROGRESS_WAIT_SECONDS:
+                del pending_progress[job_id]
+                progress_queues.pop(job_id, None)
+
+
+def open_progress(job_id):
+    """Fila que o /progress vai ouvir. Um job_id ainda sem lote ganha uma fila
+    provisória, que expira se o upload não chegar em PROGRESS_WAIT_SECONDS;
+    retorna None se já há MAX_PENDING_PROGRESS delas."""
+    expire_pending_progress()
+    with jobs_lock:
+        if job_id in progress_queues:
+            return progress_queues[job_id]
+        if len(pending_progress) >= MAX_PENDING_PROGRESS:
+            return None
+        pending_progress[job_id] = time.monotonic()
+        return progress_queues.setdefault(job_id, queue.Queue())
 
 
 @app.route('/progress')
 def progress():
+    job_id = request.args.get('job_id', '')
+    if not JOB_ID_PATTERN.match(job_id):
+        return jsonify({"status": "error", "message": "Parâmetro job_id ausente ou inválido."}), 400
+    progress_queue = open_progress(job_id)
+    if progress_queue is None:
+        response = jsonify({"status": "error", "message": "Muitos streams de progresso aguardando upload. Tente novamente em instantes."})
+        response.headers['Retry-After'] = str(PROGRESS_WAIT_SECONDS)
+        return response, 429
+
     def generate():
         while True:
             try:
@@ -415,391 +525,781 @@ def progress():
                     break
                 yield f"data: {message}\n\n"
             except queue.Empty:
+                # Fila expirada (upload não chegou) ou lote já esquecido: nada
+                # mais vai chegar por ela
+                expire_pending_progress()
+                with jobs_lock:
+                    orphaned = progress_queues.get(job_id) is not progress_queue
+                if orphaned:
+                    yield f"data: DONE\n\n"
+                    break
                 yield f"data: ping\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
 
-@app.route('/upload_and_extract', methods=['POST'])
-def upload_and_extract():
-    skip_percentuais = request.form.get('skip_percentuals') in ('1', 'true', 'on', 'yes')
-
-    if 'pdf_files' not in request.files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF enviado."}), 400
-
-    pdf_files = request.files.getlist('pdf_files')
-    excel_file = request.files.get('excel_file') if 'excel_file' in request.files else None
-
-    if not pdf_files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF selecionado."}), 400
-
-    if not skip_percentuais and not excel_file:
-        return jsonify({"status": "error", "message": "Nenhum arquivo Excel de percentuais selecionado."}), 400
-
-    # limpa pastas temporárias
-    for folder in [app.config['UPLOAD_FOLDER'], app.config['GENERATED_REPORTS_FOLDER']]:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-        os.makedirs(folder, exist_ok=True)
-
-    # salva PDFs
-    for pdf in pdf_files:
-        if pdf and allowed_file(pdf.filename):
-            filename = secure_filename(pdf.filename)
-            pdf.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+class Job:
+    """Um lote (upload + extração) e sua área de trabalho: uploads/<job_id>
+    e generated_reports/<job_id>."""
+
+    def __init__(self, job_id, client):
+        self.id = job_id
+        self.client = client
+        self.created = time.time()
+        self.finished = None
+        self.status = 'receiving'
+        self.message = None
+        self.pipeline = None
+        self.final_state = None  # situação do pipeline ao terminar
+        self.traced = False
+        self.profiles = []  # PDFs com perfil cProfile (só com rastreamento)
+        # Pedido de cancelamento (POST /jobs/<job_id>/cancel); partial indica
+        # que o lote cancelado ainda gerou relatórios com o que já tinha extraído
+        self.cancellation = TokenCancelamento()
+        self.partial = False
+        self.upload_folder = storage.upload_folder(job_id)
+        self.report_folder = storage.report_folder(job_id)
+        self.progress = progress_queue_for(job_id)
+
+    def finish(self, status, message=None):
+        if self.pipeline is not None:
+            self.final_state = self.pipeline.situacao()
+            self.profiles = sorted(self.pipeline.perfis)
+            self.pipeline = None
+        self.status = status
+        self.message = message
+        self.finished = time.time()
+        self.progress.put('DONE')
+        storage.finish(self.id, downloadable=self.has_reports())
+        if self.has_reports():
+            threading.Thread(target=index_preview, args=(self.id,), daemon=True).start()
+
+    def has_reports(self):
+        return self.status == 'done' or self.partial
+
+
+def retry_after_seconds():
+    """Estimativa de quando haverá vaga: tempo para esvaziar a fila atual."""
+    return max(1, min(600, math.ceil(scheduler.estimativa_espera())))
+
+
+def admit_job(job_id, client):
+    """Registra o lote se houver vaga. Retorna (job, None) ou (None, resposta de erro)."""
+    with jobs_lock:
+        # job_id de lote conhecido, inclusive só no disco (relatórios de antes
+        # de reiniciar o servidor): não pode ser reaproveitado
+        if job_id in jobs or storage.exists(job_id):
+            return None, (jsonify({"status": "error", "message": "Já existe um lote com este job_id."}), 409)
+        active = [job for job in jobs.values() if job.status in ACTIVE_STATUSES]
+        if len(active) >= MAX_ACTIVE_JOBS:
+            message = "Servidor ocupado: muitos lotes em andamento. Tente novamente em instantes."
+        elif sum(1 for job in active if job.client == client) >= MAX_JOBS_PER_CLIENT:
+            message = f"Limite de {MAX_JOBS_PER_CLIENT} lote(s) simultâneo(s) por usuário atingido. Aguarde o término dos anteriores."
+        elif not storage.make_room():
+            message = "Servidor sem espaço em disco para novos lotes no momento. Tente novamente em instantes."
         else:
-            return jsonify({"status": "error", "message": f"Tipo de arquivo PDF não permitido: {pdf.filename}"}), 400
-
-    excel_path = None
-    if excel_file:
-        if allowed_file(excel_file.filename):
-            excel_filename = secure_filename(excel_file.filename)
-            excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-            excel_file.save(excel_path)
-        else:
-            return jsonify({"status": "error", "message": "Tipo de arquivo Excel não permitido ou nome inválido."}), 400
-
+            job = jobs[job_id] = Job(job_id, client)
+            storage.create(job_id)
+            return job, None
+    retry_after = retry_after_seconds()
+    response = jsonify({"status": "error", "message": message, "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return None, (response, 429)
+
+
+def forget_job(job_id):
+    with jobs_lock:
+        jobs.pop(job_id, None)
+        progress_queues.pop(job_id, None)
+
+
+def sweep_shared_folders():
+    """Expira, a cada passada da limpeza, o que os lotes deixam fora das suas
+    áreas de trabalho: journals interrompidos e o acervo de resultados."""
+    limpar_journais(app.config['JOURNAL_FOLDER'], JOURNAL_RETENTION_SECONDS, JOURNAL_QUOTA_BYTES)
+    if result_store:
+        result_store.limpar()
+
+
+# Uploads e relatórios de cada lote, apagados por uma única thread de limpeza
+storage = StorageManager(
+    app.config['UPLOAD_FOLDER'], app.config['GENERATED_REPORTS_FOLDER'],
+    ttl=CLEANUP_DELAY_SECONDS, quota=DISK_QUOTA_BYTES,
+    interval=JANITOR_INTERVAL_SECONDS, reserve=app.config['MAX_CONTENT_LENGTH'],
+    on_evict=forget_job, on_sweep=sweep_shared_folders
+)
+
+# --- PROCESSO ÚNICO DO SERVIDOR ---
+# Lotes, streams de progresso, áreas de trabalho e limites de admissão ficam
+# na memória do processo: uma requisição atendida por outro processo não
+# encontra o lote. Por isso um único processo do servidor usa cada pasta
+# base, e ele mantém uma trava (flock) em <pasta base>/servidor.lock. Outro
+# processo (gunicorn com --workers 2, por exemplo) espera a trava por até
+# SERVER_LOCK_WAIT_SECONDS, o bastante para a troca de worker num reload, e
+# se recusa a subir; o gunicorn então encerra o servidor.
+SERVER_LOCK_NAME = 'servidor.lock'
+SERVER_LOCK_WAIT_SECONDS = 10
+
+
+def acquire_server_lock(base_dir):
+    """Trava a pasta base para este processo. Retorna o arquivo travado (que
+    precisa ficar aberto) ou levanta RuntimeError se outro processo a usa."""
+    if fcntl is None:
+        return None
+    lock_file = open(os.path.join(base_dir, SERVER_LOCK_NAME), 'a')
+    deadline = time.monotonic() + SERVER_LOCK_WAIT_SECONDS
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                raise RuntimeError(
+                    f"Outro processo do servidor já usa a pasta base '{base_dir}'. O estado dos lotes fica "
+                    "na memória do processo: rode um único processo (gunicorn --workers 1 --threads 16).")
+            time.sleep(0.5)
+
+
+server_lock = None  # trava da pasta base, aberta enquanto o processo viver
+server_started = False
+
+
+def start_server():
+    """Trava a pasta base e inicia a limpeza e o pool de extração, já
+    aquecido para o primeiro lote não esperar por ele. Chamada só por
+    `python app.py` (bloco __main__) e pelo hook post_worker_init do
+    gunicorn (gunicorn.conf.py): os processos de extração (forkserver/spawn)
+    reimportam este arquivo ao subir e não podem rodar nada disto."""
+    global server_lock, server_started
+    if server_started:
+        return
+    server_lock = acquire_server_lock(BASE_DIR)
+    server_started = True
+    storage.start()
+    scheduler.aquecer()
+
+
+class UploadError(Exception):
+    """Erro de validação do upload (responde 400)."""
+
+
+def parse_known_files(value):
+    """Campo `known_files` do upload: JSON com [{"name", "sha256", "size"}]
+    dos PDFs que o cliente não enviou porque o servidor já os tem (ver
+    /known_files). Retorna [(nome seguro, sha256, tamanho)]."""
     try:
-        # limpa fila de progresso
-        while not progress_queue.empty():
-            progress_queue.get()
-
-        total_pdfs = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.pdf')])
-        progress_queue.put(f"0/{total_pdfs}")
-
-        output_files = run_extraction_process_web_mode(
-            pdf_upload_folder=app.config['UPLOAD_FOLDER'],
-            excel_percentual_path=excel_path,
-            output_report_folder=app.config['GENERATED_REPORTS_FOLDER'],
-            progress_callback=lambda current, total: progress_queue.put(f"{current}/{total}")
-        )
-
-        progress_queue.put('DONE')
-
-        response_data = {
-            "status": "success",
-            "message": "Extração e geração de relatórios concluídas com sucesso!",
-            "download_links": {}
-        }
-        for key, filename in output_files.items():
-            response_data["download_links"][key] = f"/download/{filename}"
-
-        return jsonify(response_data), 200
-
-    except Exception as e:
-        print(f"Erro durante a extração: {e}")
-        progress_queue.put('DONE')
-        return jsonify({"status": "error", "message": f"Erro interno durante a extração: {str(e)}"}), 500
-
-
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['GENERATED_REPORTS_FOLDER'], filename, as_attachment=True)
-
-
-if __name__ == '__main__':
-    print(f"\nServidor rodando! Base dir: {BASE_DIR}")
-    print("Acesse http://127.0.0.1:5000 no seu navegador.\n")
-    app.run(debug=True, port=5000, use_reloader=False)
-import argparse
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
-from flask_cors import CORS # Para permitir a comunicação
-
-# Importa a função principal que adaptamos do seu script
-from seu_script_de_extracao import run_extraction_process_web_mode
-
-
-# --- Configuração ---
-# Permite sobrescrever a pasta base onde os dados (uploads/generated_reports)
-# serão criados. Prioriza argumento de linha de comando, depois variável de
-# ambiente `EXTRACTION_BASE_DIR`, e por fim o diretório atual de trabalho.
-ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
-
-
-def make_app(base_dir: str):
-    """Cria a instância Flask usando `base_dir` como diretório base para
-    `uploads/` e `generated_reports/`. Isso permite que quem clona o repo
-    escolha onde armazenar os dados."""
-
-    upload_folder = os.path.join(base_dir, 'uploads')
-    generated_folder = os.path.join(base_dir, 'generated_reports')
-
-    app = Flask(__name__, static_folder='static')
-    CORS(app)
-
-    app.config['UPLOAD_FOLDER'] = upload_folder
-    app.config['GENERATED_REPORTS_FOLDER'] = generated_folder
-    app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
-
-    # Cria as pastas se não existirem
-    os.makedirs(upload_folder, exist_ok=True)
-    os.makedirs(generated_folder, exist_ok=True)
-
-    return app
-
-
-def get_base_dir_from_args_or_env():
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('--base-dir', dest='base_dir', help='Pasta base para uploads e reports')
-    args, _ = parser.parse_known_args()
-    base_dir = args.base_dir or os.getenv('EXTRACTION_BASE_DIR') or os.getcwd()
-    return os.path.abspath(base_dir)
-
-
-BASE_DIR = get_base_dir_from_args_or_env()
-app = make_app(BASE_DIR)
-
-
-# Fila para comunicação de progresso
-progress_queue = queue.Queue()
-
-
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-
-# --- Rota Principal (Interface) ---
-@app.route('/')
-def index():
-    return send_from_directory(app.static_folder, 'index.html')
-
-
-# --- Rota para Stream de Progresso ---
-@app.route('/progress')
-def progress():
-    def generate():
-        while True:
+        entries = json.loads(value or '[]')
+    except ValueError:
+        raise UploadError("Campo known_files inválido.")
+    if not isinstance(entries, list):
+        raise UploadError("Campo known_files inválido.")
+    known = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise UploadError("Campo known_files inválido.")
+        name = str(entry.get('name') or '')
+        sha256 = str(entry.get('sha256') or '').lower()
+        if not name.lower().endswith('.pdf') or not secure_filename(name) or not SHA256_PATTERN.match(sha256):
+            raise UploadError(f"Entrada inválida em known_files: {name}")
+        try:
+            size = max(0, int(entry.get('size') or 0))
+        except (TypeError, ValueError):
+            size = 0
+        known.append((secure_filename(name), sha256, size))
+    return known
+
+
+class UploadTarget:
+    """Destino de um arquivo do upload. Com `memory_budget` > 0 os bytes ficam
+    em memória enquanto couberem no orçamento; ao estourar, o que já chegou é
+    despejado em `path` e o restante continua sendo gravado no disco."""
+
+    def __init__(self, path, memory_budget=0):
+        self.path = path
+        self.memory_budget = memory_budget
+        self.buffer = io.BytesIO() if memory_budget > 0 else None
+        self.file = None if self.buffer is not None else open(path + '.part', 'wb')
+
+    def write(self, data):
+        if self.buffer is not None:
+            if self.buffer.tell() + len(data) <= self.memory_budget:
+                self.buffer.write(data)
+                return
+            self.file = open(self.path + '.part', 'wb')
+            self.file.write(self.buffer.getbuffer())
+            self.buffer = None
+        self.file.write(data)
+
+    def finish(self):
+        """Retorna os bytes se o arquivo ficou em memória, ou None se foi para o disco."""
+        if self.buffer is not None:
+            return self.buffer.getvalue()
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+        return None
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            if os.path.exists(self.path + '.part'):
+                os.remove(self.path + '.part')
+
+
+INCOMPLETE_UPLOAD_MESSAGE = "Upload incompleto: o corpo da requisição terminou antes do fim do formulário."
+
+
+def iter_multipart(stream, boundary, chunk_size=64 * 1024):
+    """Decodifica o corpo multipart à medida que ele chega pela rede. Gera
+    ('field', nome, valor), ('file', nome, filename), ('data', None, bytes)
+    e ('end', None, None) ao fim de cada arquivo. Um corpo que termina antes
+    do boundary final (upload interrompido) levanta UploadError."""
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=app.config.get('MAX_FORM_MEMORY_SIZE'))
+    current = None
+    field_data = []
+    while True:
+        chunk = stream.read(chunk_size)
+        try:
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+        except ValueError:
+            # o decoder não consegue fechar a parte em andamento
+            raise UploadError(INCOMPLETE_UPLOAD_MESSAGE)
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                current = event
+                yield 'file', event.name, event.filename
+            elif isinstance(event, Field):
+                current = event
+                field_data = []
+            elif isinstance(event, Data):
+                if isinstance(current, File):
+                    if event.data:
+                        yield 'data', None, event.data
+                    if not event.more_data:
+                        yield 'end', None, None
+                else:
+                    field_data.append(event.data)
+                    if not event.more_data:
+                        yield 'field', current.name, b''.join(field_data).decode('utf-8', 'replace')
             try:
-                message = progress_queue.get(timeout=30)
-                if message == 'DONE':
-                    yield f"data: {message}\n\n"
-                    break
-                yield f"data: {message}\n\n"
-            except queue.Empty:
-                yield f"data: ping\n\n"
-    return Response(generate(), mimetype='text/event-stream')
+                event = decoder.next_event()
+            except ValueError:
+                raise UploadError(INCOMPLETE_UPLOAD_MESSAGE)
+        if isinstance(event, Epilogue):
+            return
+        if not chunk:
+            raise UploadError(INCOMPLETE_UPLOAD_MESSAGE)
+
+
+@app.route('/known_files', methods=['POST'])
+def known_files():
+    """Negociação antes do upload: o cliente manda os SHA-256 dos PDFs
+    selecionados e recebe os que o servidor já extraiu (acervo de resultados
+    ou journal). Esses PDFs vão no campo `known_files` do upload, sem os bytes."""
+    data = request.get_json(silent=True) or {}
+    hashes = data.get('hashes')
+    if not isinstance(hashes, list) or len(hashes) > MAX_KNOWN_QUERY:
+        return jsonify({"status": "error",
+                        "message": f"Envie em 'hashes' uma lista de até {MAX_KNOWN_QUERY} SHA-256."}), 400
+    hashes = {str(h).lower() for h in hashes if SHA256_PATTERN.match(str(h).lower())}
+    known = hashes_conhecidos(hashes, result_store, app.config['JOURNAL_FOLDER'])
+    return jsonify({"status": "success", "known": sorted(known)})
 
 
-# --- Rota para a Extração ---
 @app.route('/upload_and_extract', methods=['POST'])
 def upload_and_extract():
-    if 'pdf_files' not in request.files or 'excel_file' not in request.files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF ou Excel enviado."}), 400
-
-    pdf_files = request.files.getlist('pdf_files')
-    excel_file = request.files['excel_file']
-
-    if not pdf_files or not excel_file:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF ou Excel selecionado."}), 400
-
-    # --- Limpa pastas temporárias para uma nova execução ---
-    for folder in [app.config['UPLOAD_FOLDER'], app.config['GENERATED_REPORTS_FOLDER']]:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-        os.makedirs(folder, exist_ok=True)
-
-    # --- Salva os arquivos PDF ---
-    for pdf in pdf_files:
-        if pdf and allowed_file(pdf.filename):
-            filename = secure_filename(pdf.filename)
-            pdf.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        else:
-            return jsonify({"status": "error", "message": f"Tipo de arquivo PDF não permitido: {pdf.filename}"}), 400
-
-    # --- Salva o arquivo Excel ---
-    if excel_file and allowed_file(excel_file.filename):
-        excel_filename = secure_filename(excel_file.filename)
-        excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-        excel_file.save(excel_path)
-    else:
-        return jsonify({"status": "error", "message": "Tipo de arquivo Excel não permitido ou nome inválido."}), 400
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({"status": "error", "message": "Nenhum arquivo PDF enviado."}), 400
 
+    job_id = request.args.get('job_id') or uuid.uuid4().hex
+    if not JOB_ID_PATTERN.match(job_id):
+        return jsonify({"status": "error", "message": "job_id inválido."}), 400
+
+    # Admissão antes de ler o corpo: com o servidor saturado o upload nem começa
+    job, refusal = admit_job(job_id, request.remote_addr)
+    if refusal:
+        return refusal
+
+    # área de trabalho própria do lote, criada na admissão (o journal fica
+    # em pasta compartilhada e sobrevive)
+    upload_folder = job.upload_folder
+
+    rejected_files = []
+
+    def report_rejected(rejected):
+        # Lista os arquivos rejeitados na triagem antes de serem extraídos
+        for filename, reason in rejected:
+            rejected_files.append({"arquivo": filename, "motivo": reason})
+            job.progress.put(f"REJEITADO: {filename} — {reason}")
+
+    job.traced = TRACE_ALL_JOBS or request.args.get('trace') in ('1', 'true', 'on', 'yes')
+
+    # A extração começa enquanto o upload ainda está chegando: cada PDF é
+    # entregue ao pipeline assim que termina de ser gravado no disco
+    pipeline = job.pipeline = PipelineExtracao(
+        pdf_upload_folder=upload_folder,
+        output_report_folder=job.report_folder,
+        progress_callback=lambda current, total: job.progress.put(f"{current}/{total}"),
+        journal_folder=app.config['JOURNAL_FOLDER'],
+        triage_callback=report_rejected,
+        cost_model_path=app.config['COST_MODEL_PATH'],
+        escalonador=scheduler,
+        rastrear=job.traced,
+        limite_perfil=PROFILE_THRESHOLD_SECONDS,
+        cancelamento=job.cancellation,
+        acervo=result_store,
+        limite_paginas=PAGE_SHARD_THRESHOLD
+    ).iniciar()
+
+    def memory_left():
+        # orçamento de memória do job descontando os PDFs que ainda aguardam extração
+        if not DISKLESS_MODE:
+            return 0
+        return max(0, DISKLESS_MEMORY_BUDGET - pipeline.memoria_em_uso)
+
+    target = None
     try:
-        # Limpa a fila de progresso
-        while not progress_queue.empty():
-            progress_queue.get()
-        
-        # Conta o total de PDFs
-        total_pdfs = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.pdf')])
-        progress_queue.put(f"0/{total_pdfs}")
-        
-        # --- A MÁGICA ACONTECE AQUI ---
-        # Chama a função adaptada do seu script, passando as pastas e a fila de progresso
-        output_files = run_extraction_process_web_mode(
-            pdf_upload_folder=app.config['UPLOAD_FOLDER'],
-            excel_percentual_path=excel_path,
-            output_report_folder=app.config['GENERATED_REPORTS_FOLDER'],
-            progress_callback=lambda current, total: progress_queue.put(f"{current}/{total}")
-        )
-        # --------------------------------
-        
-        # Sinaliza conclusão
-        progress_queue.put('DONE')
-
-        # Prepara a resposta JSON com links para download
+        form = {}
+        pdf_names = []
+        excel_path = None
+        excel_content = None
+        excel_ready = False
+        target_pdf = None  # nome do PDF sendo recebido (None para o Excel)
+        for kind, name, value in iter_multipart(request.stream, boundary):
+            # Extração interrompida por erro: o resto do upload não é lido
+            pipeline.verificar_erro()
+            if job.cancellation.cancelado:
+                # Lote cancelado durante o upload: o resto do corpo não é lido
+                if target:
+                    target.discard()
+                    target = None
+                break
+            if kind == 'field':
+                form[name] = value
+                if name == 'known_files':
+                    # PDFs que o servidor já tem: entram no lote sem os bytes
+                    for filename, sha256, size in parse_known_files(value):
+                        if filename in pdf_names:
+                            print(f"Arquivo repetido no upload ignorado: {filename}")
+                            continue
+                        pdf_names.append(filename)
+                        pipeline.adicionar_conhecido(filename, sha256, size)
+            elif kind == 'file':
+                target = None
+                if name == 'pdf_files':
+                    if not value or not allowed_file(value):
+                        raise UploadError(f"Tipo de arquivo PDF não permitido: {value}")
+                    filename = secure_filename(value)
+                    if filename in pdf_names:
+                        print(f"Arquivo repetido no upload ignorado: {filename}")
+                        continue
+                    pdf_names.append(filename)
+                    target = UploadTarget(os.path.join(upload_folder, filename), memory_left())
+                    target_pdf = filename
+                elif name == 'excel_file' and value:
+                    if not allowed_file(value):
+                        raise UploadError("Tipo de arquivo Excel não permitido ou nome inválido.")
+                    excel_path = os.path.join(upload_folder, secure_filename(value))
+                    target = UploadTarget(excel_path, memory_left())
+                    target_pdf = None
+            elif kind == 'data' and target:
+                target.write(value)
+            elif kind == 'end' and target:
+                content = target.finish()
+                target = None
+                if target_pdf:
+                    pipeline.adicionar(target_pdf, content)
+                else:
+                    excel_content = content
+                    excel_ready = True
+
+        if not job.cancellation.cancelado:
+            if not pdf_names:
+                raise UploadError("Nenhum arquivo PDF selecionado.")
+            skip_percentuais = form.get('skip_percentuals') in ('1', 'true', 'on', 'yes')
+            if not skip_percentuais and not excel_path:
+                raise UploadError("Nenhum arquivo Excel de percentuais selecionado.")
+
+        # Upload concluído: espera os PDFs em andamento e monta os relatórios
+        job.status = 'processing'
+        output_files = pipeline.finalizar(excel_path if excel_ready else None, excel_content)
+
         response_data = {
             "status": "success",
             "message": "Extração e geração de relatórios concluídas com sucesso!",
-            "download_links": {}
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "preview_url": f"/jobs/{job_id}/preview",
+            "download_links": {},
+            "rejected_files": rejected_files,
+            "reused_files": pipeline.reaproveitados,
+            "metrics": {"layout_templates": dict(pipeline.templates)}
         }
+        with metrics_lock:
+            for key, value in pipeline.templates.items():
+                layout_metrics[key] += value
         for key, filename in output_files.items():
-            response_data["download_links"][key] = f"/download/{filename}"
-            
+            response_data["download_links"][key] = f"/download/{job_id}/{filename}"
+        response_data["download_links"]["bundle"] = f"/download_bundle/{job_id}"
+
+        if pipeline.parcial:
+            # Cancelado com finalize=1: relatórios parciais
+            job.partial = True
+            response_data["status"] = "cancelled"
+            response_data["message"] = (f"Extração cancelada ({job.cancellation.motivo}); relatórios parciais gerados "
+                                        f"com {len(pipeline.resultados)} de {len(pipeline.admitidos)} PDFs.")
+            job.progress.put(f"CANCELADO: {response_data['message']}")
+            job.finish('cancelled', response_data["message"])
+            return jsonify(response_data), 200
+
+        job.finish('done')
         return jsonify(response_data), 200
 
+    except ExtracaoCancelada as e:
+        message = f"Extração cancelada ({e}); nenhum relatório foi gerado."
+        job.progress.put(f"CANCELADO: {message}")
+        job.finish('cancelled', message)
+        return jsonify({
+            "status": "cancelled",
+            "message": message,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "rejected_files": rejected_files,
+        }), 200
+
+    except UploadError as e:
+        if target:
+            target.discard()
+        pipeline.abortar()
+        job.finish('error', str(e))
+        return jsonify({"status": "error", "message": str(e)}), 400
+
     except Exception as e:
         print(f"Erro durante a extração: {e}")
-        progress_queue.put('DONE')
+        if target:
+            target.discard()
+        pipeline.abortar()
+        job.finish('error', str(e))
         return jsonify({"status": "error", "message": f"Erro interno durante a extração: {str(e)}"}), 500
 
 
-# --- Rota para Download dos Relatórios ---
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['GENERATED_REPORTS_FOLDER'], filename, as_attachment=True)
-
-
-# --- Inicia o Servidor ---
-if __name__ == '__main__':
-    # Se o usuário passar --base-dir ao executar `python app.py --base-dir <pasta>`
-    # ou configurar a variável de ambiente `EXTRACTION_BASE_DIR`, a app
-    # já terá sido criada apontando para essa pasta.
-    print(f"\nServidor rodando! Base dir: {BASE_DIR}")
-    print("Acesse http://127.0.0.1:5000 no seu navegador.\n")
-    app.run(debug=True, port=5000)
-import os
-import shutil
-import threading
-import queue
-from flask import Flask, request, jsonify, send_from_directory, Response
-from werkzeug.utils import secure_filename
-from flask_cors import CORS # Para permitir a comunicação
-
-# Importa a função principal que adaptamos do seu script
-from seu_script_de_extracao import run_extraction_process_web_mode
-
-# --- Configuração ---
-UPLOAD_FOLDER = 'uploads'
-GENERATED_REPORTS_FOLDER = 'generated_reports'
-ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx'}
-
-app = Flask(__name__, static_folder='static')
-CORS(app) # Habilita CORS para a aplicação
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['GENERATED_REPORTS_FOLDER'] = GENERATED_REPORTS_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # Limite de 100MB para uploads
-
-# Cria as pastas se não existirem
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(GENERATED_REPORTS_FOLDER, exist_ok=True)
-
-# Fila para comunicação de progresso
-progress_queue = queue.Queue()
-
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-# --- Rota Principal (Interface) ---
-@app.route('/')
-def index():
-    return send_from_directory(app.static_folder, 'index.html')
-
-# --- Rota para Stream de Progresso ---
-@app.route('/progress')
-def progress():
-    def generate():
-        while True:
-            try:
-                message = progress_queue.get(timeout=30)
-                if message == 'DONE':
-                    yield f"data: {message}\n\n"
-                    break
-                yield f"data: {message}\n\n"
-            except queue.Empty:
-                yield f"data: ping\n\n"
-    return Response(generate(), mimetype='text/event-stream')
-
-# --- Rota para a Extração ---
-@app.route('/upload_and_extract', methods=['POST'])
-def upload_and_extract():
-    if 'pdf_files' not in request.files or 'excel_file' not in request.files:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF ou Excel enviado."}), 400
-
-    pdf_files = request.files.getlist('pdf_files')
-    excel_file = request.files['excel_file']
-
-    if not pdf_files or not excel_file:
-        return jsonify({"status": "error", "message": "Nenhum arquivo PDF ou Excel selecionado."}), 400
-
-    # --- Limpa pastas temporárias para uma nova execução ---
-    for folder in [UPLOAD_FOLDER, GENERATED_REPORTS_FOLDER]:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-        os.makedirs(folder, exist_ok=True)
-
-    # --- Salva os arquivos PDF ---
-    for pdf in pdf_files:
-        if pdf and allowed_file(pdf.filename):
-            filename = secure_filename(pdf.filename)
-            pdf.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        else:
-            return jsonify({"status": "error", "message": f"Tipo de arquivo PDF não permitido: {pdf.filename}"}), 400
-
-    # --- Salva o arquivo Excel ---
-    if excel_file and allowed_file(excel_file.filename):
-        excel_filename = secure_filename(excel_file.filename)
-        excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-        excel_file.save(excel_path)
-    else:
-        return jsonify({"status": "error", "message": "Tipo de arquivo Excel não permitido ou nome inválido."}), 400
-
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Situação de um lote: arquivos por etapa, profundidade da fila de
+    extração (todos os lotes) e tempos de espera dos PDFs deste lote."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Lote não encontrado."}), 404
+    pipeline = job.pipeline
+    state = pipeline.situacao() if pipeline is not None else (job.final_state or {})
+    data = {
+        "job_id": job.id,
+        "status": job.status,
+        "message": job.message,
+        "elapsed_seconds": round((job.finished or time.time()) - job.created, 3),
+        "files": {
+            "received": state.get("recebidos", 0),
+            "admitted": state.get("admitidos", 0),
+            "done": state.get("concluidos", 0),
+            "queued": state.get("na_fila", 0),
+            "running": state.get("em_execucao", 0),
+            "rejected": state.get("rejeitados", 0),
+            "discarded": state.get("descartados", 0),
+            "reused": state.get("reaproveitados", 0),
+        },
+        "queue": {
+            "depth": scheduler.profundidade(),
+            "active_jobs": scheduler.lotes_ativos(),
+            "estimated_wait_seconds": round(scheduler.estimativa_espera(), 3),
+        },
+        "wait_seconds": {
+            "mean": round(state.get("espera_media", 0.0), 3),
+            "max": round(state.get("espera_maxima", 0.0), 3),
+            "current": round(state.get("espera_atual", 0.0), 3),
+        },
+    }
+    if job.cancellation.cancelado:
+        data["cancel_requested"] = True
+        data["partial"] = job.cancellation.finalizar_parcial
+    if job.has_reports():
+        data["download_links"] = {key: f"/download/{job.id}/{filename}" for key, filename in RELATORIOS.items()}
+        data["download_links"]["bundle"] = f"/download_bundle/{job.id}"
+        data["preview_url"] = f"/jobs/{job.id}/preview"
+        if job.traced:
+            data["trace_url"] = f"/jobs/{job.id}/trace"
+            data["profiles"] = {name: f"/jobs/{job.id}/profiles/{name}" for name in job.profiles}
+    return jsonify(data)
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancela um lote em andamento: os PDFs que ainda não começaram são
+    descartados e os em extração, abandonados. Com finalize=1 (na query ou no
+    formulário), os relatórios são gerados com os PDFs já extraídos."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Lote não encontrado."}), 404
+    if job.status not in ACTIVE_STATUSES:
+        return jsonify({"status": "error", "message": "O lote já terminou."}), 409
+    finalize = request.values.get('finalize') in ('1', 'true', 'on', 'yes')
+    if job.cancellation.cancelar("cancelado pelo usuário", finalizar_parcial=finalize):
+        job.progress.put("CANCELANDO: pedido de cancelamento recebido")
+    return jsonify({
+        "status": "cancelling",
+        "job_id": job.id,
+        "finalize": job.cancellation.finalizar_parcial,
+        "status_url": f"/jobs/{job.id}",
+    }), 202
+
+
+@app.route('/jobs/<job_id>/trace')
+def job_trace(job_id):
+    """Rastreamento do lote (abre em chrome://tracing ou ui.perfetto.dev)."""
+    def send(folder):
+        if not os.path.isfile(os.path.join(folder, NOME_RASTRO)):
+            return jsonify({"status": "error", "message": "Lote sem rastreamento (envie com ?trace=1)."}), 404
+        return send_from_directory(folder, NOME_RASTRO, mimetype='application/json',
+                                   as_attachment=True, download_name=f"rastro_{job_id}.json")
+    return serve_protected(job_id, send)
+
+
+@app.route('/jobs/<job_id>/profiles/<filename>')
+def job_profile(job_id, filename):
+    """Perfil cProfile (texto) de um PDF lento do lote."""
+    return serve_protected(job_id, lambda folder: send_from_directory(
+        folder, nome_arquivo_perfil(filename), mimetype='text/plain'))
+
+
+@app.route('/jobs/<job_id>/preview')
+def job_preview(job_id):
+    """Uma página dos resultados do lote, um item por aluno, lida do modelo de
+    linhas (nenhum relatório é renderizado). Query: page, per_page, sort
+    (seq, matricula, name, components, pending_hours, percentage, file),
+    order (asc/desc) e os filtros matricula, name, component e q (qualquer
+    um dos três), que buscam por trecho sem diferenciar maiúsculas e acentos."""
     try:
-        # Limpa a fila de progresso
-        while not progress_queue.empty():
-            progress_queue.get()
-        
-        # Conta o total de PDFs
-        total_pdfs = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.pdf')])
-        progress_queue.put(f"0/{total_pdfs}")
-        
-        # --- A MÁGICA ACONTECE AQUI ---
-        # Chama a função adaptada do seu script, passando as pastas e a fila de progresso
-        output_files = run_extraction_process_web_mode(
-            pdf_upload_folder=app.config['UPLOAD_FOLDER'],
-            excel_percentual_path=excel_path,
-            output_report_folder=app.config['GENERATED_REPORTS_FOLDER'],
-            progress_callback=lambda current, total: progress_queue.put(f"{current}/{total}")
-        )
-        # --------------------------------
-        
-        # Sinaliza conclusão
-        progress_queue.put('DONE')
-
-        # Prepara a resposta JSON com links para download
-        response_data = {
-            "status": "success",
-            "message": "Extração e geração de relatórios concluídas com sucesso!",
-            "download_links": {}
-        }
-        for key, filename in output_files.items():
-            response_data["download_links"][key] = f"/download/{filename}"
-            
-        return jsonify(response_data), 200
-
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', PREVIEW_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetros page e per_page devem ser números."}), 400
+    if page < 1 or not 1 <= per_page <= MAX_PREVIEW_PAGE_SIZE:
+        return jsonify({"status": "error",
+                        "message": f"Use page >= 1 e per_page entre 1 e {MAX_PREVIEW_PAGE_SIZE}."}), 400
+    sort = request.args.get('sort', 'seq')
+    order = request.args.get('order', 'asc')
+    if sort not in PREVIEW_SORT_FIELDS or order not in ('asc', 'desc'):
+        return jsonify({"status": "error", "message": "Parâmetros sort/order inválidos."}), 400
+    filters = {field: request.args.get(param, '').strip() for param, field in PREVIEW_FILTERS.items()}
+
+    def send(folder):
+        preview = carregar_previa(folder)
+        if preview is None:
+            return jsonify({"status": "error", "message": "Lote sem resultados para pré-visualizar."}), 404
+        students, matched = preview.pagina(page, per_page, PREVIEW_SORT_FIELDS[sort], order == 'desc', filters)
+        return jsonify({
+            "job_id": job_id,
+            "page": page,
+            "per_page": per_page,
+            "pages": max(1, math.ceil(matched / per_page)),
+            "matched": matched,
+            "total": len(preview.alunos),
+            "sort": sort,
+            "order": order,
+            "students": [{
+                "seq": student["seq"],
+                "matricula": student["matricula"],
+                "name": student["nome"],
+                "components": student["componentes"],
+                "summary": student["resumo"],
+                "pending_hours": student["ch_total"],
+                "percentage": student["percentual"],
+                "file": student["arquivo"],
+            } for student in students],
+        })
+    return serve_protected(job_id, send)
+
+
+def index_preview(job_id):
+    """Indexa a pré-visualização assim que o lote termina, para que a primeira
+    página pedida não espere a leitura do modelo de linhas."""
+    folder = storage.acquire(job_id)
+    if folder is None:
+        return
+    try:
+        carregar_previa(folder)
     except Exception as e:
-        print(f"Erro durante a extração: {e}")
-        progress_queue.put('DONE')
-        return jsonify({"status": "error", "message": f"Erro interno durante a extração: {str(e)}"}), 500
+        print(f"Erro ao indexar a pré-visualização do lote {job_id}: {e}")
+    finally:
+        storage.release(job_id)
+
+
+def client_accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def render_report(folder, filename):
+    """Renderiza o relatório sob demanda (no primeiro download) a partir do
+    modelo de linhas gravado pela extração."""
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        # já renderizado (publicado com rename atômico): nenhuma trava
+        return path
+    with render_locks.hold((folder, filename)):
+        return renderizar_relatorio(folder, filename)
+
+
+def build_bundle(folder):
+    """Monta (ou reaproveita) o ZIP com todos os relatórios da pasta.
+    O ZIP só é refeito se algum relatório for mais novo que ele."""
+    bundle_path = os.path.join(folder, BUNDLE_NAME)
+    reports = [name for name in sorted(RELATORIOS.values()) if render_report(folder, name)]
+    if not reports:
+        return None
+    with bundle_locks.hold(folder):
+        if os.path.exists(bundle_path):
+            bundle_mtime = os.path.getmtime(bundle_path)
+            if all(os.path.getmtime(os.path.join(folder, f)) <= bundle_mtime for f in reports):
+                return bundle_path
+        tmp_path = bundle_path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w') as zf:
+            for name in reports:
+                compress = zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                zf.write(os.path.join(folder, name), arcname=name, compress_type=compress)
+        os.replace(tmp_path, bundle_path)
+    return bundle_path
+
+
+@app.route('/metrics')
+def metrics():
+    """Contadores acumulados do cache de templates de layout (desde o início
+    do servidor) e a situação atual da fila de extração e dos workers."""
+    with metrics_lock:
+        hits, misses = layout_metrics["acertos"], layout_metrics["falhas"]
+    total = hits + misses
+    with jobs_lock:
+        active_jobs = sum(1 for job in jobs.values() if job.status in ACTIVE_STATUSES)
+    return jsonify({
+        "layout_templates": {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else None,
+        },
+        "queue": {
+            "depth": scheduler.profundidade(),
+            "active_jobs": active_jobs,
+            "max_active_jobs": MAX_ACTIVE_JOBS,
+            "estimated_wait_seconds": round(scheduler.estimativa_espera(), 3),
+        },
+        "storage": storage_metrics(),
+        "workers": worker_metrics(),
+    })
+
+
+def worker_metrics():
+    pool = scheduler.situacao_pool()
+    if DISTRIBUTED_MODE:
+        return {
+            "mode": "distributed",
+            "max_inflight": DISTRIBUTED_INFLIGHT,
+            "expected_processes": DISTRIBUTED_WORKERS,
+            "tasks": pool["estados"],
+            "workers": pool["workers"],
+            "awaiting_results": pool["aguardando"],
+        }
+    return {
+        "mode": "local",
+        "processes": scheduler.max_workers,
+        "max_tasks": WORKER_MAX_TASKS,
+        "max_rss_mb": WORKER_MAX_RSS_MB,
+        "recycled": pool["reciclados"],
+        "restarted": pool["reiniciados"],
+        "pool": [{"pid": w["pid"], "ready": w["pronto"], "busy": w["ocupado"],
+                  "tasks": w["tarefas"], "rss_mb": w["rss_mb"]} for w in pool["workers"]],
+    }
+
+
+def storage_metrics():
+    used, committed = storage.usage()
+    with storage.lock:
+        workspaces = len(storage.workspaces)
+    return {
+        "workspaces": workspaces,
+        "used_bytes": used,
+        "committed_bytes": committed,
+        "quota_bytes": storage.quota,
+    }
+
+
+def not_found():
+    return jsonify({"status": "error", "message": "Nenhum relatório disponível para download."}), 404
+
+
+def serve_protected(job_id, send):
+    """Serve um download mantendo os relatórios do lote protegidos da
+    limpeza até a resposta terminar de ser enviada."""
+    folder = storage.acquire(job_id)
+    if folder is None:
+        return not_found()
+    try:
+        response = app.make_response(send(folder))
+    except BaseException:
+        storage.release(job_id)
+        raise
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            storage.release(job_id)
+    # call_on_close não é chamado em respostas direct_passthrough (send_file);
+    # o corpo da resposta, por sua vez, é sempre fechado pelo servidor
+    response.response = ClosingIterator(response.response, [release])
+    return response
+
+
+@app.route('/download/<job_id>/<filename>')
+def download_job_file(job_id, filename):
+    return serve_protected(job_id, lambda folder: send_report(folder, filename))
+
+
+def send_report(folder, filename):
+    # Só os relatórios (e seus .gz) são servidos; o modelo de linhas, o
+    # rastreamento e os demais arquivos internos do lote não
+    report = filename[:-3] if filename.endswith('.gz') else filename
+    if report not in RELATORIOS.values():
+        return not_found()
+    render_report(folder, report)
+    # send_file/send_from_directory já tratam ETag, Last-Modified, 304 e Range
+    gz_path = safe_join(folder, filename + '.gz')
+    if gz_path and os.path.isfile(gz_path) and client_accepts_gzip():
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_file(gz_path, mimetype=mimetype, as_attachment=True, download_name=filename)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    response = send_from_directory(folder, filename, as_attachment=True)
+    if gz_path and os.path.isfile(gz_path):
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route('/download_bundle/<job_id>')
+def download_job_bundle(job_id):
+    return serve_protected(job_id, send_bundle)
+
+
+def send_bundle(folder):
+    bundle_path = build_bundle(folder)
+    if not bundle_path:
+        return not_found()
+    return send_file(bundle_path, mimetype='application/zip', as_attachment=True, download_name=BUNDLE_NAME)
 
-# --- Rota para Download dos Relatórios ---
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['GENERATED_REPORTS_FOLDER'], filename, as_attachment=True)
 
-# --- Inicia o Servidor ---
 if __name__ == '__main__':
-    print("\nServidor rodando! Acesse http://127.0.0.1:5000 no seu navegador.\n")
-    app.run(debug=False, port=5000, use_reloader=False)
\ No newline at end of file
+    start_server()
+    print(f"\nServidor rodando! Base dir: {BASE_DIR}")
+    print("Acesse http://127.0.0.1:5000 no seu navegador.\n")
+    app.run(debug=False, port=5000, use_reloader=False)
@@ -0,0 +1,87 @@
+"""Benchmark da extração: mede o tempo de cada PDF de uma pasta e compara o
+tempo total do lote (makespan) despachando em ordem alfabética (FIFO) e do
+mais caro para o mais barato (LPT, com o custo estimado pelo EstimadorCusto).
+
+Uso:
+    python benchmark.py <pasta_com_pdfs> [--workers 4] [--executar]
+
+Com --executar, além da simulação a partir dos tempos medidos, o lote é
+extraído de verdade em paralelo nas duas ordens e o tempo de parede é medido.
+"""
+import os
+import time
+import argparse
+
+from seu_script_de_extracao import (
+    EstimadorCusto, triar_pdf, processar_pdf, executar_extracoes,
+    ordenar_por_custo, simular_makespan,
+)
+
+
+def medir(pasta, arquivos):
+    duracoes = {}
+    for arquivo in arquivos:
+        _, _, segundos, _, _ = processar_pdf(os.path.join(pasta, arquivo))
+        duracoes[arquivo] = segundos
+    return duracoes
+
+
+def executar(pasta, ordem, workers):
+    inicio = time.perf_counter()
+    tarefas = [(a, os.path.join(pasta, a), False) for a in ordem]
+    for _ in executar_extracoes(tarefas, workers):
+        pass
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do agendamento da extração de históricos')
+    parser.add_argument('pasta', help='Pasta com os PDFs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processos de extração')
+    parser.add_argument('--executar', action='store_true', help='Também executa o lote de verdade nas duas ordens')
+    args = parser.parse_args()
+
+    arquivos = sorted(f for f in os.listdir(args.pasta) if f.lower().endswith('.pdf'))
+    paginas = {}
+    tamanhos = {}
+    for arquivo in list(arquivos):
+        caminho = os.path.join(args.pasta, arquivo)
+        motivo, meta = triar_pdf(caminho)
+        if motivo:
+            print(f"Ignorado: {arquivo} — {motivo}")
+            arquivos.remove(arquivo)
+            continue
+        paginas[arquivo] = meta['paginas']
+        tamanhos[arquivo] = os.path.getsize(caminho)
+    if not arquivos:
+        print("Nenhum PDF válido na pasta.")
+        return
+
+    print(f"Medindo {len(arquivos)} PDFs (sequencial)...")
+    duracoes = medir(args.pasta, arquivos)
+
+    # Estimativa com o modelo inicial (lote "frio") e com o modelo ajustado
+    # pelos próprios tempos medidos (lote "aprendido")
+    frio = EstimadorCusto()
+    aprendido = EstimadorCusto()
+    for arquivo in arquivos:
+        aprendido.registrar(paginas[arquivo], tamanhos[arquivo], duracoes[arquivo])
+
+    fifo = simular_makespan(arquivos, duracoes, args.workers)
+    print(f"\nSoma dos tempos: {sum(duracoes.values()):.2f}s | maior PDF: {max(duracoes.values()):.2f}s | workers: {args.workers}")
+    print(f"Makespan FIFO (alfabético):   {fifo:.2f}s")
+    for nome, estimador in (('LPT (modelo inicial)', frio), ('LPT (modelo aprendido)', aprendido)):
+        custos = {a: estimador.estimar(paginas[a], tamanhos[a]) for a in arquivos}
+        lpt = simular_makespan(ordenar_por_custo(arquivos, custos), duracoes, args.workers)
+        print(f"Makespan {nome + ':':<26}{lpt:.2f}s (redução de {(1 - lpt / fifo) * 100:.1f}% sobre FIFO)")
+    print(f"Modelo aprendido: {aprendido.seg_por_pagina:.3f} s/página + {aprendido.seg_por_mb:.3f} s/MB")
+
+    if args.executar:
+        custos = {a: aprendido.estimar(paginas[a], tamanhos[a]) for a in arquivos}
+        real_fifo = executar(args.pasta, arquivos, args.workers)
+        real_lpt = executar(args.pasta, ordenar_por_custo(arquivos, custos), args.workers)
+        print(f"\nExecução real: FIFO {real_fifo:.2f}s | LPT {real_lpt:.2f}s (redução de {(1 - real_lpt / real_fifo) * 100:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
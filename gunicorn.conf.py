@@ -0,0 +1,13 @@
+# Configuração do gunicorn, lida automaticamente quando ele é iniciado nesta
+# pasta (gunicorn app:app). O servidor guarda os lotes na memória do
+# processo: um único worker, com threads (ver README).
+workers = 1
+worker_class = 'gthread'
+threads = 16
+
+
+def post_worker_init(worker):
+    # Trava a pasta base e sobe a limpeza e o pool de extração no worker
+    # (não no import do app.py, que os processos de extração repetem)
+    from app import start_server
+    start_server()
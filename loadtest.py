@@ -0,0 +1,346 @@
+"""Teste de carga local: simula vários coordenadores enviando lotes ao mesmo
+tempo contra um servidor gunicorn iniciado localmente (ou já em execução).
+
+Cada usuário virtual, em sequência, para cada lote:
+  1. abre o stream GET /progress (mede o tempo até o primeiro evento);
+  2. envia POST /upload_and_extract com um lote sintético de PDFs da pasta
+     (amostrados com reposição, com nomes únicos por usuário/lote); com
+     --tentativas, reenvia lotes recusados com 429 após o Retry-After;
+  3. baixa cada relatório listado em download_links.
+
+Ao final são mostrados, por endpoint, p50/p95/p99 de latência, vazão e taxa
+de erros, além do RSS do servidor (processo mestre + workers) amostrado
+durante o teste.
+
+Uso:
+    python loadtest.py <pasta_com_pdfs> [--usuarios 20] [--lotes 1] [--tamanho-lote 10]
+                       [--gunicorn-workers 1] [--threads 8] [--url http://127.0.0.1:8000]
+
+Sem --url, o gunicorn é iniciado com uma pasta base temporária e encerrado
+no fim (requer `pip install gunicorn`; o RSS é lido de /proc, só Linux).
+"""
+import os
+import sys
+import time
+import json
+import uuid
+import random
+import signal
+import socket
+import select
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+
+# --- CLIENTE HTTP ---
+
+class Cliente:
+    def __init__(self, url, timeout):
+        partes = urlsplit(url)
+        self.host = partes.hostname
+        self.porta = partes.port or 80
+        self.timeout = timeout
+
+    def conexao(self):
+        return http.client.HTTPConnection(self.host, self.porta, timeout=self.timeout)
+
+    def requisitar(self, metodo, caminho, corpo=None, headers=None):
+        """Retorna (status, corpo); erros de rede viram status 0."""
+        conn = self.conexao()
+        try:
+            conn.request(metodo, caminho, body=corpo, headers=headers or {})
+            resposta = conn.getresponse()
+            return resposta.status, resposta.read()
+        except (OSError, http.client.HTTPException) as e:
+            return 0, str(e).encode()
+        finally:
+            conn.close()
+
+
+def montar_multipart(arquivos):
+    """Corpo multipart com skip_percentuals e os PDFs [(nome, bytes)]."""
+    fronteira = uuid.uuid4().hex
+    partes = [
+        f'--{fronteira}\r\nContent-Disposition: form-data; name="skip_percentuals"\r\n\r\n1\r\n'.encode()
+    ]
+    for nome, conteudo in arquivos:
+        partes.append(
+            f'--{fronteira}\r\nContent-Disposition: form-data; name="pdf_files"; filename="{nome}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'.encode()
+        )
+        partes.append(conteudo)
+        partes.append(b'\r\n')
+    partes.append(f'--{fronteira}--\r\n'.encode())
+    return b''.join(partes), f'multipart/form-data; boundary={fronteira}'
+
+
+# --- MÉTRICAS ---
+
+class Metricas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.amostras = {}  # endpoint -> [(segundos, ok)]
+        self.pdfs_enviados = 0
+        self.recusados = 0  # uploads recusados pelo controle de admissão (429)
+
+    def registrar(self, endpoint, segundos, ok):
+        with self.lock:
+            self.amostras.setdefault(endpoint, []).append((segundos, ok))
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    k = (len(valores) - 1) * p / 100
+    i = int(k)
+    if i + 1 >= len(valores):
+        return valores[-1]
+    return valores[i] + (valores[i + 1] - valores[i]) * (k - i)
+
+
+class AmostradorRSS(threading.Thread):
+    """Soma o RSS do processo e de seus filhos (via /proc) periodicamente."""
+
+    def __init__(self, pid, intervalo=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervalo = intervalo
+        self.amostras = []
+        self.parar = threading.Event()
+
+    def rss_total(self):
+        pids = {self.pid}
+        try:
+            for entrada in os.listdir('/proc'):
+                if entrada.isdigit():
+                    try:
+                        with open(f'/proc/{entrada}/stat') as f:
+                            campos = f.read().rsplit(')', 1)[1].split()
+                        if int(campos[1]) == self.pid:
+                            pids.add(int(entrada))
+                    except (OSError, IndexError, ValueError):
+                        continue
+        except OSError:
+            return None
+        total = 0
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for linha in f:
+                        if linha.startswith('VmRSS:'):
+                            total += int(linha.split()[1]) * 1024
+            except OSError:
+                continue
+        return total
+
+    def run(self):
+        while not self.parar.is_set():
+            rss = self.rss_total()
+            if rss:
+                self.amostras.append(rss)
+            self.parar.wait(self.intervalo)
+
+
+# --- USUÁRIO VIRTUAL ---
+
+def acompanhar_progresso(cliente, job_id, metricas, fim):
+    """Mede o tempo até o primeiro evento do stream /progress (ou até o
+    upload terminar, se nenhum evento chegar antes)."""
+    inicio = time.perf_counter()
+    conn = cliente.conexao()
+    ok = False
+    try:
+        conn.request('GET', f'/progress?job_id={job_id}')
+        # O servidor só envia os cabeçalhos junto com o primeiro evento
+        while not fim.is_set():
+            if select.select([conn.sock], [], [], 0.2)[0]:
+                resposta = conn.getresponse()
+                if resposta.status == 200:
+                    while True:
+                        linha = resposta.fp.readline()
+                        if not linha or linha.startswith(b'data:'):
+                            break
+                ok = resposta.status == 200
+                break
+        else:
+            ok = True
+    except (OSError, http.client.HTTPException):
+        ok = fim.is_set()
+    finally:
+        conn.close()
+    metricas.registrar('GET /progress', time.perf_counter() - inicio, ok)
+
+
+def usuario(indice, cliente, pdfs, args, metricas, rng):
+    for lote in range(args.lotes):
+        escolhidos = [rng.choice(pdfs) for _ in range(args.tamanho_lote)]
+        arquivos = [(f'u{indice:03d}_l{lote:03d}_{i:04d}_{nome}', conteudo)
+                    for i, (nome, conteudo) in enumerate(escolhidos)]
+        corpo, content_type = montar_multipart(arquivos)
+
+        job_id = uuid.uuid4().hex
+        fim = threading.Event()
+        progresso = None
+        if not args.sem_progresso:
+            progresso = threading.Thread(target=acompanhar_progresso, args=(cliente, job_id, metricas, fim), daemon=True)
+            progresso.start()
+
+        inicio = time.perf_counter()
+        for tentativa in range(args.tentativas + 1):
+            status, resposta = cliente.requisitar('POST', f'/upload_and_extract?job_id={job_id}', corpo, {'Content-Type': content_type})
+            if status != 429:
+                break
+            with metricas.lock:
+                metricas.recusados += 1
+            if tentativa < args.tentativas:
+                try:
+                    espera = float(json.loads(resposta).get('retry_after', 1))
+                except ValueError:
+                    espera = 1.0
+                time.sleep(espera)
+        metricas.registrar('POST /upload_and_extract', time.perf_counter() - inicio, status == 200)
+        fim.set()
+        if progresso:
+            progresso.join(timeout=5)
+        if status != 200:
+            print(f"   usuário {indice}, lote {lote}: HTTP {status} {resposta[:200]!r}")
+            continue
+        with metricas.lock:
+            metricas.pdfs_enviados += len(arquivos)
+
+        try:
+            links = json.loads(resposta).get('download_links', {})
+        except ValueError:
+            links = {}
+        for chave, caminho in links.items():
+            endpoint = 'GET /download_bundle' if chave == 'bundle' else 'GET /download/<filename>'
+            inicio = time.perf_counter()
+            status, _ = cliente.requisitar('GET', caminho, headers={'Accept-Encoding': 'gzip'})
+            metricas.registrar(endpoint, time.perf_counter() - inicio, status == 200)
+
+
+# --- SERVIDOR LOCAL ---
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def iniciar_gunicorn(args, base_dir):
+    porta = porta_livre()
+    comando = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--config', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'),
+        '--bind', f'127.0.0.1:{porta}',
+        '--workers', str(args.gunicorn_workers),
+        '--worker-class', 'gthread', '--threads', str(args.threads),
+        '--timeout', str(int(args.timeout)),
+    ]
+    env = dict(os.environ, EXTRACTION_BASE_DIR=base_dir)
+    log = open(os.path.join(base_dir, 'gunicorn.log'), 'wb')
+    processo = subprocess.Popen(comando, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{porta}'
+    cliente = Cliente(url, timeout=2)
+    limite = time.time() + 30
+    while time.time() < limite:
+        if processo.poll() is not None:
+            raise RuntimeError(f"gunicorn encerrou ao iniciar (veja {log.name})")
+        status, _ = cliente.requisitar('GET', '/')
+        if status:
+            return processo, url
+        time.sleep(0.2)
+    processo.terminate()
+    raise RuntimeError("gunicorn não respondeu em 30s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga dos endpoints do extrator')
+    parser.add_argument('pasta', help='Pasta com os PDFs usados para montar os lotes')
+    parser.add_argument('--usuarios', type=int, default=20, help='Usuários simultâneos')
+    parser.add_argument('--lotes', type=int, default=1, help='Lotes enviados por usuário')
+    parser.add_argument('--tamanho-lote', type=int, default=10, help='PDFs por lote')
+    parser.add_argument('--url', help='Servidor já em execução (padrão: inicia um gunicorn local)')
+    parser.add_argument('--pid', type=int, help='PID do servidor informado em --url, para medir o RSS')
+    parser.add_argument('--gunicorn-workers', type=int, default=1,
+                        help='Workers do gunicorn local (o servidor mantém os lotes em memória e recusa mais de 1)')
+    parser.add_argument('--threads', type=int, default=8, help='Threads por worker do gunicorn local')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout das requisições (s)')
+    parser.add_argument('--tentativas', type=int, default=0,
+                        help='Reenvios de um lote recusado com 429, respeitando o Retry-After')
+    parser.add_argument('--sem-progresso', action='store_true', help='Não abre o stream /progress')
+    parser.add_argument('--seed', type=int, default=0, help='Semente da amostragem dos lotes')
+    args = parser.parse_args()
+
+    pdfs = []
+    for arquivo in sorted(os.listdir(args.pasta)):
+        if arquivo.lower().endswith('.pdf'):
+            with open(os.path.join(args.pasta, arquivo), 'rb') as f:
+                pdfs.append((arquivo, f.read()))
+    if not pdfs:
+        print("Nenhum PDF na pasta.")
+        return
+
+    processo = None
+    base_temporaria = None
+    pid = args.pid
+    url = args.url
+    if not url:
+        base_temporaria = tempfile.mkdtemp(prefix='extrator_carga_')
+        processo, url = iniciar_gunicorn(args, base_temporaria)
+        pid = processo.pid
+        print(f"gunicorn iniciado em {url} (pid {pid}, {args.gunicorn_workers} workers x {args.threads} threads, base {base_temporaria})")
+
+    amostrador = None
+    if pid and os.path.isdir('/proc'):
+        amostrador = AmostradorRSS(pid)
+        amostrador.start()
+
+    metricas = Metricas()
+    cliente = Cliente(url, args.timeout)
+    print(f"{args.usuarios} usuários x {args.lotes} lote(s) de {args.tamanho_lote} PDFs contra {url}...")
+    inicio = time.perf_counter()
+    threads = [
+        threading.Thread(target=usuario, args=(i, cliente, pdfs, args, metricas, random.Random(args.seed + i)))
+        for i in range(args.usuarios)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - inicio
+
+    if amostrador:
+        amostrador.parar.set()
+        amostrador.join()
+    if processo:
+        processo.send_signal(signal.SIGTERM)
+        try:
+            processo.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            processo.kill()
+
+    print(f"\nDuração: {duracao:.2f}s | PDFs extraídos: {metricas.pdfs_enviados} ({metricas.pdfs_enviados / duracao:.2f} PDFs/s)")
+    print(f"{'endpoint':<28}{'req':>6}{'erros':>8}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for endpoint, amostras in sorted(metricas.amostras.items()):
+        tempos = [s for s, _ in amostras]
+        erros = sum(1 for _, ok in amostras if not ok)
+        print(f"{endpoint:<28}{len(amostras):>6}{erros / len(amostras):>8.1%}{len(amostras) / duracao:>8.2f}"
+              f"{percentil(tempos, 50):>8.2f}s{percentil(tempos, 95):>8.2f}s{percentil(tempos, 99):>8.2f}s")
+    if metricas.recusados:
+        print(f"Recusas por controle de admissão (429): {metricas.recusados}")
+    if amostrador and amostrador.amostras:
+        mb = 1024 * 1024
+        print(f"RSS do servidor: pico {max(amostrador.amostras) / mb:.0f} MB | final {amostrador.amostras[-1] / mb:.0f} MB")
+    if base_temporaria:
+        print(f"Log do gunicorn: {os.path.join(base_temporaria, 'gunicorn.log')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,429 @@
 import pdfplumber
+import pypdfium2 as pdfium
 import os
 import re
+import io
 import csv
+import atexit
+import json
+import gzip
+import time
+import uuid
+import queue
+import shutil
+import pstats
+import socket
+import sqlite3
+import sys
+import heapq
+import hashlib
+import cProfile
+import unicodedata
+import threading
+import multiprocessing.connection
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 import xlrd
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, Alignment
 
+try:
+    import fcntl  # travas de arquivo (journal em gravação); ausente no Windows
+except ImportError:
+    fcntl = None
+
 # --- FUNÇÕES AUXILIARES (do seu script original) ---
-# Todas as funções que seu amigo criou estão aqui, sem modificação.
+# Vieram do script original. Desde então foram adaptadas: aceitam PDFs em
+# memória e devolvem os resultados no modelo compacto (ResultadoHistorico).
+
+# Os PDFs podem vir do disco (caminho) ou da memória (bytes, no modo sem disco);
+# as funções abaixo aceitam qualquer um dos dois.
+
+def abrir_pdf(fonte):
+    """Abre o PDF no pdfplumber a partir de um caminho ou de bytes."""
+    if isinstance(fonte, (bytes, bytearray, memoryview)):
+        return pdfplumber.open(io.BytesIO(fonte))
+    return pdfplumber.open(fonte)
+
+def descrever_pdf(fonte):
+    """Texto para mensagens de log (não imprime o conteúdo de PDFs em memória)."""
+    if isinstance(fonte, (bytes, bytearray, memoryview)):
+        return f"<PDF em memória, {len(fonte)} bytes>"
+    return fonte
+
+_RE_ESPACOS = re.compile(r'\s+')
 
 def limpar_texto(texto):
     """Remove quebras de linha extras e espaços desnecessários."""
     if texto:
-        return re.sub(r'\s+', ' ', str(texto)).strip()
+        return _RE_ESPACOS.sub(' ', str(texto)).strip()
     return ""
 
+# --- MODELO DE RESULTADOS ---
+# Resultado da extração de um histórico em forma compacta: objetos com
+# __slots__, carga horária em horas (int) e código e nome dos componentes
+# internados (o mesmo componente se repete nos históricos de toda a turma).
+# É o que os workers devolvem ao processo principal (o pickle leva só os
+# valores, ver __reduce__), o que o journal e o acervo guardam (em JSON, ver
+# registro_para_json) e de onde sai o modelo de linhas dos relatórios.
+# Registros guardados levam VERSAO_EXTRATOR: incremente-a a cada correção que
+# mude o que a extração devolve, e os resultados antigos (acervo e journals)
+# deixam de ser reaproveitados.
+
+VERSAO_EXTRATOR = 1
+
+class ComponentePendente:
+    """Componente curricular obrigatório pendente; ch em horas, ou None se o
+    histórico não traz a carga horária."""
+
+    __slots__ = ('codigo', 'nome', 'ch')
+
+    def __init__(self, codigo, nome, ch=None):
+        self.codigo = sys.intern(codigo)
+        self.nome = sys.intern(nome)
+        self.ch = ch
+
+    def __reduce__(self):
+        return (ComponentePendente, (self.codigo, self.nome, self.ch))
+
+    def __eq__(self, outro):
+        return (isinstance(outro, ComponentePendente)
+                and (self.codigo, self.nome, self.ch) == (outro.codigo, outro.nome, outro.ch))
+
+    def __repr__(self):
+        return f"ComponentePendente({self.codigo!r}, {self.nome!r}, {self.ch!r})"
+
+    def texto(self):
+        """Como o componente aparece nos relatórios: "CÓDIGO NOME 60 h"."""
+        if self.ch is None:
+            return f"{self.codigo} {self.nome}".strip()
+        return f"{self.codigo} {self.nome} {self.ch} h".strip()
+
+class ResultadoHistorico:
+    """Componentes pendentes e carga horária pendente (linha "Pendente" da
+    tabela de carga horária) de um histórico, em horas.
+    No resultado de um trecho de páginas (ver extrair_dados_paginas),
+    pendentes é None se a leitura falhou e as horas são None se o trecho não
+    tem a linha "Pendente"."""
+
+    __slots__ = ('pendentes', 'optativos', 'complementares', 'total')
+
+    def __init__(self, pendentes=(), optativos=0, complementares=0, total=0):
+        self.pendentes = tuple(pendentes) if pendentes is not None else None
+        self.optativos = optativos
+        self.complementares = complementares
+        self.total = total
+
+    def __reduce__(self):
+        return (ResultadoHistorico, (self.pendentes, self.optativos, self.complementares, self.total))
+
+    def __eq__(self, outro):
+        return isinstance(outro, ResultadoHistorico) and self.__reduce__()[1] == outro.__reduce__()[1]
+
+    def __repr__(self):
+        return (f"ResultadoHistorico({len(self.pendentes or ())} pendentes, optativos={self.optativos}, "
+                f"complementares={self.complementares}, total={self.total})")
+
+    @property
+    def horas(self):
+        """(optativos, complementares, total), ou None num trecho sem a linha "Pendente"."""
+        if self.total is None:
+            return None
+        return self.optativos, self.complementares, self.total
+
+    def resumo_texto(self):
+        """Resumo do relatório: "3 componentes + 180h optativos + complementares 150h; 730 h"."""
+        partes = []
+        qtd = len(self.pendentes)
+        if qtd > 0:
+            partes.append(f"{qtd} {'componente' if qtd == 1 else 'componentes'}")
+        if self.optativos:
+            partes.append(f"{self.optativos}h optativos")
+        if self.complementares:
+            partes.append(f"complementares {self.complementares}h")
+        if partes:
+            return " + ".join(partes) + f"; {self.total} h"
+        if self.total:
+            return f"{self.total} h"
+        return "não contém"  # Caso não tenha pendências
+
+    def para_json(self):
+        pendentes = None if self.pendentes is None else [[p.codigo, p.nome, p.ch] for p in self.pendentes]
+        return {"pendentes": pendentes, "horas": self.horas}
+
+    @classmethod
+    def de_json(cls, dado):
+        """Inverso de para_json."""
+        pendentes = dado["pendentes"]
+        if pendentes is not None:
+            pendentes = [ComponentePendente(*p) for p in pendentes]
+        return cls(pendentes, *(dado["horas"] or (None, None, None)))
+
+_RE_DIGITOS = re.compile(r'\d+')
+
+def registro_para_json(registro):
+    """Registro de um PDF concluído (journal/acervo) em forma serializável."""
+    dado = {chave: valor for chave, valor in registro.items() if chave != "resultado"}
+    dado.update(registro["resultado"].para_json())
+    dado["versao"] = VERSAO_EXTRATOR
+    return dado
+
+def registro_atual(dado):
+    """True se o registro serializado foi extraído pela versão atual do extrator."""
+    return dado.get("versao") == VERSAO_EXTRATOR
+
+def registro_de_json(dado):
+    """Inverso de registro_para_json. Registros de outra versão do extrator
+    (inclusive os do formato antigo, sem versão) são recusados antes, por
+    registro_atual()."""
+    registro = {chave: valor for chave, valor in dado.items() if chave not in ("pendentes", "horas", "versao")}
+    registro["resultado"] = ResultadoHistorico.de_json(dado)
+    return registro
+
+# --- RASTREAMENTO (formato Chrome trace / Perfetto) ---
+# Opcional, por lote: cada thread que extrai um PDF com rastreamento ligado
+# acumula trechos ("spans") com início, duração, pid e thread; o pipeline
+# junta os trechos de todos os processos num JSON que abre em
+# chrome://tracing ou ui.perfetto.dev. Desligado, trecho() não registra nada.
+
+NOME_RASTRO = "rastro.json"
+_rastro_local = threading.local()
+
+def agora_us():
+    return time.time_ns() // 1000
+
+def evento_trace(nome, inicio_us, fim_us, args=None):
+    """Evento completo ("X") na thread atual."""
+    return {"name": nome, "ph": "X", "ts": inicio_us, "dur": max(0, fim_us - inicio_us),
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args or {}}
+
+def registrar_trecho(nome, inicio_us, **args):
+    """Fecha um trecho iniciado em `inicio_us`, se o rastreamento estiver ligado."""
+    eventos = getattr(_rastro_local, "eventos", None)
+    if eventos is not None:
+        eventos.append(evento_trace(nome, inicio_us, agora_us(), args))
+
+@contextmanager
+def trecho(nome, **args):
+    if getattr(_rastro_local, "eventos", None) is None:
+        yield
+        return
+    inicio = agora_us()
+    try:
+        yield
+    finally:
+        registrar_trecho(nome, inicio, **args)
+
+def perfilar_extracao(caminho_pdf, linhas=40, paginas=None):
+    """Extrai o PDF (ou só as `paginas` (inicio, fim)) de novo sob o cProfile
+    e retorna o relatório (texto) das funções mais caras por tempo acumulado."""
+    perfil = cProfile.Profile()
+    perfil.enable()
+    try:
+        if paginas:
+            extrair_dados_paginas(caminho_pdf, *paginas)
+        else:
+            extrair_dados_historico(caminho_pdf)
+    finally:
+        perfil.disable()
+    saida = io.StringIO()
+    pstats.Stats(perfil, stream=saida).sort_stats("cumulative").print_stats(linhas)
+    return saida.getvalue()
+
+def nome_arquivo_perfil(arquivo):
+    """Nome do arquivo com o perfil cProfile de um PDF do lote."""
+    return f"perfil_{os.path.splitext(arquivo)[0]}.txt"
+
+
+# --- CANCELAMENTO ---
+# Cancelamento cooperativo de um lote: quem pede chama cancelar() no token; o
+# pipeline descarta os PDFs que ainda não começaram e avisa quem está
+# extraindo. A extração confere o pedido entre uma página e outra (ver
+# verificar_cancelamento) e desiste com ExtracaoCancelada; nos workers do
+# pool o pedido chega pelo pipe do worker e, se ele não desistir em
+# PRAZO_CANCELAMENTO segundos, o processo é terminado e substituído.
+
+PRAZO_CANCELAMENTO = 2.0
+_cancelamento_local = threading.local()
+
+class ExtracaoCancelada(Exception):
+    """A extração foi interrompida por um pedido de cancelamento."""
+
+class TokenCancelamento:
+    """Pedido de cancelamento de um lote, compartilhado entre quem cancela
+    (por exemplo, o endpoint da API) e o PipelineExtracao. Com
+    `finalizar_parcial`, o lote ainda grava os relatórios com os PDFs que já
+    tinham sido extraídos."""
+
+    def __init__(self):
+        self.motivo = None
+        self.finalizar_parcial = False
+        self._evento = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelado(self):
+        return self._evento.is_set()
+
+    def cancelar(self, motivo="extração cancelada", finalizar_parcial=False):
+        with self._lock:
+            if self._evento.is_set():
+                return False
+            self.motivo = motivo
+            self.finalizar_parcial = finalizar_parcial
+            self._evento.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+        return True
+
+    def ao_cancelar(self, callback):
+        """Chama `callback()` no cancelamento (na hora, se já foi cancelado)."""
+        with self._lock:
+            if not self._evento.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def verificar(self):
+        if self._evento.is_set():
+            raise ExtracaoCancelada(self.motivo)
+
+def verificar_cancelamento():
+    """Ponto de parada da extração: levanta ExtracaoCancelada se a thread
+    atual tem um pedido de cancelamento pendente."""
+    verificar = getattr(_cancelamento_local, "verificar", None)
+    if verificar is not None:
+        verificar()
+
+
+# --- TEMPLATES DE LAYOUT ---
+# Os históricos do SIGAA têm layout fixo: a mesma geometria de colunas aparece
+# em todos os documentos. Cada tabela encontrada é identificada por uma
+# impressão digital (tamanho da página + posições x das colunas) e o cache
+# guarda o que aquela geometria já se mostrou ser: tabela de pendentes, de
+# carga horária ou outra (ex.: componentes cursados). Tabelas "outra" com
+# geometria conhecida não passam pela extração de células, que percorre todos
+# os caracteres da página uma vez por linha da tabela. Geometrias novas ou que
+# já apareceram com classificações diferentes são sempre extraídas.
+# O cache e os contadores são do processo e podem ser usados por várias
+# threads ao mesmo tempo (TEMPLATES_LOCK); os acertos e falhas de cada
+# extração são contados à parte, na thread que a executa.
+
+MAX_TEMPLATES_LAYOUT = 512
+TEMPLATES_LAYOUT = {}  # impressão digital -> frozenset de tipos, ou None (ambígua)
+ESTATISTICAS_TEMPLATES = {"acertos": 0, "falhas": 0}
+TEMPLATES_LOCK = threading.Lock()
+_templates_local = threading.local()
+
+def contar_template(chave):
+    """Conta um acerto ou falha do cache no processo e na extração em curso."""
+    with TEMPLATES_LOCK:
+        ESTATISTICAS_TEMPLATES[chave] += 1
+    contagem = getattr(_templates_local, "contagem", None)
+    if contagem is not None:
+        contagem[chave] += 1
+
+def impressao_digital_tabela(page, tabela):
+    """Tamanho da página e posições x (arredondadas) das colunas da tabela."""
+    colunas = sorted({round(c[0]) for c in tabela.cells} | {round(c[2]) for c in tabela.cells})
+    return (round(page.width), round(page.height), tuple(colunas))
+
+def classificar_tabela(table):
+    """Tipos de tabela reconhecidos pelo cabeçalho (mesmas regras da extração)."""
+    tipos = set()
+    if not table or not table[0]:
+        return frozenset(tipos)
+    header_texto_up = " ".join(limpar_texto(c) for c in table[0] if c).upper()
+    if ("CARGA" in header_texto_up and "HORÁRIA" in header_texto_up) or "OBRIGATÓRIAS" in header_texto_up:
+        tipos.add("carga")
+    header = [limpar_texto(cell).upper() for cell in table[0] if cell]
+    if "CÓDIGO" in header and "COMPONENTE CURRICULAR" in header:
+        tipos.add("pendentes")
+    return frozenset(tipos)
+
+def cabecalho_pode_ser_relevante(page, tabela):
+    """Confere, só com o texto da primeira linha, se a tabela pode ser de
+    pendentes ou de carga horária. É conservadora: na dúvida responde True."""
+    if not tabela.rows:
+        return True
+    texto = (page.crop(tabela.rows[0].bbox).extract_text() or "").upper()
+    if ("CARGA" in texto and "HORÁRIA" in texto) or "OBRIGATÓRIAS" in texto:
+        return True
+    return "CÓDIGO" in texto and "COMPONENTE" in texto
+
+def extrair_tabelas_relevantes(page):
+    """Equivalente a page.extract_tables(), mas sem extrair as células das
+    tabelas cuja geometria o cache de templates já sabe que não interessa."""
+    tabelas = []
+    for tabela in page.find_tables():
+        digital = impressao_digital_tabela(page, tabela)
+        with TEMPLATES_LOCK:
+            conhecida = digital in TEMPLATES_LAYOUT
+            tipos = TEMPLATES_LAYOUT.get(digital)
+        if tipos is not None and not tipos and not cabecalho_pode_ser_relevante(page, tabela):
+            contar_template("acertos")
+            continue
+        table = tabela.extract()
+        tabelas.append(table)
+        classificacao = classificar_tabela(table)
+        with TEMPLATES_LOCK:
+            if digital not in TEMPLATES_LAYOUT:
+                if len(TEMPLATES_LAYOUT) < MAX_TEMPLATES_LAYOUT:
+                    TEMPLATES_LAYOUT[digital] = classificacao
+            elif TEMPLATES_LAYOUT[digital] is not None and TEMPLATES_LAYOUT[digital] != classificacao:
+                # Mesma geometria com conteúdos diferentes: deixa de confiar nela.
+                TEMPLATES_LAYOUT[digital] = None
+        if not conhecida:
+            contar_template("falhas")
+        elif tipos is None or tipos == classificacao:
+            contar_template("acertos")
+    return tabelas
+
+def estatisticas_templates():
+    """Cópia dos contadores do cache de templates deste processo."""
+    with TEMPLATES_LOCK:
+        return dict(ESTATISTICAS_TEMPLATES, templates=len(TEMPLATES_LAYOUT))
+
 def extrair_dados_historico(caminho_pdf):
-    """Extrai disciplinas pendentes e resumo de carga horária de um histórico PDF."""
-    dados_pendentes = []  # lista de dicts: {codigo, nome, ch}
-    resumo_horas = {"optativos": "0", "complementares": "0", "total": "0"}
+    """Extrai disciplinas pendentes e resumo de carga horária de um histórico
+    PDF. Retorna um ResultadoHistorico."""
+    return mesclar_trechos([extrair_dados_paginas(caminho_pdf)])
+
+# Célula de carga horária na tabela de pendentes ("60", "60 h", "60h")
+_RE_CH_CELULA = re.compile(r'^\d+[ ]*h?$', flags=re.IGNORECASE)
+_RE_NAO_DIGITO = re.compile(r'[^0-9]')
+_RE_LINHA_PENDENTE = re.compile(r'^(?P<codigo>[A-Z0-9]{6,})\s+(?P<resto>.+)$')
+_RE_CH_FINAL = re.compile(r'(\d+)\s*h$')
+
+def extrair_dados_paginas(caminho_pdf, inicio=0, fim=None):
+    """Extração das páginas [inicio, fim) de um histórico (índices a partir
+    de 0; fim=None vai até a última). Retorna um ResultadoHistorico parcial:
+    pendentes é None se a leitura falhou e as horas são None se o trecho não
+    tem a linha "PENDENTE" de carga horária. Os trechos de um mesmo PDF são
+    juntados por mesclar_trechos, na ordem das páginas."""
+    dados_pendentes = []  # lista de ComponentePendente
+    horas = None  # (optativos, complementares, total) da última linha "PENDENTE"
 
     try:
-        with pdfplumber.open(caminho_pdf) as pdf:
-            for page in pdf.pages:
+        with trecho("abrir"):
+            pdf = abrir_pdf(caminho_pdf)
+        with pdf:
+            for numero_pagina, page in enumerate(pdf.pages[inicio:fim], inicio + 1):
+                verificar_cancelamento()
                 page_tem_pendentes = False  # Flag para saber se encontrou pendentes nesta página
-                tables = page.extract_tables() or []
+                with trecho("extract_tables", pagina=numero_pagina):
+                    tables = extrair_tabelas_relevantes(page)
                 
                 for table in tables:
                     if not table or not table[0]:
                         continue
+                    cabecalho = [limpar_texto(c) for c in table[0] if c]
 
                     # --- Detecta tabela de carga horária integralizada/pendente ---
-                    header_texto = " ".join(limpar_texto(c) for c in table[0] if c)
-                    header_texto_up = header_texto.upper()
+                    header_texto_up = " ".join(cabecalho).upper()
                     if ("CARGA" in header_texto_up and "HORÁRIA" in header_texto_up) or "OBRIGATÓRIAS" in header_texto_up:
                         for row in table:
                             if not row:
@@ -40,17 +431,13 @@ def extrair_dados_historico(caminho_pdf):
                             primeira = limpar_texto(row[0]).upper() if row[0] else ""
                             if "PENDENTE" in primeira:
                                 row_clean = [limpar_texto(c) for c in row if c is not None]
-                                if len(row_clean) >= 4: # Ajustado para maior robustez
-                                    resumo_horas["total"] = re.sub(r'[^0-9]', '', row_clean[-1]) or "0"
-                                    resumo_horas["complementares"] = re.sub(r'[^0-9]', '', row_clean[-2]) or "0"
-                                    resumo_horas["optativos"] = re.sub(r'[^0-9]', '', row_clean[-3]) or "0"
-                                elif len(row_clean) == 3: # Caso não tenha a coluna "Obrigatórias"
-                                    resumo_horas["total"] = re.sub(r'[^0-9]', '', row_clean[-1]) or "0"
-                                    resumo_horas["complementares"] = re.sub(r'[^0-9]', '', row_clean[-2]) or "0"
-                                    resumo_horas["optativos"] = re.sub(r'[^0-9]', '', row_clean[-3]) or "0"
+                                # Com ou sem a coluna "Obrigatórias": as três últimas são
+                                # optativos, complementares e total
+                                if len(row_clean) >= 3:
+                                    horas = tuple(int(_RE_NAO_DIGITO.sub('', c) or 0) for c in row_clean[-3:])
 
                     # --- Detecta tabela de componentes curriculares obrigatórios pendentes ---
-                    header = [limpar_texto(cell).upper() for cell in table[0] if cell]
+                    header = [c.upper() for c in cabecalho]
                     header_found = ("CÓDIGO" in header and "COMPONENTE CURRICULAR" in header)
                     if not header_found:
                         continue
@@ -59,29 +446,30 @@ def extrair_dados_historico(caminho_pdf):
                     for row in table[1:]:
                         if not row or len(row) < 2:
                             continue
-                        codigo = limpar_texto(row[0])
-                        nome_disciplina = limpar_texto(row[1])
+                        # Cada célula é limpa uma única vez
+                        celulas = [limpar_texto(cell) for cell in row]
+                        codigo = celulas[0]
+                        nome_disciplina = celulas[1]
                         if not codigo or not nome_disciplina:
                             continue
                         if "ENADE" in codigo.upper() or "ENADE" in nome_disciplina.upper():
                             continue
 
-                        ch = ""
-                        for cell in row[2:]:
-                            cell_text = limpar_texto(cell)
-                            if re.match(r'^\d+[ ]*h?$', cell_text, flags=re.IGNORECASE):
-                                numero = re.findall(r'\d+', cell_text)[0]
-                                ch = f"{numero} h"
+                        ch = None
+                        for cell_text in celulas[2:]:
+                            if _RE_CH_CELULA.match(cell_text):
+                                ch = int(_RE_DIGITOS.search(cell_text).group())
                                 break
 
-                        esta_matriculado = any("MATRICULADO" in limpar_texto(cell).upper() for cell in row if cell)
+                        esta_matriculado = any("MATRICULADO" in cell_text.upper() for cell_text in celulas)
                         if esta_matriculado and "(Matriculado)" not in nome_disciplina:
                             nome_disciplina += " (Matriculado)"
 
-                        dados_pendentes.append({"codigo": codigo, "nome": nome_disciplina, "ch": ch})
+                        dados_pendentes.append(ComponentePendente(codigo, nome_disciplina, ch))
                 
                 # --- Fallback textual (Lógica original) ---
                 if not page_tem_pendentes:
+                    inicio_fallback = agora_us()
                     texto = page.extract_text() or ""
                     linhas = [limpar_texto(l) for l in texto.split('\n') if l.strip()]
                     capturando = False
@@ -96,15 +484,15 @@ def extrair_dados_historico(caminho_pdf):
                         if not capturando:
                             continue
                         
-                        m = re.match(r'^(?P<codigo>[A-Z0-9]{6,})\s+(?P<resto>.+)$', linha)
+                        m = _RE_LINHA_PENDENTE.match(linha)
                         if not m:
                             continue
                         codigo = m.group('codigo')
                         resto = m.group('resto')
-                        m_ch = re.search(r'(\d+)\s*h$', resto)
-                        ch = ''
+                        m_ch = _RE_CH_FINAL.search(resto)
+                        ch = None
                         if m_ch:
-                            ch = f"{m_ch.group(1)} h"
+                            ch = int(m_ch.group(1))
                             nome = resto[:resto.rfind(m_ch.group(1))].strip()
                         else:
                             nome = resto
@@ -115,37 +503,30 @@ def extrair_dados_historico(caminho_pdf):
                         if esta_matriculado and '(MATRICULADO)' not in nome.upper():
                             nome += ' (Matriculado)'
                             
-                        dados_pendentes.append({"codigo": codigo, "nome": nome, "ch": ch})
+                        dados_pendentes.append(ComponentePendente(codigo, nome, ch))
+                    registrar_trecho("fallback textual", inicio_fallback, pagina=numero_pagina)
+    except ExtracaoCancelada:
+        raise
     except Exception as e:
-        print(f"Erro ao ler o PDF {caminho_pdf}: {e}")
-        return [], resumo_horas
-
-    return dados_pendentes, resumo_horas
-
-def gerar_resumo_string(dados_pendentes, resumo_horas):
-    qtd = len(dados_pendentes)
-    partes = []
-    if qtd > 0:
-        palavra_comp = "componente" if qtd == 1 else "componentes"
-        partes.append(f"{qtd} {palavra_comp}")
-
-    opt = resumo_horas.get('optativos', '0')
-    compl = resumo_horas.get('complementares', '0')
-    total = resumo_horas.get('total', '0')
-
-    if opt and opt != '0':
-        partes.append(f"{opt}h optativos")
-    if compl and compl != '0':
-        partes.append(f"complementares {compl}h")
-
-    total_str = f"{total} h" if total else "0 h"
-    prefixo = " + ".join(partes)
-    if prefixo:
-        return prefixo + f"; {total_str}"
-    elif total and total != '0':
-         return f"{total_str}"
-    else:
-        return "não contém" # Caso não tenha pendências
+        print(f"Erro ao ler o PDF {descrever_pdf(caminho_pdf)}: {e}")
+        dados_pendentes = None
+
+    return ResultadoHistorico(dados_pendentes, *(horas or (None, None, None)))
+
+def mesclar_trechos(trechos):
+    """Junta os ResultadoHistorico dos trechos de um PDF, na ordem das
+    páginas, com o mesmo resultado da leitura sequencial: os pendentes são
+    concatenados e vale a última linha "PENDENTE" de carga horária vista. Se
+    um trecho falhou, o PDF fica sem pendentes e com as horas vistas até ali."""
+    dados_pendentes = []
+    horas = (0, 0, 0)
+    for parte in trechos:
+        if parte.horas is not None:
+            horas = parte.horas
+        if parte.pendentes is None:
+            return ResultadoHistorico((), *horas)
+        dados_pendentes.extend(parte.pendentes)
+    return ResultadoHistorico(dados_pendentes, *horas)
 
 def extrair_matricula_do_nome_arquivo(nome_arquivo):
     match = re.search(r'historico[_-]?(\d+)', nome_arquivo, re.IGNORECASE)
@@ -153,7 +534,7 @@ def extrair_matricula_do_nome_arquivo(nome_arquivo):
 
 def extrair_nome_aluno(caminho_pdf):
     try:
-        with pdfplumber.open(caminho_pdf) as pdf:
+        with abrir_pdf(caminho_pdf) as pdf:
             if not pdf.pages:
                 return ""
             texto = pdf.pages[0].extract_text() or ""
@@ -161,10 +542,130 @@ def extrair_nome_aluno(caminho_pdf):
             if match:
                 return match.group(1).strip()
     except Exception as e:
-        print(f"   Aviso: não foi possível extrair nome de {caminho_pdf}: {e}")
+        print(f"   Aviso: não foi possível extrair nome de {descrever_pdf(caminho_pdf)}: {e}")
     return ""
 
-def carregar_percentuais(arquivo_xls):
+# Fração superior da página 1 onde ficam os dados do aluno (Nome, Matrícula, Curso)
+FRACAO_CABECALHO = 0.3
+
+def interpretar_cabecalho(texto):
+    """Extrai nome, matrícula e curso do texto da faixa de cabeçalho."""
+    metadados = {"nome": "", "matricula": "", "curso": ""}
+    linhas = [limpar_texto(l) for l in texto.splitlines() if l.strip()]
+    for linha in linhas:
+        if not metadados["nome"]:
+            m = re.search(r'Nome:\s*([A-ZÀ-Ú\s]+?)(?:\s+Matrícula:|\s*$)', linha)
+            if m:
+                metadados["nome"] = m.group(1).strip()
+        if not metadados["matricula"]:
+            m = re.search(r'Matr[íi]cula:\s*(\d+)', linha, re.IGNORECASE)
+            if m:
+                metadados["matricula"] = m.group(1)
+        if not metadados["curso"]:
+            m = re.search(r'Curso:\s*(.+?)(?:\s+\S+:|$)', linha)
+            if m:
+                metadados["curso"] = m.group(1).strip()
+    return metadados
+
+# O pdfium não é thread-safe: requisições simultâneas (ex.: gunicorn com
+# threads) derrubam o processo se usarem a biblioteca ao mesmo tempo.
+PDFIUM_LOCK = threading.Lock()
+
+def ler_faixa_cabecalho(doc):
+    """Texto da faixa de cabeçalho da página 1 de um documento pdfium e a
+    quantidade de caracteres da página (0 = sem camada de texto)."""
+    page = doc[0]
+    try:
+        largura, altura = page.get_size()
+        textpage = page.get_textpage()
+        try:
+            # coordenadas do PDF: origem no canto inferior esquerdo
+            texto = textpage.get_text_bounded(0, altura * (1 - FRACAO_CABECALHO), largura, altura)
+            return texto, textpage.count_chars()
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+
+def extrair_metadados_cabecalho(caminho_pdf):
+    """Lê apenas a faixa de cabeçalho da página 1 e retorna nome, matrícula e
+    curso. Usa o pdfium, que extrai o texto de uma região recortada sem montar
+    o layout da página inteira (alguns ms por arquivo, contra ~100 ms do
+    pdfplumber). Campos não encontrados voltam como string vazia."""
+    try:
+        with PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(caminho_pdf)
+            try:
+                if len(doc) == 0:
+                    return interpretar_cabecalho("")
+                texto, _ = ler_faixa_cabecalho(doc)
+            finally:
+                doc.close()
+    except Exception as e:
+        print(f"   Aviso: não foi possível ler o cabeçalho de {descrever_pdf(caminho_pdf)}: {e}")
+        return interpretar_cabecalho("")
+    return interpretar_cabecalho(texto)
+
+
+# --- TRIAGEM PRÉVIA ---
+# Rejeita, antes da extração completa, arquivos que não são históricos legíveis:
+# uploads truncados, imagens escaneadas, outros documentos do SIGAA etc.
+
+MAX_PAGINAS_HISTORICO = 200
+# Palavras que identificam o cabeçalho de um histórico
+ASSINATURAS_HISTORICO = ('HISTÓRICO', 'HISTORICO')
+
+def triar_pdf(caminho_pdf, max_paginas=MAX_PAGINAS_HISTORICO):
+    """Faz as verificações baratas de um PDF antes da extração.
+    Retorna (motivo_rejeicao, metadados); motivo_rejeicao é None se o arquivo
+    passou na triagem e metadados traz nome/matrícula/curso do cabeçalho e a
+    quantidade de páginas."""
+    metadados = interpretar_cabecalho("")
+    if isinstance(caminho_pdf, (bytes, bytearray, memoryview)):
+        inicio, fim = bytes(caminho_pdf[:1024]), bytes(caminho_pdf[-2048:])
+    else:
+        try:
+            tamanho = os.path.getsize(caminho_pdf)
+            with open(caminho_pdf, 'rb') as f:
+                inicio = f.read(1024)
+                f.seek(max(0, tamanho - 2048))
+                fim = f.read()
+        except OSError as e:
+            return f"não foi possível ler o arquivo ({e})", metadados
+
+    if b'%PDF-' not in inicio:
+        return "não é um PDF (cabeçalho %PDF ausente)", metadados
+    if b'%%EOF' not in fim or b'startxref' not in fim:
+        return "PDF truncado ou corrompido (trailer/xref ausente)", metadados
+
+    with PDFIUM_LOCK:
+        try:
+            doc = pdfium.PdfDocument(caminho_pdf)
+        except Exception as e:
+            return f"PDF corrompido ({e})", metadados
+        try:
+            paginas = len(doc)
+            if paginas == 0:
+                return "PDF sem páginas", metadados
+            if paginas > max_paginas:
+                return f"PDF com {paginas} páginas (limite: {max_paginas})", metadados
+            texto, qtd_caracteres = ler_faixa_cabecalho(doc)
+        except Exception as e:
+            return f"PDF corrompido ({e})", metadados
+        finally:
+            doc.close()
+
+    if qtd_caracteres == 0:
+        return "PDF sem camada de texto (documento escaneado?)", metadados
+    if not any(a in texto.upper() for a in ASSINATURAS_HISTORICO):
+        return "cabeçalho não corresponde a um histórico escolar", metadados
+    metadados = interpretar_cabecalho(texto)
+    metadados["paginas"] = paginas
+    return None, metadados
+
+def carregar_percentuais(arquivo_xls, conteudo=None):
+    """`conteudo` opcional: bytes da planilha já em memória (modo sem disco);
+    nesse caso `arquivo_xls` serve apenas para identificar o formato."""
     percentuais = {}
     try:
         # Se nenhum arquivo fornecido, retorna dicionário vazio
@@ -172,7 +673,7 @@ def carregar_percentuais(arquivo_xls):
             return percentuais
 
         # Suporta .xls (xlrd) e .xlsx (openpyxl). Detecta pela extensão do arquivo.
-        if not os.path.exists(arquivo_xls):
+        if conteudo is None and not os.path.exists(arquivo_xls):
             print(f"   Aviso: arquivo de percentuais não encontrado: {arquivo_xls}")
             return percentuais
 
@@ -180,7 +681,10 @@ def carregar_percentuais(arquivo_xls):
         ext = ext.lower()
 
         if ext == '.xls':
-            wb = xlrd.open_workbook(arquivo_xls)
+            if conteudo is not None:
+                wb = xlrd.open_workbook(file_contents=conteudo)
+            else:
+                wb = xlrd.open_workbook(arquivo_xls)
             ws = wb.sheet_by_index(0)
             for row_idx in range(9, ws.nrows):
                 row = ws.row_values(row_idx)
@@ -197,7 +701,7 @@ def carregar_percentuais(arquivo_xls):
 
         elif ext in ('.xlsx', '.xlsm', '.xltx', '.xltm'):
             # Usa openpyxl para arquivos xlsx
-            wb = load_workbook(arquivo_xls, read_only=True, data_only=True)
+            wb = load_workbook(io.BytesIO(conteudo) if conteudo is not None else arquivo_xls, read_only=True, data_only=True)
             ws = wb[wb.sheetnames[0]]
             # openpyxl rows are 1-indexed; dados começam na linha 10 (índice humano)
             for row_idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
@@ -224,41 +728,498 @@ def carregar_percentuais(arquivo_xls):
     return percentuais
 
 
-# --- FUNÇÃO PRINCIPAL ADAPTADA ---
-# Esta é a função que o app.py irá chamar.
+# --- JOURNAL DE EXECUÇÃO (retomada após falha) ---
+# Cada execução grava, em modo append, uma linha JSON por PDF concluído. Se o
+# processo morrer no meio do lote, a próxima execução lê os journals que
+# ficaram na pasta, pula os PDFs já processados (pelo hash do conteúdo) e só
+# regenera os relatórios.
 
-def run_extraction_process_web_mode(pdf_upload_folder, excel_percentual_path, output_report_folder, progress_callback=None):
-    """
-    Executa o processo de extração principal.
-    Recebe os caminhos das pastas (do servidor) e gera os relatórios.
-    Retorna um dicionário com os nomes dos arquivos gerados.
-    progress_callback: função opcional que recebe (current, total) para reportar progresso
-    """
-    
-    # 1. Carrega percentuais (se informado)
-    if excel_percentual_path:
-        print(f"Carregando percentuais de '{excel_percentual_path}'...")
-        percentuais_dict = carregar_percentuais(excel_percentual_path)
-        print(f"   → {len(percentuais_dict)} percentuais carregados.\n")
-    else:
-        print("Nenhum arquivo de percentuais fornecido — extração seguirá sem percentuais.")
-        percentuais_dict = {}
-    
-    # 2. Lista os PDFs (da pasta de upload)
-    pdfs_encontrados = sorted([f for f in os.listdir(pdf_upload_folder) if f.lower().endswith(".pdf")])
-    print(f"Encontrados {len(pdfs_encontrados)} arquivos PDF na pasta de upload. Iniciando extração...")
+def calcular_hash_arquivo(caminho, tamanho_bloco=1024 * 1024):
+    """Retorna o SHA-256 (hex) do conteúdo do arquivo (caminho ou bytes)."""
+    if isinstance(caminho, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(caminho).hexdigest()
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(tamanho_bloco), b''):
+            h.update(bloco)
+    return h.hexdigest()
 
-    # 3. Define os nomes dos arquivos de saída
-    excel_output_name = "relatorio_componentes.xlsx"
-    csv_compact_name = "relatorio_final.csv"
-    txt_output_name = "relatorio_historicos.txt"
-    
-    # Define os caminhos completos de saída
-    excel_output_path = os.path.join(output_report_folder, excel_output_name)
-    csv_compact_path = os.path.join(output_report_folder, csv_compact_name)
-    txt_output_path = os.path.join(output_report_folder, txt_output_name)
+def carregar_journal(caminho_journal):
+    """Lê o journal e retorna {hash: registro} dos PDFs já concluídos.
+    Uma última linha truncada (queda durante a escrita) é ignorada."""
+    concluidos = {}
+    if not caminho_journal or not os.path.exists(caminho_journal):
+        return concluidos
+    with open(caminho_journal, 'r', encoding='utf-8') as f:
+        for linha in f:
+            linha = linha.strip()
+            if not linha:
+                continue
+            try:
+                registro = json.loads(linha)
+            except ValueError:
+                continue
+            # registros de outra versão do extrator são extraídos de novo
+            if registro.get('hash') and registro_atual(registro):
+                concluidos[registro['hash']] = registro_de_json(registro)
+    return concluidos
+
+# Um journal em gravação fica travado (flock exclusivo) pelo processo que o
+# escreve, enquanto o lote durar: outros processos (outro worker do gunicorn,
+# uma execução pela linha de comando na mesma pasta base) o enxergam como em
+# andamento e não o reaproveitam nem apagam. Journal destravado é de uma
+# execução interrompida (queda, cancelamento ou erro) e nunca volta a ser
+# gravado. Sem fcntl (Windows), vale só o registro deste processo.
+JOURNAIS_ATIVOS = set()
+JOURNAIS_LOCK = threading.Lock()
+
+def abrir_journal(caminho):
+    """Cria o journal de um lote já travado: o arquivo só aparece com o nome
+    final (.jsonl) depois de travado, então nunca é visto destravado."""
+    with JOURNAIS_LOCK:
+        JOURNAIS_ATIVOS.add(caminho)
+    temporario = caminho + '.tmp'
+    arquivo = open(temporario, 'a', encoding='utf-8')
+    if fcntl is not None:
+        fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX)
+    os.replace(temporario, caminho)
+    return arquivo
+
+def fechar_journal(caminho, arquivo):
+    """Fecha (e destrava) o journal de um lote que terminou."""
+    if arquivo is not None:
+        arquivo.close()
+    with JOURNAIS_LOCK:
+        JOURNAIS_ATIVOS.discard(caminho)
+
+def journal_em_uso(caminho):
+    """True se algum lote (deste ou de outro processo) ainda grava o journal."""
+    with JOURNAIS_LOCK:
+        if caminho in JOURNAIS_ATIVOS:
+            return True
+    if fcntl is None:
+        return False
+    try:
+        with open(caminho, 'rb') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+    except OSError:
+        return True  # sumiu ou ilegível: não é reaproveitável agora
+    return False
+
+class IndiceJournais:
+    """Registros dos journals de execuções interrompidas de uma pasta. Como
+    um journal destravado não muda mais, cada um é lido uma vez só; as
+    consultas seguintes só listam a pasta para ver o que entrou ou saiu."""
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self._journais = {}  # caminho -> {hash: registro}
+        self._lock = threading.Lock()
+
+    def atualizar(self):
+        """{hash: (registro, caminho_journal)} dos journals interrompidos."""
+        try:
+            nomes = sorted(n for n in os.listdir(self.pasta) if n.endswith('.jsonl'))
+        except OSError:
+            nomes = []
+        caminhos = [os.path.join(self.pasta, nome) for nome in nomes]
+        with self._lock:
+            for caminho in set(self._journais) - set(caminhos):
+                del self._journais[caminho]
+            for caminho in caminhos:
+                if caminho not in self._journais and not journal_em_uso(caminho):
+                    try:
+                        self._journais[caminho] = carregar_journal(caminho)
+                    except OSError:
+                        continue
+            concluidos = {}
+            for caminho in caminhos:
+                for h, registro in self._journais.get(caminho, {}).items():
+                    concluidos[h] = (registro, caminho)
+        return concluidos
+
+INDICES_JOURNAIS = {}
+
+def carregar_journais(pasta):
+    """Indexa todos os journals de execuções interrompidas na pasta.
+    Retorna {hash: (registro, caminho_journal)}."""
+    if not pasta or not os.path.isdir(pasta):
+        return {}
+    with JOURNAIS_LOCK:
+        indice = INDICES_JOURNAIS.setdefault(os.path.abspath(pasta), IndiceJournais(pasta))
+    return indice.atualizar()
+
+def limpar_journais(pasta, retencao, cota=None):
+    """Apaga os journals interrompidos sem modificação há mais de `retencao`
+    segundos (os resultados deles também ficam no acervo, se ligado) e, se os
+    que sobraram passarem de `cota` bytes, os mais antigos primeiro. Journals
+    de lotes em andamento nunca são apagados."""
+    agora = time.time()
+    apagados = 0
+    try:
+        nomes = os.listdir(pasta)
+    except OSError:
+        return 0
+    interrompidos = []  # (mtime, tamanho, caminho)
+    for nome in nomes:
+        caminho = os.path.join(pasta, nome)
+        try:
+            mtime = os.path.getmtime(caminho)
+            # .tmp: lote que caiu entre criar e publicar o journal
+            if nome.endswith('.jsonl.tmp') and agora - mtime >= retencao:
+                os.remove(caminho)
+                apagados += 1
+            elif nome.endswith('.jsonl') and not journal_em_uso(caminho):
+                if agora - mtime >= retencao:
+                    os.remove(caminho)
+                    apagados += 1
+                else:
+                    interrompidos.append((mtime, os.path.getsize(caminho), caminho))
+        except OSError:
+            pass
+    if cota is not None:
+        total = sum(tamanho for _, tamanho, _ in interrompidos)
+        for _, tamanho, caminho in sorted(interrompidos):
+            if total <= cota:
+                break
+            try:
+                os.remove(caminho)
+                apagados += 1
+            except OSError:
+                pass
+            total -= tamanho
+    if apagados:
+        print(f"Journals: {apagados} journal(s) de execuções interrompidas expirado(s).")
+    return apagados
+
+def registrar_no_journal(arquivo_journal, registro):
+    """Acrescenta um registro ao journal e força a gravação em disco."""
+    arquivo_journal.write(json.dumps(registro_para_json(registro), ensure_ascii=False) + "\n")
+    arquivo_journal.flush()
+    os.fsync(arquivo_journal.fileno())
+
+
+# --- ACERVO DE RESULTADOS (por hash do conteúdo) ---
+# O journal só vive até o lote terminar. O acervo guarda o resultado de cada
+# PDF extraído (um JSON por hash SHA-256) entre um lote e outro: na rodada
+# seguinte os PDFs idênticos não são extraídos de novo e o navegador nem
+# precisa enviá-los (ver PipelineExtracao.adicionar_conhecido).
+
+PASTA_ACERVO = "resultados"
+
+class AcervoResultados:
+    """Resultados já extraídos, em `pasta`/v<VERSAO_EXTRATOR>/<2 primeiros
+    dígitos>/<hash>.json: resultados de outra versão do extrator não são
+    encontrados e expiram sem uso. Entradas não usadas (nem consultadas) há
+    mais de `retencao` segundos são apagadas por limpar()."""
+
+    INTERVALO_LIMPEZA = 3600
+
+    def __init__(self, pasta, retencao=30 * 24 * 3600):
+        self.pasta = pasta
+        self.retencao = retencao
+        self._ultima_limpeza = 0.0
+        os.makedirs(pasta, exist_ok=True)
+
+    def _caminho(self, h):
+        if not re.fullmatch(r'[0-9a-f]{64}', h or ''):
+            return None
+        return os.path.join(self.pasta, f"v{VERSAO_EXTRATOR}", h[:2], h + '.json')
+
+    def obter(self, h):
+        """Registro do PDF com este hash, ou None. A consulta renova a entrada."""
+        caminho = self._caminho(h)
+        if caminho is None:
+            return None
+        try:
+            with open(caminho, 'r', encoding='utf-8') as f:
+                dado = json.load(f)
+            if not registro_atual(dado):
+                return None
+            registro = registro_de_json(dado)
+            os.utime(caminho)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return registro
+
+    def conhecidos(self, hashes):
+        """Subconjunto de `hashes` que o acervo tem (renovando as entradas)."""
+        conhecidos = set()
+        for h in hashes:
+            caminho = self._caminho(h)
+            if caminho is None:
+                continue
+            try:
+                os.utime(caminho)
+            except OSError:
+                continue
+            conhecidos.add(h)
+        return conhecidos
+
+    def guardar(self, registro):
+        caminho = self._caminho(registro.get("hash"))
+        if caminho is None:
+            return
+        registro = {chave: valor for chave, valor in registro_para_json(registro).items() if chave != "arquivo"}
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        temporario = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temporario, 'w', encoding='utf-8') as f:
+                json.dump(registro, f, ensure_ascii=False)
+            os.replace(temporario, caminho)
+        except OSError as e:
+            print(f"   Aviso: não foi possível guardar {registro['hash']} no acervo: {e}")
+            if os.path.exists(temporario):
+                os.remove(temporario)
+
+    def limpar(self):
+        """Apaga as entradas vencidas (no máximo uma passada por INTERVALO_LIMPEZA)."""
+        agora = time.time()
+        if agora - self._ultima_limpeza < self.INTERVALO_LIMPEZA:
+            return 0
+        self._ultima_limpeza = agora
+        apagados = 0
+        for raiz, _, nomes in os.walk(self.pasta):
+            for nome in nomes:
+                caminho = os.path.join(raiz, nome)
+                try:
+                    if agora - os.path.getmtime(caminho) >= self.retencao:
+                        os.remove(caminho)
+                        apagados += 1
+                except OSError:
+                    pass
+        if apagados:
+            print(f"Acervo de resultados: {apagados} resultado(s) sem uso apagado(s).")
+        return apagados
 
-    # 4. Cria o Workbook Excel
+def hashes_conhecidos(hashes, acervo=None, journal_folder=None):
+    """Quais dos hashes o servidor já tem extraídos: no acervo ou nos
+    journals de execuções interrompidas."""
+    hashes = set(hashes)
+    conhecidos = acervo.conhecidos(hashes) if acervo else set()
+    if journal_folder and hashes - conhecidos:
+        conhecidos |= hashes & set(carregar_journais(journal_folder))
+    return conhecidos
+
+
+# --- AGENDAMENTO POR CUSTO ---
+# Com a extração em paralelo, a ordem alfabética deixa o pool esperando por um
+# histórico longo no fim do lote. Os PDFs são despachados do mais caro para o
+# mais barato (LPT), com o custo estimado a partir de páginas e tamanho.
+
+class EstimadorCusto:
+    """Modelo linear custo = seg_por_pagina * paginas + seg_por_mb * mb,
+    ajustado por mínimos quadrados (com regularização em direção aos valores
+    iniciais) a partir dos tempos de extração medidos."""
+
+    SEG_POR_PAGINA_INICIAL = 0.15
+    SEG_POR_MB_INICIAL = 0.05
+    PESO_INICIAL = 1.0
+
+    def __init__(self):
+        # Somas para as equações normais: pp, pm, mm, py, my
+        self.somas = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.amostras = 0
+        self._ajustar()
+
+    def _ajustar(self):
+        pp, pm, mm, py, my = self.somas
+        peso = self.PESO_INICIAL
+        a11, a12, a22 = pp + peso, pm, mm + peso
+        b1 = py + peso * self.SEG_POR_PAGINA_INICIAL
+        b2 = my + peso * self.SEG_POR_MB_INICIAL
+        det = a11 * a22 - a12 * a12
+        self.seg_por_pagina = max((b1 * a22 - a12 * b2) / det, 1e-4)
+        self.seg_por_mb = max((a11 * b2 - a12 * b1) / det, 0.0)
+
+    def estimar(self, paginas, tamanho_bytes):
+        return self.seg_por_pagina * (paginas or 1) + self.seg_por_mb * tamanho_bytes / (1024 * 1024)
+
+    def registrar(self, paginas, tamanho_bytes, segundos):
+        p = float(paginas or 1)
+        m = tamanho_bytes / (1024 * 1024)
+        for i, valor in enumerate((p * p, p * m, m * m, p * segundos, m * segundos)):
+            self.somas[i] += valor
+        self.amostras += 1
+        self._ajustar()
+
+    @classmethod
+    def carregar(cls, caminho):
+        estimador = cls()
+        if caminho and os.path.exists(caminho):
+            try:
+                with open(caminho, 'r', encoding='utf-8') as f:
+                    dados = json.load(f)
+                estimador.somas = [float(v) for v in dados['somas']]
+                estimador.amostras = int(dados.get('amostras', 0))
+                estimador._ajustar()
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"   Aviso: modelo de custo inválido em {caminho}, usando valores iniciais: {e}")
+        return estimador
+
+    def salvar(self, caminho):
+        # .tmp próprio de cada thread: lotes simultâneos podem salvar ao mesmo tempo
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump({'somas': self.somas, 'amostras': self.amostras,
+                       'seg_por_pagina': self.seg_por_pagina, 'seg_por_mb': self.seg_por_mb}, f)
+        os.replace(temporario, caminho)
+
+def chave_custo(tarefa, custos):
+    """Chave da ordem LPT: maior custo estimado primeiro (empate: nome)."""
+    return (-custos[tarefa], str(tarefa))
+
+def ordenar_por_custo(arquivos, custos):
+    """Ordem de despacho LPT: maior custo estimado primeiro (empate: nome).
+    Os trechos de um PDF longo entram como (arquivo, parte)."""
+    return sorted(arquivos, key=lambda a: chave_custo(a, custos))
+
+# Históricos longos (alunos com muitos anos de vínculo ou transferidos) viram
+# o último PDF do lote a terminar. A partir de LIMITE_PAGINAS_PARTICAO páginas,
+# o PDF é dividido em trechos de páginas, com pelo menos PAGINAS_MINIMAS_TRECHO
+# páginas cada, extraídos em paralelo como tarefas independentes e juntados
+# na ordem das páginas (ver mesclar_trechos).
+LIMITE_PAGINAS_PARTICAO = 16
+PAGINAS_MINIMAS_TRECHO = 4
+
+def dividir_paginas(paginas, partes):
+    """Divide as páginas [0, paginas) em `partes` intervalos (inicio, fim)
+    contíguos e de tamanhos parecidos."""
+    return [(paginas * i // partes, paginas * (i + 1) // partes) for i in range(partes)]
+
+def simular_makespan(ordem, duracoes, workers):
+    """Tempo total do lote se `ordem` for despachada para `workers` processos,
+    cada um pegando o próximo PDF assim que fica livre."""
+    livres = [0.0] * max(1, workers)
+    for arquivo in ordem:
+        i = livres.index(min(livres))
+        livres[i] += duracoes[arquivo]
+    return max(livres)
+
+def processar_pdf(caminho_pdf, buscar_nome=False, rastrear=None, limite_perfil=None, paginas=None):
+    """Extração completa de um PDF (executada nos processos de trabalho).
+    Retorna (resultado, nome, segundos, templates, rastro), onde resultado
+    é o ResultadoHistorico e templates conta os acertos e falhas do cache de layout durante esta
+    extração. Com `rastrear` (nome do arquivo, usado no trecho principal),
+    rastro traz os eventos do rastreamento e, se a extração levou mais de
+    `limite_perfil` segundos, o perfil cProfile de uma segunda extração do
+    mesmo arquivo (só os arquivos lentos pagam o custo do profiler);
+    sem `rastrear`, rastro é None.
+    Com `paginas` (inicio, fim), extrai só esse trecho de um PDF longo e
+    resultado é o parcial de extrair_dados_paginas, para mesclar_trechos."""
+    inicio = time.perf_counter()
+    inicio_us = agora_us()
+    templates = _templates_local.contagem = {"acertos": 0, "falhas": 0}
+    if rastrear:
+        _rastro_local.eventos = []
+    try:
+        if paginas:
+            resultado = extrair_dados_paginas(caminho_pdf, *paginas)
+        else:
+            resultado = extrair_dados_historico(caminho_pdf)
+        nome = ""
+        if buscar_nome:
+            with trecho("nome do aluno"):
+                nome = extrair_nome_aluno(caminho_pdf)
+    finally:
+        eventos = getattr(_rastro_local, "eventos", None)
+        _rastro_local.eventos = None
+        _templates_local.contagem = None
+    segundos = time.perf_counter() - inicio
+    rastro = None
+    if rastrear:
+        eventos.append(evento_trace(rastrear, inicio_us, agora_us(), {"segundos": round(segundos, 3)}))
+        perfil = None
+        if limite_perfil is not None and segundos > limite_perfil:
+            perfil = perfilar_extracao(caminho_pdf, paginas=paginas)
+        rastro = {"eventos": eventos, "perfil": perfil}
+    return resultado, nome, segundos, templates, rastro
+
+def executar_extracoes(tarefas, max_workers):
+    """Executa processar_pdf para cada (arquivo, caminho, buscar_nome), na
+    ordem dada, e gera (arquivo, resultado) conforme cada um termina."""
+    if max_workers <= 1 or len(tarefas) <= 1:
+        for arquivo, caminho, buscar_nome in tarefas:
+            yield arquivo, processar_pdf(caminho, buscar_nome)
+        return
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tarefas))) as executor:
+        # o pool consome as tarefas na ordem de submissão
+        futuros = {executor.submit(processar_pdf, caminho, buscar_nome): arquivo
+                   for arquivo, caminho, buscar_nome in tarefas}
+        for futuro in as_completed(futuros):
+            yield futuros[futuro], futuro.result()
+
+
+# --- RELATÓRIOS SOB DEMANDA ---
+# A extração grava apenas um modelo compacto de linhas (uma linha por linha de
+# relatório). Cada formato (XLSX, CSV, TXT) é renderizado a partir dele somente
+# quando é pedido pela primeira vez e fica em cache na pasta de relatórios.
+
+RELATORIOS = {
+    'excel_report': "relatorio_componentes.xlsx",
+    'csv_report': "relatorio_final.csv",
+    'txt_report': "relatorio_historicos.txt",
+}
+MODELO_RELATORIO = "relatorio_linhas.json"
+
+# Colunas de cada linha do modelo; resumo/ch_total/percentual só existem na
+# primeira linha de cada aluno (seq preenchido), como no relatório Excel.
+COLUNAS_MODELO = ['seq', 'matricula', 'nome', 'componente', 'resumo', 'ch_total', 'percentual', 'arquivo']
+
+def montar_linhas_relatorio(resultados, percentuais_dict):
+    """Converte os resultados da extração no modelo de linhas dos relatórios."""
+    linhas = []
+    seq = 1  # Contador sequencial
+    for registro in resultados:
+        resultado = registro['resultado']
+        pendentes = resultado.pendentes
+        matricula = registro['matricula']
+        nome_aluno = registro['nome']
+        percentual = percentuais_dict.get(matricula, "")
+        resumo_qtd = resultado.resumo_texto()
+        ch_total = f"{resultado.total} h"
+
+        if not pendentes:
+            linhas.append([seq, matricula, nome_aluno, 'não contém', resumo_qtd, ch_total, percentual, registro['arquivo']])
+            seq += 1
+            continue
+
+        # Com disciplinas pendentes
+        for idx, componente in enumerate(pendentes):
+            componente_texto = componente.texto()
+            if idx == 0:
+                linhas.append([seq, matricula, nome_aluno, componente_texto, resumo_qtd, ch_total, percentual, registro['arquivo']])
+                seq += 1
+            else:
+                # Repetir matrícula e nome em todas as linhas
+                linhas.append([None, matricula, nome_aluno, componente_texto, None, None, None, registro['arquivo']])
+    return linhas
+
+def linha_consolidada(linha):
+    """Texto da linha nos relatórios CSV/TXT."""
+    if linha[0] is not None:
+        return f"{linha[3]} ; {linha[4]}".strip()
+    return linha[3]
+
+def salvar_modelo_relatorio(pasta, linhas):
+    caminho = os.path.join(pasta, MODELO_RELATORIO)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'colunas': COLUNAS_MODELO, 'linhas': linhas}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(caminho + '.tmp', caminho)
+    return caminho
+
+def carregar_modelo_relatorio(pasta):
+    with open(os.path.join(pasta, MODELO_RELATORIO), 'r', encoding='utf-8') as f:
+        linhas = json.load(f)['linhas']
+    # O mesmo componente se repete por toda a turma: uma cópia só do texto
+    for linha in linhas:
+        linha[3] = sys.intern(linha[3])
+    return linhas
+
+def renderizar_xlsx(linhas, caminho):
     wb = Workbook()
     ws = wb.active
     ws.title = "Componentes Pendentes"
@@ -272,70 +1233,1685 @@ def run_extraction_process_web_mode(pdf_upload_folder, excel_percentual_path, ou
             cell.font = Font(bold=True)
             cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
 
-    seq = 1  # Contador sequencial
-    
-    # 5. Abre os arquivos de saída (CSV e TXT) e processa os PDFs
-    with open(csv_compact_path, "w", newline='', encoding="utf-8-sig") as csv_compact, \
-         open(txt_output_path, "w", encoding="utf-8-sig") as arquivo_txt:
+    for seq, matricula, nome_aluno, componente, resumo_qtd, ch_total, percentual, _ in linhas:
+        ws.append([seq, matricula, nome_aluno, None, componente, resumo_qtd, ch_total, percentual])
+    wb.save(caminho)
 
+def renderizar_csv(linhas, caminho):
+    with open(caminho, "w", newline='', encoding="utf-8-sig") as csv_compact:
         writer_compacto = csv.writer(csv_compact, delimiter=';')
         writer_compacto.writerow(['Linha Consolidada','Arquivo'])
+        for linha in linhas:
+            writer_compacto.writerow([linha_consolidada(linha), linha[7]])
 
-        for i, arquivo in enumerate(pdfs_encontrados):
-            print(f"Processando [{i+1}/{len(pdfs_encontrados)}]: {arquivo}")
-            
-            # Reporta progresso se callback fornecido
-            if progress_callback:
-                progress_callback(i + 1, len(pdfs_encontrados))
-            
-            caminho_completo = os.path.join(pdf_upload_folder, arquivo)
-            
-            # --- Extrai os dados do PDF ---
-            pendentes, resumo = extrair_dados_historico(caminho_completo)
-            
-            matricula = extrair_matricula_do_nome_arquivo(arquivo)
-            nome_aluno = extrair_nome_aluno(caminho_completo)
-            percentual = percentuais_dict.get(matricula, "")
-            resumo_qtd = gerar_resumo_string(pendentes, resumo)
-            ch_total = f"{resumo.get('total','0')} h"
-
-            if not pendentes:
-                linha_consolidada = f"não contém ; {resumo_qtd}"
-                writer_compacto.writerow([linha_consolidada, arquivo])
-                arquivo_txt.write(linha_consolidada + "\n")
-                
-                ws.append([seq, matricula, nome_aluno, None, 'não contém', resumo_qtd, ch_total, percentual])
-                seq += 1
+def renderizar_txt(linhas, caminho):
+    with open(caminho, "w", encoding="utf-8-sig") as arquivo_txt:
+        for linha in linhas:
+            arquivo_txt.write(linha_consolidada(linha) + "\n")
+
+RENDERIZADORES = {
+    RELATORIOS['excel_report']: (renderizar_xlsx, False),
+    RELATORIOS['csv_report']: (renderizar_csv, True),
+    RELATORIOS['txt_report']: (renderizar_txt, True),
+}
+
+def comprimir_relatorio(caminho):
+    """Grava `caminho + '.gz'` ao lado do relatório (servido com Content-Encoding: gzip)."""
+    caminho_gz = caminho + '.gz'
+    with open(caminho, 'rb') as origem, gzip.GzipFile(caminho_gz + '.tmp', 'wb', compresslevel=9, mtime=0) as destino:
+        shutil.copyfileobj(origem, destino)
+    os.replace(caminho_gz + '.tmp', caminho_gz)
+    return caminho_gz
+
+def renderizar_relatorio(pasta, nome_arquivo):
+    """Garante que o relatório `nome_arquivo` exista na pasta, renderizando-o a
+    partir do modelo de linhas se ainda não foi gerado. Retorna o caminho, ou
+    None se o nome não for um relatório conhecido ou não houver modelo."""
+    if nome_arquivo not in RENDERIZADORES:
+        return None
+    caminho = os.path.join(pasta, nome_arquivo)
+    if os.path.exists(caminho):
+        return caminho
+    if not os.path.exists(os.path.join(pasta, MODELO_RELATORIO)):
+        return None
+    renderizar, comprimir = RENDERIZADORES[nome_arquivo]
+    # Renderiza em arquivo temporário e publica com rename atômico
+    caminho_tmp = caminho + '.tmp'
+    renderizar(carregar_modelo_relatorio(pasta), caminho_tmp)
+    os.replace(caminho_tmp, caminho)
+    if comprimir:
+        comprimir_relatorio(caminho)
+    return caminho
+
+# --- PRÉ-VISUALIZAÇÃO DOS RESULTADOS ---
+# A pré-visualização (GET /jobs/<job_id>/preview) lê o modelo de linhas
+# gravado pela extração, sem renderizar relatório nenhum. O modelo de cada
+# pasta é indexado uma vez, com um item por aluno e os textos de busca já
+# normalizados, e fica em cache enquanto o arquivo não mudar. As ordenações
+# são calculadas na primeira vez em que são pedidas e as últimas seleções
+# (filtro + ordenação) ficam guardadas, então folhear as páginas de uma
+# mesma busca é só fatiar uma lista.
+
+MAX_PREVIAS = 8  # pastas indexadas em memória
+MAX_SELECOES_PREVIA = 16  # seleções (filtro + ordenação) guardadas por pasta
+PREVIAS = OrderedDict()  # pasta -> (mtime do modelo, PreviaRelatorio)
+PREVIAS_LOCK = threading.Lock()
+
+_RE_NUMERO = re.compile(r'\d+(?:[.,]\d+)?')
+
+def chave_busca(texto):
+    """Texto em minúsculas e sem acentos, para busca ("João" casa com "joao")."""
+    texto = str(texto or '')
+    if texto.isascii():
+        return texto.lower()
+    decomposto = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).casefold()
+
+def _numero(valor):
+    """Valor numérico de "730 h" ou "85,5%" para ordenação; None se não houver."""
+    if isinstance(valor, (int, float)):
+        return valor
+    m = _RE_NUMERO.search(str(valor or ''))
+    return float(m.group().replace(',', '.')) if m else None
+
+class PreviaRelatorio:
+    """Alunos do modelo de linhas de um lote, prontos para paginar, ordenar e
+    filtrar. Cada aluno é um dict com as colunas da primeira linha dele no
+    modelo e a lista dos seus componentes pendentes."""
+
+    def __init__(self, linhas):
+        self.alunos = []
+        for seq, matricula, nome, componente, resumo, ch_total, percentual, arquivo in linhas:
+            if seq is not None or not self.alunos:
+                self.alunos.append({"seq": seq, "matricula": matricula, "nome": nome, "componentes": [],
+                                    "resumo": resumo, "ch_total": ch_total, "percentual": percentual,
+                                    "arquivo": arquivo})
+                if seq is not None and componente == 'não contém':
+                    continue
+            self.alunos[-1]["componentes"].append(componente)
+        # Colunas de busca; o texto de cada componente se repete pela turma
+        # toda e é normalizado uma vez só
+        chaves_componentes = {}
+        def chave_componente(texto):
+            chave = chaves_componentes.get(texto)
+            if chave is None:
+                chave = chaves_componentes[texto] = chave_busca(texto)
+            return chave
+        self._busca = {
+            'matricula': [chave_busca(a["matricula"]) for a in self.alunos],
+            'nome': [chave_busca(a["nome"]) for a in self.alunos],
+            'componente': ["\n".join(map(chave_componente, a["componentes"])) for a in self.alunos],
+        }
+        # O modelo já vem na ordem de seq
+        self._ordens = {('seq', False): list(range(len(self.alunos)))}
+        self._selecoes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _valores(self, campo):
+        if campo in ('matricula', 'nome'):
+            return [v or None for v in self._busca[campo]]
+        if campo == 'componentes':
+            return [len(a["componentes"]) for a in self.alunos]
+        if campo == 'arquivo':
+            return [chave_busca(a["arquivo"]) or None for a in self.alunos]
+        return [_numero(a[campo]) for a in self.alunos]
+
+    def _ordem(self, campo, decrescente):
+        """Índices dos alunos ordenados por `campo`; vazios sempre por último."""
+        chave = (campo, decrescente)
+        if chave not in self._ordens:
+            valores = self._valores(campo)
+            preenchidos = [i for i, v in enumerate(valores) if v is not None]
+            preenchidos.sort(key=valores.__getitem__, reverse=decrescente)  # sort estável: empates na ordem de seq
+            self._ordens[chave] = preenchidos + [i for i, v in enumerate(valores) if v is None]
+        return self._ordens[chave]
+
+    def _filtrar(self, selecao, filtros):
+        for campo, termo in filtros.items():
+            if campo == 'q':
+                matriculas, nomes, componentes = (self._busca[c] for c in ('matricula', 'nome', 'componente'))
+                selecao = [i for i in selecao if termo in matriculas[i] or termo in nomes[i] or termo in componentes[i]]
+            else:
+                coluna = self._busca[campo]
+                selecao = [i for i in selecao if termo in coluna[i]]
+        return selecao
+
+    def selecionar(self, ordenar='seq', decrescente=False, filtros=None):
+        """Índices dos alunos que passam nos filtros (busca por trecho, sem
+        diferenciar maiúsculas nem acentos), na ordem pedida."""
+        filtros = {campo: chave_busca(valor) for campo, valor in (filtros or {}).items() if valor}
+        chave = (ordenar, decrescente, tuple(sorted(filtros.items())))
+        with self._lock:
+            selecao = self._selecoes.get(chave)
+            if selecao is None:
+                selecao = self._filtrar(self._ordem(ordenar, decrescente), filtros)
+                self._selecoes[chave] = selecao
+                if len(self._selecoes) > MAX_SELECOES_PREVIA:
+                    self._selecoes.popitem(last=False)
+            else:
+                self._selecoes.move_to_end(chave)
+        return selecao
+
+    def pagina(self, numero=1, por_pagina=50, ordenar='seq', decrescente=False, filtros=None):
+        """Página `numero` (a partir de 1) da seleção: (alunos, total selecionado)."""
+        selecao = self.selecionar(ordenar, decrescente, filtros)
+        inicio = (numero - 1) * por_pagina
+        return [self.alunos[i] for i in selecao[inicio:inicio + por_pagina]], len(selecao)
+
+def carregar_previa(pasta):
+    """PreviaRelatorio do modelo de linhas da pasta (em cache enquanto o
+    modelo não mudar), ou None se a pasta ainda não tem modelo."""
+    try:
+        mtime = os.stat(os.path.join(pasta, MODELO_RELATORIO)).st_mtime_ns
+    except FileNotFoundError:
+        with PREVIAS_LOCK:
+            PREVIAS.pop(pasta, None)
+        return None
+    with PREVIAS_LOCK:
+        em_cache = PREVIAS.get(pasta)
+        if em_cache is not None and em_cache[0] == mtime:
+            PREVIAS.move_to_end(pasta)
+            return em_cache[1]
+    previa = PreviaRelatorio(carregar_modelo_relatorio(pasta))
+    with PREVIAS_LOCK:
+        PREVIAS[pasta] = (mtime, previa)
+        PREVIAS.move_to_end(pasta)
+        while len(PREVIAS) > MAX_PREVIAS:
+            PREVIAS.popitem(last=False)
+    return previa
+
+
+# --- POOL DE WORKERS PERSISTENTE ---
+# Os processos de extração vivem enquanto a aplicação estiver no ar e são
+# reaproveitados por todos os lotes: o custo de subir o Python, importar o
+# pdfplumber/pdfminer e carregar métricas de fontes é pago uma vez por worker,
+# no aquecimento, e não a cada lote. Para não acumular memória ao longo de
+# milhares de PDFs, cada worker é reciclado (substituído por um novo, já
+# aquecido) depois de `max_tarefas` extrações ou quando seu RSS passa de
+# `max_rss_mb`. Um worker que morre no meio de uma extração (segfault, OOM
+# killer) é substituído e o PDF é tentado de novo uma vez.
+
+# Tentativas de um PDF cujo worker morreu durante a extração
+TENTATIVAS_WORKER = 2
+# Workers seguidos que morrem antes de ficar prontos até o pool desistir
+FALHAS_AQUECIMENTO = 5
+
+def _montar_pdf_aquecimento():
+    """PDF mínimo (uma página com texto e uma tabela de duas células) usado
+    para exercitar o pdfplumber ao subir cada worker."""
+    conteudo = (b"BT /F1 12 Tf 72 770 Td (HISTORICO ESCOLAR) Tj ET\n"
+                b"72 700 200 40 re S 172 700 m 172 740 l S\n"
+                b"BT /F1 10 Tf 80 715 Td (CODIGO) Tj 100 0 Td (CH) Tj ET")
+    objetos = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(conteudo), conteudo),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    saida = bytearray(b"%PDF-1.4\n")
+    posicoes = []
+    for numero, objeto in enumerate(objetos, 1):
+        posicoes.append(len(saida))
+        saida += b"%d 0 obj\n%s\nendobj\n" % (numero, objeto)
+    inicio_xref = len(saida)
+    saida += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objetos) + 1)
+    saida += b"".join(b"%010d 00000 n \n" % posicao for posicao in posicoes)
+    saida += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objetos) + 1, inicio_xref)
+    return bytes(saida)
+
+def aquecer_extracao():
+    """Exercita a extração num PDF mínimo para carregar de antemão o que o
+    pdfplumber/pdfminer só importa no primeiro uso."""
+    try:
+        extrair_dados_historico(_montar_pdf_aquecimento())
+    except Exception as e:
+        print(f"Aviso: aquecimento do worker {os.getpid()} falhou: {e}")
+
+def rss_atual():
+    """Memória residente do processo atual em bytes (0 se indisponível)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+# Mensagem do pool pedindo que o worker desista do PDF em andamento
+CANCELAR = "cancelar"
+
+def _pedido_de_cancelamento(conexao):
+    # Durante uma extração o pool só escreve no pipe para cancelá-la
+    if conexao.poll() and conexao.recv() == CANCELAR:
+        raise ExtracaoCancelada("extração cancelada")
+
+def _laco_worker(conexao, max_tarefas, max_rss):
+    """Corpo de cada processo do pool: aquece, avisa que está pronto e extrai
+    um PDF por mensagem até ser encerrado ou atingir o limite de reciclagem."""
+    aquecer_extracao()
+    _cancelamento_local.verificar = lambda: _pedido_de_cancelamento(conexao)
+    conexao.send(("pronto", rss_atual()))
+    feitas = 0
+    while True:
+        try:
+            argumentos = conexao.recv()
+        except (EOFError, OSError):
+            return
+        if argumentos is None:
+            return
+        if argumentos == CANCELAR:
+            continue  # o PDF cancelado terminou antes de o pedido chegar
+        try:
+            resposta = ("ok", processar_pdf(*argumentos))
+        except Exception as e:
+            resposta = ("erro", e)
+        feitas += 1
+        rss = rss_atual()
+        motivo = None
+        if max_tarefas and feitas >= max_tarefas:
+            motivo = f"{feitas} tarefas"
+        elif max_rss and rss > max_rss:
+            motivo = f"RSS de {rss // (1024 * 1024)} MB"
+        try:
+            conexao.send(("resultado",) + resposta + (rss, motivo))
+        except Exception as e:
+            # Exceção que não pode ser serializada: envia só a descrição
+            conexao.send(("resultado", "erro", RuntimeError(repr(resposta[1] if resposta[0] == "erro" else e)), rss, motivo))
+        if motivo:
+            return
+
+class _Worker:
+    def __init__(self, processo, conexao):
+        self.processo = processo
+        self.conexao = conexao
+        self.pronto = False
+        self.saindo = False   # reciclagem pedida: o processo vai terminar sozinho
+        self.tarefa = None    # [argumentos, futuro, tentativas]
+        self.tarefas = 0
+        self.rss = 0
+        self.prazo = None     # cancelamento pedido: limite para o worker desistir
+
+class PoolAquecido:
+    """Processos de extração de vida longa. submit(*argumentos) executa
+    processar_pdf(*argumentos) no primeiro worker livre e retorna um
+    concurrent.futures.Future."""
+
+    def __init__(self, processos, max_tarefas=None, max_rss_mb=None):
+        metodos = multiprocessing.get_all_start_methods()
+        # forkserver: os workers nascem de um processo limpo que já importou
+        # este módulo, e não de um fork do servidor web com suas threads
+        if "forkserver" in metodos:
+            self._contexto = multiprocessing.get_context("forkserver")
+            self._contexto.set_forkserver_preload([__name__])
+        else:
+            self._contexto = multiprocessing.get_context("spawn")
+        self.processos = processos
+        self.max_tarefas = max_tarefas
+        self.max_rss = int(max_rss_mb * 1024 * 1024) if max_rss_mb else None
+        self.reciclados = 0
+        self.reiniciados = 0
+        self._falhas_aquecimento = 0
+        self._erro = None
+        self._workers = []
+        self._pendentes = deque()
+        self._encerrado = False
+        self._lock = threading.Lock()
+        self._despertar_leitura, self._despertar_escrita = self._contexto.Pipe(duplex=False)
+        for _ in range(processos):
+            self._iniciar_worker()
+        self._thread = threading.Thread(target=self._supervisor, daemon=True)
+        self._thread.start()
+        # Encerra os workers antes de o multiprocessing terminá-los na saída
+        # (que o supervisor confundiria com quedas)
+        atexit.register(self.encerrar)
+
+    def _iniciar_worker(self):
+        conexao, conexao_filho = self._contexto.Pipe()
+        processo = self._contexto.Process(
+            target=_laco_worker, args=(conexao_filho, self.max_tarefas, self.max_rss), daemon=True)
+        processo.start()
+        conexao_filho.close()
+        self._workers.append(_Worker(processo, conexao))
+
+    def submit(self, *argumentos):
+        futuro = Future()
+        with self._lock:
+            if self._encerrado:
+                raise RuntimeError("pool de extração encerrado")
+            if self._erro:
+                raise RuntimeError(self._erro)
+            self._pendentes.append([argumentos, futuro, 0])
+            self._distribuir()
+        return futuro
+
+    def cancelar(self, futuro):
+        """Cancela a extração de `futuro`: se ainda não começou, sai da fila;
+        se está num worker, ele é avisado e, passado PRAZO_CANCELAMENTO, é
+        terminado e substituído. O futuro termina com ExtracaoCancelada."""
+        with self._lock:
+            for tarefa in self._pendentes:
+                if tarefa[1] is futuro:
+                    self._pendentes.remove(tarefa)
+                    break
+            else:
+                for worker in self._workers:
+                    if worker.tarefa is not None and worker.tarefa[1] is futuro and worker.prazo is None:
+                        worker.prazo = time.monotonic() + PRAZO_CANCELAMENTO
+                        try:
+                            worker.conexao.send(CANCELAR)
+                        except (OSError, ValueError):
+                            pass
+                        self._despertar_escrita.send(None)
+                return
+        if not futuro.cancel() and not futuro.done():
+            futuro.set_exception(ExtracaoCancelada("extração cancelada"))
+
+    def situacao(self):
+        with self._lock:
+            return {
+                "workers": [{"pid": w.processo.pid, "pronto": w.pronto, "ocupado": w.tarefa is not None,
+                             "tarefas": w.tarefas, "rss_mb": round(w.rss / (1024 * 1024), 1)}
+                            for w in self._workers],
+                "reciclados": self.reciclados,
+                "reiniciados": self.reiniciados,
+            }
+
+    def _distribuir(self):
+        for worker in self._workers:
+            if not self._pendentes:
+                return
+            if not worker.pronto or worker.saindo or worker.tarefa is not None:
                 continue
+            tarefa = self._pendentes.popleft()
+            if tarefa[2] == 0 and not tarefa[1].set_running_or_notify_cancel():
+                continue
+            worker.tarefa = tarefa
+            try:
+                worker.conexao.send(tarefa[0])
+            except (OSError, ValueError):
+                pass  # o worker morreu; o supervisor trata pelo sentinel
 
-            # Com disciplinas pendentes
-            for idx, d in enumerate(pendentes):
-                codigo = d.get('codigo','')
-                nome = d.get('nome','')
-                ch = d.get('ch','')
-                componente_texto = f"{codigo} {nome} {ch}".strip()
-                
-                if idx == 0:
-                    linha_consolidada = f"{componente_texto} ; {resumo_qtd}".strip()
-                    writer_compacto.writerow([linha_consolidada, arquivo])
-                    arquivo_txt.write(linha_consolidada + "\n")
-                    
-                    ws.append([seq, matricula, nome_aluno, None, componente_texto, resumo_qtd, ch_total, percentual])
-                    seq += 1
+    def _supervisor(self):
+        while True:
+            with self._lock:
+                if self._encerrado:
+                    return
+                objetos = {self._despertar_leitura: None}
+                for worker in self._workers:
+                    objetos[worker.conexao] = worker
+                    objetos[worker.processo.sentinel] = worker
+                prazos = [w.prazo for w in self._workers if w.prazo is not None]
+            espera = min([1.0] + [max(0.0, prazo - time.monotonic()) for prazo in prazos])
+            prontos = multiprocessing.connection.wait(list(objetos), timeout=espera)
+            concluidos = []
+            with self._lock:
+                agora = time.monotonic()
+                for worker in self._workers:
+                    if worker.prazo is not None and worker.prazo <= agora:
+                        # Não desistiu a tempo: o processo é terminado e, no
+                        # sentinel, substituído
+                        print(f"Worker de extração {worker.processo.pid} não atendeu o cancelamento; terminando.")
+                        worker.processo.terminate()
+                        worker.prazo = float("inf")
+                for objeto in prontos:
+                    worker = objetos[objeto]
+                    if worker is None:
+                        while self._despertar_leitura.poll():
+                            self._despertar_leitura.recv()
+                    elif worker in self._workers:
+                        if objeto is not worker.conexao or not self._receber(worker, concluidos):
+                            self._worker_terminou(worker, concluidos)
+                self._distribuir()
+            # Os callbacks dos futuros rodam fora do lock do pool
+            for futuro, ok, valor in concluidos:
+                if futuro.done():
+                    continue
+                if ok:
+                    futuro.set_result(valor)
                 else:
-                    writer_compacto.writerow([componente_texto, arquivo])
-                    arquivo_txt.write(componente_texto + "\n")
-                    # Repetir matrícula, nome (e percentual quando disponível) em todas as linhas
-                    ws.append([None, matricula, nome_aluno, None, componente_texto, None, None, None])
+                    futuro.set_exception(valor)
 
-    # 6. Salva o Excel
-    wb.save(excel_output_path)
-    
-    print("\nProcessamento concluído! Arquivos gerados em 'generated_reports'.")
-    
-    # 7. Retorna os nomes dos arquivos para o Flask
-    return {
-        'excel_report': excel_output_name,
-        'csv_report': csv_compact_name,
-        'txt_report': txt_output_name
-    }
\ No newline at end of file
+    def _receber(self, worker, concluidos):
+        """Trata uma mensagem do worker; False se o pipe foi fechado."""
+        try:
+            mensagem = worker.conexao.recv()
+        except (EOFError, OSError):
+            return False
+        if mensagem[0] == "pronto":
+            self._falhas_aquecimento = 0
+            worker.pronto = True
+            worker.rss = mensagem[1]
+            return True
+        _, status, valor, worker.rss, motivo = mensagem
+        tarefa, worker.tarefa = worker.tarefa, None
+        worker.prazo = None
+        worker.tarefas += 1
+        if tarefa is not None:
+            concluidos.append((tarefa[1], status == "ok", valor))
+        if motivo:
+            worker.saindo = True
+            self.reciclados += 1
+            print(f"Worker de extração {worker.processo.pid} reciclado após {motivo}.")
+        return True
+
+    def _worker_terminou(self, worker, concluidos):
+        # Mensagens enviadas antes de o processo sair ainda estão no pipe
+        try:
+            while worker.tarefa is not None and worker.conexao.poll():
+                if not self._receber(worker, concluidos):
+                    break
+        except OSError:
+            pass
+        if worker not in self._workers:
+            return
+        self._workers.remove(worker)
+        worker.conexao.close()
+        worker.processo.join(timeout=1)
+        tarefa = worker.tarefa
+        if worker.prazo is not None and tarefa is not None:
+            # Terminado por não atender o cancelamento: não é queda nem se tenta de novo
+            concluidos.append((tarefa[1], False, ExtracaoCancelada("extração cancelada")))
+            tarefa = None
+        elif not worker.saindo and not self._encerrado:
+            self.reiniciados += 1
+            print(f"Worker de extração {worker.processo.pid} terminou inesperadamente "
+                  f"(código {worker.processo.exitcode}); iniciando outro.")
+        if tarefa is not None:
+            tarefa[2] += 1
+            if tarefa[2] < TENTATIVAS_WORKER and not self._encerrado:
+                self._pendentes.appendleft(tarefa)
+            else:
+                concluidos.append((tarefa[1], False, RuntimeError(
+                    f"worker de extração terminou inesperadamente (código {worker.processo.exitcode})")))
+        if self._encerrado:
+            return
+        if not worker.pronto:
+            self._falhas_aquecimento += 1
+            if self._falhas_aquecimento >= FALHAS_AQUECIMENTO:
+                # Algo impede os workers de subir (ex.: import quebrado): em vez
+                # de reiniciá-los para sempre, falha o que está esperando
+                self._erro = (f"{self._falhas_aquecimento} workers de extração seguidos "
+                              f"terminaram antes de ficar prontos")
+                print(f"Erro: {self._erro}.")
+                while self._pendentes:
+                    concluidos.append((self._pendentes.popleft()[1], False, RuntimeError(self._erro)))
+                return
+        self._iniciar_worker()
+
+    def encerrar(self):
+        """Para os workers; PDFs pendentes são cancelados e os em extração falham."""
+        with self._lock:
+            if self._encerrado:
+                return
+            self._encerrado = True
+            pendentes = list(self._pendentes)
+            self._pendentes.clear()
+            workers = list(self._workers)
+        self._despertar_escrita.send(None)
+        self._thread.join()
+        for worker in workers:
+            if worker.tarefa is None:
+                try:
+                    worker.conexao.send(None)
+                except (OSError, ValueError):
+                    pass
+            else:
+                worker.processo.terminate()
+                pendentes.append(worker.tarefa)
+        for worker in workers:
+            worker.processo.join(timeout=5)
+            if worker.processo.is_alive():
+                worker.processo.kill()
+            worker.conexao.close()
+        for _, futuro, tentativas in pendentes:
+            if futuro.done() or (tentativas == 0 and futuro.cancel()):
+                continue
+            futuro.set_exception(RuntimeError("pool de extração encerrado"))
+
+
+# --- FILA DISTRIBUÍDA (vários hosts) ---
+# No modo distribuído o servidor web não extrai: cada PDF que o escalonador
+# despacha vira uma tarefa (com o conteúdo do PDF) num banco SQLite dentro da
+# pasta base compartilhada. Processos worker.py em qualquer máquina que monte
+# essa pasta reivindicam as tarefas com um lease, renovado enquanto extraem,
+# e gravam o resultado na mesma linha; o servidor recolhe os resultados e os
+# entrega ao pipeline como se viessem do pool local. Se um worker morre, o
+# lease vence e a tarefa volta a ser reivindicada por outro.
+
+PASTA_FILA_DISTRIBUIDA = "fila"
+NOME_FILA_DISTRIBUIDA = "tarefas.sqlite"
+# Validade do lease (s); o worker o renova a cada terço desse tempo
+LEASE_PADRAO = 60.0
+# Leases vencidos de uma mesma tarefa até ela ser dada como erro (um PDF
+# que derruba todo worker que o pega não circula para sempre)
+MAX_TENTATIVAS_DISTRIBUIDAS = 3
+# Tarefas terminadas que nenhum servidor recolheu (ex.: ele reiniciou) são apagadas depois disso (s)
+RETENCAO_TAREFAS = 24 * 3600
+
+def conectar_fila(pasta):
+    """Conexão (em autocommit) com o banco da fila em `pasta`, criando-o se preciso."""
+    os.makedirs(pasta, exist_ok=True)
+    conexao = sqlite3.connect(os.path.join(pasta, NOME_FILA_DISTRIBUIDA), timeout=30,
+                              isolation_level=None, check_same_thread=False)
+    # Journal clássico em vez de WAL: o WAL depende de memória compartilhada
+    # entre os processos e não funciona com o banco numa pasta de rede
+    conexao.execute("PRAGMA journal_mode=DELETE")
+    conexao.execute("""CREATE TABLE IF NOT EXISTS tarefas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        origem TEXT NOT NULL,
+        arquivo TEXT,
+        pdf BLOB,
+        buscar_nome INTEGER NOT NULL,
+        rastrear TEXT,
+        limite_perfil REAL,
+        paginas TEXT,
+        estado TEXT NOT NULL,
+        worker TEXT,
+        lease_ate REAL,
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        resultado TEXT,
+        erro TEXT,
+        criada REAL NOT NULL,
+        atualizada REAL NOT NULL)""")
+    conexao.execute("CREATE INDEX IF NOT EXISTS tarefas_estado ON tarefas (estado, id)")
+    conexao.execute("CREATE INDEX IF NOT EXISTS tarefas_origem ON tarefas (origem, estado)")
+    return conexao
+
+class FilaDistribuida:
+    """Executor do EscalonadorJusto no modo distribuído: submit(*argumentos)
+    grava a tarefa de processar_pdf na fila de `pasta` e retorna um
+    concurrent.futures.Future resolvido quando algum worker publicar o
+    resultado."""
+
+    def __init__(self, pasta, intervalo=0.25):
+        self.pasta = pasta
+        self.intervalo = intervalo
+        self.origem = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._conexao = conectar_fila(pasta)
+        self._futuros = {}  # id da tarefa -> Future
+        self._lock = threading.Lock()
+        self._encerrado = threading.Event()
+        self._ultima_limpeza = 0.0
+        self._thread = threading.Thread(target=self._coletar, daemon=True)
+        self._thread.start()
+
+    def submit(self, fonte, buscar_nome=False, rastrear=None, limite_perfil=None, paginas=None):
+        if isinstance(fonte, str):
+            arquivo = os.path.basename(fonte)
+            with open(fonte, 'rb') as f:
+                conteudo = f.read()
+        else:
+            arquivo = rastrear
+            conteudo = bytes(fonte)
+        futuro = Future()
+        futuro.set_running_or_notify_cancel()
+        agora = time.time()
+        with self._lock:
+            if self._encerrado.is_set():
+                raise RuntimeError("fila distribuída encerrada")
+            cursor = self._conexao.execute(
+                "INSERT INTO tarefas (origem, arquivo, pdf, buscar_nome, rastrear, limite_perfil, paginas, estado, criada, atualizada)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 'pendente', ?, ?)",
+                (self.origem, arquivo, conteudo, int(bool(buscar_nome)), rastrear, limite_perfil,
+                 json.dumps(list(paginas)) if paginas else None, agora, agora))
+            self._futuros[cursor.lastrowid] = futuro
+        return futuro
+
+    def cancelar(self, futuro):
+        """Tira a tarefa da fila ou, se um worker já a pegou, marca-a como
+        cancelada (o worker desiste na próxima verificação); o futuro termina
+        na hora com ExtracaoCancelada."""
+        with self._lock:
+            id_tarefa = next((i for i, f in self._futuros.items() if f is futuro), None)
+            if id_tarefa is None:
+                return
+            del self._futuros[id_tarefa]
+            removidas = self._conexao.execute(
+                "DELETE FROM tarefas WHERE id = ? AND estado = 'pendente'", (id_tarefa,)).rowcount
+            if not removidas:
+                self._conexao.execute(
+                    "UPDATE tarefas SET estado = 'cancelada', atualizada = ? WHERE id = ? AND estado = 'em_execucao'",
+                    (time.time(), id_tarefa))
+        futuro.set_exception(ExtracaoCancelada("extração cancelada"))
+
+    def situacao(self):
+        """Tarefas por estado (de todos os servidores) e workers com lease válido."""
+        with self._lock:
+            estados = dict(self._conexao.execute("SELECT estado, COUNT(*) FROM tarefas GROUP BY estado").fetchall())
+            workers = dict(self._conexao.execute(
+                "SELECT worker, COUNT(*) FROM tarefas WHERE estado = 'em_execucao' AND lease_ate >= ? GROUP BY worker",
+                (time.time(),)).fetchall())
+            aguardando = len(self._futuros)
+        return {"estados": estados, "workers": workers, "aguardando": aguardando}
+
+    def _coletar(self):
+        while not self._encerrado.wait(self.intervalo):
+            try:
+                self._coletar_resultados()
+            except sqlite3.Error as e:
+                print(f"Aviso: fila distribuída indisponível: {e}")
+
+    def _coletar_resultados(self):
+        agora = time.time()
+        with self._lock:
+            linhas = []
+            if self._futuros:
+                linhas = self._conexao.execute(
+                    "SELECT id, estado, resultado, erro FROM tarefas WHERE origem = ? AND estado IN ('concluida', 'erro')",
+                    (self.origem,)).fetchall()
+                self._conexao.executemany("DELETE FROM tarefas WHERE id = ?", [(linha[0],) for linha in linhas])
+            if agora - self._ultima_limpeza > 60:
+                self._ultima_limpeza = agora
+                self._conexao.execute(
+                    "DELETE FROM tarefas WHERE estado IN ('concluida', 'erro', 'cancelada') AND atualizada < ?",
+                    (agora - RETENCAO_TAREFAS,))
+            concluidas = [(self._futuros.pop(linha[0], None),) + tuple(linha[1:]) for linha in linhas]
+        for futuro, estado, resultado, erro in concluidas:
+            if futuro is None or futuro.done():
+                continue
+            if estado == 'concluida':
+                extraido, *resto = json.loads(resultado)
+                futuro.set_result((ResultadoHistorico.de_json(extraido), *resto))
+            else:
+                futuro.set_exception(RuntimeError(erro))
+
+    def encerrar(self):
+        """Retira da fila as tarefas deste servidor; as em extração são canceladas."""
+        self._encerrado.set()
+        self._thread.join()
+        with self._lock:
+            self._conexao.execute("DELETE FROM tarefas WHERE origem = ? AND estado = 'pendente'", (self.origem,))
+            self._conexao.execute("UPDATE tarefas SET estado = 'cancelada', atualizada = ? WHERE origem = ? AND estado = 'em_execucao'",
+                                  (time.time(), self.origem))
+            futuros = list(self._futuros.values())
+            self._futuros.clear()
+            self._conexao.close()
+        for futuro in futuros:
+            if not futuro.done():
+                futuro.set_exception(RuntimeError("fila distribuída encerrada"))
+
+def reivindicar_tarefa(conexao, worker, lease=LEASE_PADRAO):
+    """Pega a tarefa pendente mais antiga (ou uma cujo lease venceu) para
+    `worker`. Retorna (id, arquivo, pdf, buscar_nome, rastrear,
+    limite_perfil, paginas, tentativa) ou None se não houver nada a fazer."""
+    agora = time.time()
+    conexao.execute("BEGIN IMMEDIATE")
+    try:
+        conexao.execute(
+            "UPDATE tarefas SET estado = 'erro', pdf = NULL, atualizada = ?,"
+            " erro = 'o lease venceu ' || tentativas || ' vezes (o PDF derruba os workers?)'"
+            " WHERE estado = 'em_execucao' AND lease_ate < ? AND tentativas >= ?",
+            (agora, agora, MAX_TENTATIVAS_DISTRIBUIDAS))
+        # Canceladas cujo worker morreu antes de perceber o cancelamento
+        conexao.execute("DELETE FROM tarefas WHERE estado = 'cancelada' AND lease_ate < ?", (agora,))
+        linha = conexao.execute(
+            "SELECT id, arquivo, pdf, buscar_nome, rastrear, limite_perfil, paginas, tentativas FROM tarefas"
+            " WHERE estado = 'pendente' OR (estado = 'em_execucao' AND lease_ate < ?) ORDER BY id LIMIT 1",
+            (agora,)).fetchone()
+        if linha is not None:
+            conexao.execute(
+                "UPDATE tarefas SET estado = 'em_execucao', worker = ?, lease_ate = ?, tentativas = tentativas + 1,"
+                " atualizada = ? WHERE id = ?", (worker, agora + lease, agora, linha[0]))
+        conexao.execute("COMMIT")
+    except BaseException:
+        conexao.execute("ROLLBACK")
+        raise
+    if linha is None:
+        return None
+    paginas = json.loads(linha[6]) if linha[6] else None
+    return linha[:6] + (paginas, linha[7] + 1)
+
+def _manter_lease(pasta, id_tarefa, worker, lease, cancelamento, fim):
+    """Thread do worker durante uma extração: renova o lease e percebe se a
+    tarefa foi cancelada ou reivindicada por outro worker (lease perdido)."""
+    conexao = conectar_fila(pasta)
+    renovado = time.monotonic()
+    try:
+        while not fim.wait(1.0):
+            linha = conexao.execute("SELECT estado, worker FROM tarefas WHERE id = ?", (id_tarefa,)).fetchone()
+            if linha is None or linha[0] != 'em_execucao' or linha[1] != worker:
+                cancelamento.cancelar("tarefa cancelada ou reivindicada por outro worker")
+                return
+            if time.monotonic() - renovado >= lease / 3:
+                conexao.execute("UPDATE tarefas SET lease_ate = ? WHERE id = ? AND worker = ?",
+                                (time.time() + lease, id_tarefa, worker))
+                renovado = time.monotonic()
+    except sqlite3.Error as e:
+        print(f"Aviso: não foi possível renovar o lease da tarefa {id_tarefa}: {e}")
+    finally:
+        conexao.close()
+
+def executar_worker_distribuido(pasta, worker=None, lease=LEASE_PADRAO, espera=0.5, max_tarefas=None, parar=None):
+    """Laço de um processo worker do modo distribuído (ver worker.py):
+    reivindica tarefas na fila de `pasta`, extrai e publica os resultados até
+    `parar` (threading.Event) ser acionado ou `max_tarefas` serem feitas."""
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    conexao = conectar_fila(pasta)
+    aquecer_extracao()
+    print(f"Worker {worker} aguardando tarefas em '{pasta}'.")
+    feitas = 0
+    while not (parar is not None and parar.is_set()) and not (max_tarefas and feitas >= max_tarefas):
+        try:
+            tarefa = reivindicar_tarefa(conexao, worker, lease)
+        except sqlite3.Error as e:
+            print(f"Aviso: fila distribuída indisponível: {e}")
+            tarefa = None
+        if tarefa is None:
+            time.sleep(espera)
+            continue
+        id_tarefa, arquivo, pdf, buscar_nome, rastrear, limite_perfil, paginas, tentativa = tarefa
+        if tentativa > 1:
+            print(f"Retomando {arquivo} (tentativa {tentativa}; o lease anterior venceu).")
+        cancelamento = TokenCancelamento()
+        fim = threading.Event()
+        lease_thread = threading.Thread(target=_manter_lease, args=(pasta, id_tarefa, worker, lease, cancelamento, fim), daemon=True)
+        lease_thread.start()
+        _cancelamento_local.verificar = cancelamento.verificar
+        estado = valor = None
+        try:
+            resultado = processar_pdf(pdf, bool(buscar_nome), rastrear, limite_perfil, paginas)
+            extraido, *resto = resultado
+            estado, valor = 'concluida', json.dumps([extraido.para_json(), *resto], ensure_ascii=False)
+        except ExtracaoCancelada as e:
+            print(f"Abandonando {arquivo}: {e}.")
+        except Exception as e:
+            estado, valor = 'erro', f"{type(e).__name__}: {e}"
+        except KeyboardInterrupt:
+            # Worker interrompido: devolve a tarefa à fila sem esperar o lease vencer
+            conexao.execute(
+                "UPDATE tarefas SET estado = 'pendente', worker = NULL, lease_ate = NULL, tentativas = tentativas - 1"
+                " WHERE id = ? AND estado = 'em_execucao' AND worker = ?", (id_tarefa, worker))
+            raise
+        finally:
+            _cancelamento_local.verificar = None
+            fim.set()
+            lease_thread.join()
+        feitas += 1
+        if estado is None:
+            conexao.execute("DELETE FROM tarefas WHERE id = ? AND estado = 'cancelada'", (id_tarefa,))
+            continue
+        # Só publica se a tarefa ainda é deste worker (não foi cancelada nem reivindicada por outro)
+        coluna = 'resultado' if estado == 'concluida' else 'erro'
+        conexao.execute(
+            f"UPDATE tarefas SET estado = ?, {coluna} = ?, pdf = NULL, atualizada = ?"
+            " WHERE id = ? AND estado = 'em_execucao' AND worker = ?",
+            (estado, valor, time.time(), id_tarefa, worker))
+        print(f"Concluído: {arquivo}" if estado == 'concluida' else f"Erro em {arquivo}: {valor}")
+    conexao.close()
+
+
+# --- ESCALONAMENTO JUSTO ENTRE LOTES ---
+# Vários lotes podem estar em extração ao mesmo tempo (um por upload) e todos
+# dividem os mesmos processos de extração. O escalonador escolhe o próximo PDF
+# sempre do lote que recebeu menos tempo de extração (estimado) até agora,
+# como numa fila justa ponderada: um lote que chega entra no mesmo patamar dos
+# que já estão rodando, então lotes pequenos terminam logo e os grandes seguem
+# avançando em vez de monopolizar o pool. Dentro de cada lote vale a ordem LPT.
+
+class EscalonadorJusto:
+    """Pool de extração compartilhado pelos lotes (PipelineExtracao).
+    Com mais de um worker, extrai num PoolAquecido criado no primeiro uso (ou
+    antes, por aquecer()); `max_tarefas_worker` e `max_rss_worker_mb` são os
+    limites de reciclagem de cada worker. Com `executor` (ex.: FilaDistribuida),
+    as extrações vão para ele, com até `max_workers` em andamento, e
+    `paralelismo` diz quantas delas os workers de fato executam ao mesmo
+    tempo (padrão: max_workers); é ele que dimensiona a estimativa de espera
+    e a divisão de PDFs longos em trechos."""
+
+    def __init__(self, max_workers=None, max_tarefas_worker=None, max_rss_worker_mb=None, executor=None,
+                 paralelismo=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.paralelismo = paralelismo or self.max_workers
+        self.max_tarefas_worker = max_tarefas_worker
+        self.max_rss_worker_mb = max_rss_worker_mb
+        self._lotes = []    # pipelines registrados, em ordem de chegada
+        self._servico = {}  # pipeline -> custo estimado já despachado
+        self._em_execucao = 0
+        self._futuros = {}  # pipeline -> futuros das extrações em andamento no pool
+        self._pool = executor
+        self._pool_lock = threading.Lock()
+        self._encerrado = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._laco, daemon=True)
+        self._thread.start()
+
+    def aquecer(self):
+        """Sobe (e aquece) os workers agora, em vez de no primeiro PDF."""
+        if self.max_workers > 1:
+            self._obter_pool()
+        return self
+
+    def _obter_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = PoolAquecido(self.max_workers, self.max_tarefas_worker, self.max_rss_worker_mb)
+            return self._pool
+
+    def situacao_pool(self):
+        """Workers do pool (pid, tarefas, RSS) e contadores de reciclagem."""
+        with self._pool_lock:
+            pool = self._pool
+        if pool is None:
+            return {"workers": [], "reciclados": 0, "reiniciados": 0}
+        return pool.situacao()
+
+    def registrar(self, pipeline):
+        with self._cond:
+            self._servico[pipeline] = min(self._servico.values(), default=0.0)
+            self._lotes.append(pipeline)
+
+    def remover(self, pipeline):
+        with self._cond:
+            if pipeline in self._servico:
+                self._lotes.remove(pipeline)
+                del self._servico[pipeline]
+            self._futuros.pop(pipeline, None)
+            self._cond.notify_all()
+
+    def notificar(self):
+        """Avisa que algum lote tem PDFs novos aguardando."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def lotes_ativos(self):
+        with self._cond:
+            return len(self._lotes)
+
+    def profundidade(self):
+        """Quantidade de PDFs aguardando extração, somando todos os lotes."""
+        with self._cond:
+            lotes = list(self._lotes)
+        return sum(p.tamanho_backlog() for p in lotes)
+
+    def estimativa_espera(self):
+        """Segundos estimados para extrair tudo o que já está na fila."""
+        with self._cond:
+            lotes = list(self._lotes)
+        return sum(p.custo_backlog() for p in lotes) / self.paralelismo
+
+    def _escolher(self):
+        candidatos = [p for p in self._lotes if p.tamanho_backlog()]
+        if not candidatos:
+            return None
+        return min(candidatos, key=lambda p: self._servico[p])
+
+    def _laco(self):
+        while True:
+            with self._cond:
+                lote = None
+                while not self._encerrado:
+                    if self._em_execucao < self.max_workers:
+                        lote = self._escolher()
+                        if lote is not None:
+                            break
+                    self._cond.wait()
+                if self._encerrado:
+                    return
+                tarefa = lote._proximo()
+                if tarefa is None:
+                    continue
+                arquivo, argumentos, custo = tarefa
+                self._servico[lote] += custo
+                self._em_execucao += 1
+            self._executar(lote, arquivo, argumentos)
+
+    def _executar(self, lote, arquivo, argumentos):
+        if self._pool is None and self.max_workers <= 1:
+            # Sem pool: extrai na própria thread do escalonador, um PDF por vez,
+            # parando entre as páginas se o lote for cancelado
+            _cancelamento_local.verificar = lote.cancelamento.verificar
+            try:
+                resultado = processar_pdf(*argumentos)
+            except BaseException as e:
+                lote._ao_terminar(arquivo, erro=e)
+            else:
+                lote._ao_terminar(arquivo, resultado)
+            finally:
+                _cancelamento_local.verificar = None
+            self._liberar_vaga()
+            return
+        try:
+            futuro = self._obter_pool().submit(*argumentos)
+        except BaseException as e:
+            lote._ao_terminar(arquivo, erro=e)
+            self._liberar_vaga()
+            return
+        with self._cond:
+            self._futuros.setdefault(lote, set()).add(futuro)
+        futuro.add_done_callback(lambda f, l=lote, a=arquivo: self._ao_terminar_futuro(l, a, f))
+
+    def cancelar_lote(self, lote):
+        """Abandona as extrações do lote que estão no pool (ver PoolAquecido.cancelar)."""
+        with self._cond:
+            futuros = list(self._futuros.get(lote, ()))
+        for futuro in futuros:
+            self._pool.cancelar(futuro)
+
+    def _ao_terminar_futuro(self, lote, arquivo, futuro):
+        with self._cond:
+            self._futuros.get(lote, set()).discard(futuro)
+        try:
+            if futuro.cancelled():
+                lote._ao_terminar(arquivo, erro=ExtracaoCancelada("extração cancelada"))
+            elif futuro.exception() is not None:
+                lote._ao_terminar(arquivo, erro=futuro.exception())
+            else:
+                lote._ao_terminar(arquivo, futuro.result())
+        finally:
+            self._liberar_vaga()
+
+    def _liberar_vaga(self):
+        with self._cond:
+            self._em_execucao -= 1
+            self._cond.notify_all()
+
+    def encerrar(self):
+        with self._cond:
+            self._encerrado = True
+            self._cond.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.encerrar()
+
+
+# Escalonadores compartilhados pelo processo, um por número de workers: os
+# lotes que não recebem um escalonador explícito (inclusive os de
+# run_extraction_process_web_mode) reaproveitam os mesmos workers aquecidos
+ESCALONADORES = {}
+ESCALONADORES_LOCK = threading.Lock()
+
+def escalonador_compartilhado(max_workers=None, max_tarefas_worker=None, max_rss_worker_mb=None):
+    """Escalonador do processo para `max_workers` workers, criado no primeiro
+    pedido (os limites de reciclagem valem a partir da criação)."""
+    max_workers = max_workers or os.cpu_count() or 1
+    with ESCALONADORES_LOCK:
+        if max_workers not in ESCALONADORES:
+            ESCALONADORES[max_workers] = EscalonadorJusto(max_workers, max_tarefas_worker, max_rss_worker_mb)
+        return ESCALONADORES[max_workers]
+
+
+# --- PIPELINE DE EXTRAÇÃO ---
+# Os PDFs entram no pipeline um a um (por exemplo, à medida que o upload grava
+# cada arquivo) por uma fila limitada. Uma thread despachante faz a triagem de
+# cada PDF assim que ele chega e o coloca no backlog do lote, de onde o
+# escalonador o entrega aos processos de extração; assim o tempo total tende
+# a max(upload, extração) em vez da soma dos dois.
+
+# Capacidade da fila entre quem grava os PDFs e o despachante
+TAMANHO_FILA_PIPELINE = 64
+INTERVALO_ENTREGA = 0.5  # s entre verificações de erro enquanto a fila está cheia
+
+class PipelineExtracao:
+    """Extração incremental de um lote. Uso: iniciar(), adicionar(arquivo)
+    para cada PDF já gravado em `pdf_upload_folder` (ou adicionar(arquivo,
+    conteudo) com os bytes do PDF em memória, no modo sem disco) e, ao final,
+    finalizar(excel_percentual_path), que espera os PDFs em andamento e grava
+    o modelo de linhas dos relatórios.
+    `escalonador`: EscalonadorJusto onde o lote é extraído; sem ele o pipeline
+    usa o escalonador compartilhado do processo com `max_workers` processos
+    (ver escalonador_compartilhado).
+    `rastrear`: grava em `output_report_folder` o rastreamento do lote
+    (NOME_RASTRO) e o perfil cProfile dos PDFs que levarem mais de
+    `limite_perfil` segundos (perfil_<arquivo>.txt).
+    `cancelamento`: TokenCancelamento do lote; cancelado, o pipeline descarta
+    os PDFs que ainda não começaram, abandona os em extração e finalizar()
+    levanta ExtracaoCancelada (ou grava relatórios parciais, se pedido).
+    `acervo`: AcervoResultados onde cada PDF extraído é guardado e de onde
+    vêm os resultados dos PDFs já conhecidos (ver adicionar_conhecido).
+    `limite_paginas`: PDFs com pelo menos essa quantidade de páginas são
+    extraídos em trechos paralelos (ver LIMITE_PAGINAS_PARTICAO; 0 desliga)."""
+
+    def __init__(self, pdf_upload_folder, output_report_folder, progress_callback=None,
+                 journal_folder=None, triage_callback=None, max_workers=None,
+                 cost_model_path=None, tamanho_fila=TAMANHO_FILA_PIPELINE, escalonador=None,
+                 rastrear=False, limite_perfil=None, cancelamento=None, acervo=None,
+                 limite_paginas=LIMITE_PAGINAS_PARTICAO):
+        self.pdf_upload_folder = pdf_upload_folder
+        self.output_report_folder = output_report_folder
+        self.progress_callback = progress_callback
+        self.triage_callback = triage_callback
+        self.escalonador = escalonador
+        self.cancelamento = cancelamento or TokenCancelamento()
+        self.acervo = acervo
+        self.limite_paginas = limite_paginas
+        self.max_workers = escalonador.max_workers if escalonador else (max_workers or os.cpu_count() or 1)
+        # extrações simultâneas de fato (no modo distribuído, menos que as em andamento na fila)
+        self.paralelismo = escalonador.paralelismo if escalonador else self.max_workers
+        self.cost_model_path = cost_model_path
+        self.estimador = EstimadorCusto.carregar(cost_model_path)
+
+        self.journal_folder = journal_folder
+        self.journal_path = None
+        self.concluidos = {}
+        if journal_folder:
+            os.makedirs(journal_folder, exist_ok=True)
+            self.journal_path = os.path.join(journal_folder, f"{uuid.uuid4().hex}.jsonl")
+            self.concluidos = carregar_journais(journal_folder)
+            if self.concluidos:
+                print(f"Journal encontrado: {len(self.concluidos)} PDFs já processados podem ser reaproveitados.")
+        self.journals_reaproveitados = set()
+        self._arquivo_journal = None
+
+        self.hashes = {}
+        self.tamanhos = {}
+        self.metadados = {}
+        self.custos = {}  # por tarefa: o arquivo ou um trecho (arquivo, parte)
+        self._trechos = {}  # PDF longo -> resultado de cada trecho (None: ainda não terminou)
+        self.rejeitados = []
+        self.descartados = []  # PDFs que não chegaram a ser extraídos por cancelamento
+        self.reaproveitados = 0  # PDFs com resultado vindo do journal ou do acervo
+        self.parcial = False   # relatórios gerados só com parte do lote (cancelamento)
+        self.templates = {"acertos": 0, "falhas": 0}
+        self.resultados = {}
+        self.admitidos = []
+        self.recebidos = 0
+        # PDFs recebidos em memória: liberados assim que a extração termina
+        self._conteudos = {}
+        self.memoria_em_uso = 0
+        # PDFs que o cliente não enviou: hash informado no lugar dos bytes
+        self._hashes_informados = {}
+        self._arquivo_por_hash = {}
+        self._arquivo_por_matricula = {}
+
+        # Espera de cada PDF entre entrar no backlog e ser despachado
+        self._entrada_backlog = {}
+        self.esperas = []
+
+        self.rastrear = rastrear
+        self.limite_perfil = limite_perfil
+        self.eventos_rastro = []
+        self.perfis = {}  # arquivo -> relatório do cProfile
+        self._inicio_us = agora_us()
+
+        self._fila = queue.Queue(maxsize=tamanho_fila)
+        # heap de (chave_custo, tarefa): a próxima tarefa LPT sai em O(log n)
+        self._backlog = []
+        self._em_execucao = 0
+        self._erro = None
+        self._abortado = False
+        self._lock = threading.Lock()
+        self._mudou = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._despachante, daemon=True)
+
+    def iniciar(self):
+        if self.escalonador is None:
+            self.escalonador = escalonador_compartilhado(self.max_workers)
+        self.escalonador.registrar(self)
+        self.cancelamento.ao_cancelar(self._ao_cancelar)
+        self._thread.start()
+        return self
+
+    def adicionar(self, arquivo, conteudo=None):
+        """Entrega um PDF já gravado na pasta de upload, ou seus bytes em
+        `conteudo` (bloqueia se a fila estiver cheia). Levanta o erro do lote,
+        se o despachante já parou por causa dele."""
+        with self._lock:
+            self.recebidos += 1
+            if conteudo is not None:
+                self._conteudos[arquivo] = conteudo
+                self.memoria_em_uso += len(conteudo)
+        self._entregar(arquivo)
+
+    def adicionar_conhecido(self, arquivo, h, tamanho=0):
+        """Entrega um PDF que o cliente não enviou porque o servidor já tem o
+        resultado dele (hash SHA-256 `h` do conteúdo; ver registro_conhecido).
+        Se o resultado não existir mais, o PDF é rejeitado na triagem."""
+        with self._lock:
+            self.recebidos += 1
+            self._hashes_informados[arquivo] = (h, tamanho)
+        self._entregar(arquivo)
+
+    def _entregar(self, item):
+        """Põe o item na fila do despachante. A espera por vaga é em fatias de
+        INTERVALO_ENTREGA segundos: se o despachante parou por erro, ninguém
+        mais esvazia a fila, e o erro é levantado em vez de bloquear para sempre."""
+        while True:
+            self.verificar_erro()
+            if self._abortado:
+                return
+            try:
+                self._fila.put(item, timeout=INTERVALO_ENTREGA)
+                return
+            except queue.Full:
+                pass
+
+    def verificar_erro(self):
+        """Levanta o erro que interrompeu o lote, se houver."""
+        if self._erro is not None:
+            raise self._erro
+
+    def registro_conhecido(self, h):
+        """Resultado já extraído do PDF com este hash, do journal de uma
+        execução interrompida ou do acervo; None se não houver."""
+        if h in self.concluidos:
+            return self.concluidos[h][0]
+        return self.acervo.obter(h) if self.acervo else None
+
+    def _fonte(self, arquivo):
+        """Bytes do PDF em memória ou, se foi gravado em disco, seu caminho."""
+        conteudo = self._conteudos.get(arquivo)
+        return conteudo if conteudo is not None else os.path.join(self.pdf_upload_folder, arquivo)
+
+    def _liberar(self, arquivo):
+        with self._lock:
+            conteudo = self._conteudos.pop(arquivo, None)
+            if conteudo is not None:
+                self.memoria_em_uso -= len(conteudo)
+
+    # --- despachante ---
+
+    def _despachante(self):
+        fechado = False
+        try:
+            while not fechado and not self._abortado:
+                item = self._fila.get()
+                # Admite tudo o que já chegou antes de avisar o escalonador,
+                # para que o agendamento enxergue o maior conjunto possível de PDFs
+                try:
+                    while True:
+                        if item is None:
+                            fechado = True
+                            break
+                        self._admitir(item)
+                        item = self._fila.get_nowait()
+                except queue.Empty:
+                    pass
+                self.escalonador.notificar()
+        except BaseException as e:
+            with self._lock:
+                self._falhar(e)
+
+    def _admitir(self, arquivo):
+        """Hash, deduplicação, triagem e cabeçalho de um PDF recém-chegado."""
+        inicio_us = agora_us()
+        try:
+            self._admitir_arquivo(arquivo)
+        finally:
+            if self.rastrear:
+                with self._lock:
+                    self.eventos_rastro.append(evento_trace("triagem", inicio_us, agora_us(), {"arquivo": arquivo}))
+
+    def _admitir_arquivo(self, arquivo):
+        if self.cancelamento.cancelado:
+            self._descartar([arquivo])
+            return
+        with self._lock:
+            informado = self._hashes_informados.pop(arquivo, None)
+        if informado:
+            fonte = None
+            h, tamanho = informado
+        else:
+            fonte = self._fonte(arquivo)
+            h = calcular_hash_arquivo(fonte)
+            tamanho = os.path.getsize(fonte) if isinstance(fonte, str) else len(fonte)
+        if h in self._arquivo_por_hash:
+            self._rejeitar(arquivo, f"idêntico a {self._arquivo_por_hash[h]} (duplicado, ignorado)")
+            return
+        self._arquivo_por_hash[h] = arquivo
+
+        if fonte is None:
+            # PDF não enviado: os metadados vêm do resultado guardado
+            registro = self.registro_conhecido(h)
+            if registro is None:
+                self._rejeitar(arquivo, "PDF não enviado e seu resultado não está mais no servidor; envie o arquivo novamente")
+                return
+            meta = {"matricula": registro.get("matricula", ""), "nome": registro.get("nome", ""),
+                    "curso": registro.get("curso", ""), "paginas": None}
+            self._registrar_admissao(arquivo, h, tamanho, meta)
+            self._reaproveitar(arquivo, h)
+            return
+
+        motivo, meta = triar_pdf(fonte)
+        if motivo:
+            self._rejeitar(arquivo, motivo)
+            return
+        self._registrar_admissao(arquivo, h, tamanho, meta)
+        if self._reaproveitar(arquivo, h):
+            return
+        self.custos[arquivo] = self.estimador.estimar(meta.get("paginas"), self.tamanhos[arquivo])
+        tarefas = self._tarefas_do_pdf(arquivo, meta.get("paginas"))
+        with self._lock:
+            cancelado = self.cancelamento.cancelado
+            if not cancelado:
+                for tarefa in tarefas:
+                    heapq.heappush(self._backlog, (chave_custo(tarefa, self.custos), tarefa))
+                    self._entrada_backlog[tarefa] = time.monotonic()
+        if cancelado:
+            self._descartar([arquivo])
+
+    def _tarefas_do_pdf(self, arquivo, paginas):
+        """Tarefas de extração do PDF: o próprio arquivo ou, se ele for longo,
+        um trecho (arquivo, parte) por intervalo de páginas."""
+        partes = min(self.paralelismo, (paginas or 0) // PAGINAS_MINIMAS_TRECHO)
+        if not self.limite_paginas or (paginas or 0) < self.limite_paginas or partes < 2:
+            return [arquivo]
+        tarefas = []
+        for parte, (inicio, fim) in enumerate(dividir_paginas(paginas, partes)):
+            # cada trecho abre o PDF inteiro: paga o custo por MB, mas só as suas páginas
+            self.custos[(arquivo, parte)] = self.estimador.estimar(fim - inicio, self.tamanhos[arquivo])
+            tarefas.append((arquivo, parte))
+        with self._lock:
+            self._trechos[arquivo] = [None] * partes
+        print(f"{arquivo}: {paginas} páginas, extraídas em {partes} trechos paralelos.")
+        return tarefas
+
+    @staticmethod
+    def _desmembrar(tarefa):
+        """(arquivo, parte) de uma tarefa; parte é None se for o PDF inteiro."""
+        return tarefa if isinstance(tarefa, tuple) else (tarefa, None)
+
+    def _rejeitar(self, arquivo, motivo):
+        self._liberar(arquivo)
+        print(f"   Rejeitado na triagem: {arquivo} — {motivo}")
+        self.rejeitados.append((arquivo, motivo))
+        if self.triage_callback:
+            self.triage_callback([(arquivo, motivo)])
+
+    def _registrar_admissao(self, arquivo, h, tamanho, meta):
+        matricula_arquivo = extrair_matricula_do_nome_arquivo(arquivo)
+        if not meta["matricula"]:
+            meta["matricula"] = matricula_arquivo
+        elif matricula_arquivo and matricula_arquivo != meta["matricula"]:
+            print(f"   Aviso: {arquivo} tem matrícula {meta['matricula']} no cabeçalho (nome do arquivo indica {matricula_arquivo}).")
+        if meta["matricula"] and meta["matricula"] in self._arquivo_por_matricula:
+            print(f"   Aviso: matrícula {meta['matricula']} aparece em {self._arquivo_por_matricula[meta['matricula']]} e em {arquivo}.")
+        self._arquivo_por_matricula.setdefault(meta["matricula"], arquivo)
+
+        self.hashes[arquivo] = h
+        self.tamanhos[arquivo] = tamanho
+        self.metadados[arquivo] = meta
+        with self._lock:
+            self.admitidos.append(arquivo)
+
+    def _reaproveitar(self, arquivo, h):
+        """Conclui o PDF com o resultado do journal ou do acervo, sem extraí-lo.
+        Retorna False se o servidor não tiver o resultado."""
+        if h in self.concluidos:
+            registro, caminho_journal = self.concluidos[h]
+            self.journals_reaproveitados.add(caminho_journal)
+            origem = "journal"
+            # o journal de origem pode ser apagado quando o lote termina: se
+            # este lote cair antes, a retomada encontra o resultado no journal dele
+            self._gravar_journal(dict(registro, arquivo=arquivo, hash=h))
+            if self.acervo:
+                # o journal pode ser apagado quando o lote termina; o resultado fica no acervo
+                self.acervo.guardar(registro)
+        else:
+            registro = self.acervo.obter(h) if self.acervo else None
+            origem = "acervo"
+        if registro is None:
+            return False
+        self._liberar(arquivo)
+        print(f"Reaproveitado do {origem}: {arquivo}")
+        with self._lock:
+            self.reaproveitados += 1
+        self._registrar_resultado(arquivo, dict(registro, arquivo=arquivo, hash=h))
+        return True
+
+    # --- cancelamento ---
+
+    def _descartar(self, arquivos):
+        for arquivo in arquivos:
+            self._liberar(arquivo)
+        with self._lock:
+            self.descartados.extend(arquivos)
+
+    def _ao_cancelar(self):
+        with self._lock:
+            descartados = list(dict.fromkeys(self._desmembrar(tarefa)[0] for _, tarefa in sorted(self._backlog)))
+            self._backlog.clear()
+            self._entrada_backlog.clear()
+            self._mudou.notify_all()
+        self._descartar(descartados)
+        print(f"Cancelamento pedido ({self.cancelamento.motivo}): {len(descartados)} PDF(s) da fila descartados.")
+        if self.escalonador is not None:
+            self.escalonador.cancelar_lote(self)
+
+    # --- interface com o escalonador ---
+
+    def tamanho_backlog(self):
+        """Tarefas que o escalonador ainda pode despachar: nenhuma se o lote
+        falhou, foi abortado ou cancelado (ver _proximo)."""
+        with self._lock:
+            if self._erro or self._abortado or self.cancelamento.cancelado:
+                return 0
+            return len(self._backlog)
+
+    def custo_backlog(self):
+        with self._lock:
+            return sum(self.custos[tarefa] for _, tarefa in self._backlog)
+
+    def _proximo(self):
+        """Retira do backlog a tarefa (PDF ou trecho de PDF longo) de maior
+        custo estimado (LPT).
+        Retorna (tarefa, argumentos de processar_pdf, custo) ou None."""
+        with self._lock:
+            if not self._backlog or self._abortado or self._erro or self.cancelamento.cancelado:
+                return None
+            _, tarefa = heapq.heappop(self._backlog)
+            espera = time.monotonic() - self._entrada_backlog.pop(tarefa)
+            self.esperas.append(espera)
+            self._em_execucao += 1
+            arquivo, parte = self._desmembrar(tarefa)
+            paginas = None
+            rotulo = arquivo
+            if parte is not None:
+                paginas = dividir_paginas(self.metadados[arquivo]["paginas"], len(self._trechos[arquivo]))[parte]
+                rotulo = f"{arquivo} (páginas {paginas[0] + 1}-{paginas[1]})"
+            if self.rastrear:
+                # Espera na fila: evento assíncrono (as esperas se sobrepõem)
+                fim_us = agora_us()
+                marca = {"cat": "fila", "id": rotulo, "pid": os.getpid(), "tid": 0, "name": f"fila: {rotulo}"}
+                self.eventos_rastro.append(dict(marca, ph="b", ts=fim_us - int(espera * 1e6)))
+                self.eventos_rastro.append(dict(marca, ph="e", ts=fim_us))
+        # O nome do aluno, se preciso, é buscado só pelo trecho com a página 1
+        buscar_nome = not self.metadados[arquivo]["nome"] and not parte
+        argumentos = (self._fonte(arquivo), buscar_nome, rotulo if self.rastrear else None,
+                      self.limite_perfil if self.rastrear else None, paginas)
+        return tarefa, argumentos, self.custos[tarefa]
+
+    def _ao_terminar(self, tarefa, resultado=None, erro=None):
+        arquivo, parte = self._desmembrar(tarefa)
+        terminado = True  # o PDF inteiro (todos os trechos) terminou
+        try:
+            if erro is None and not self._abortado:
+                if parte is not None:
+                    resultado = self._juntar_trecho(arquivo, parte, resultado)
+                    terminado = resultado is not None
+                if terminado:
+                    self._concluir(arquivo, resultado)
+        except BaseException as e:
+            erro = e
+            terminado = True
+        if terminado:
+            self._liberar(arquivo)
+        with self._lock:
+            self._em_execucao -= 1
+            if isinstance(erro, ExtracaoCancelada):
+                if arquivo not in self.descartados:
+                    self.descartados.append(arquivo)
+            elif erro is not None and not self._abortado and not self.cancelamento.cancelado:
+                self._falhar(erro)
+            self._mudou.notify_all()
+
+    def _falhar(self, erro):
+        """Registra o erro do lote (o primeiro vale) e esvazia o backlog: nada
+        mais dele será despachado. Chamado com self._lock."""
+        self._erro = self._erro or erro
+        self._backlog.clear()
+        self._entrada_backlog.clear()
+        self._mudou.notify_all()
+
+    def _juntar_trecho(self, arquivo, parte, resultado):
+        """Guarda o resultado de um trecho de PDF longo. Quando o último trecho
+        chega, retorna o resultado do PDF inteiro, no formato de processar_pdf;
+        antes disso, None."""
+        with self._lock:
+            trechos = self._trechos[arquivo]
+            trechos[parte] = resultado
+            if any(t is None for t in trechos):
+                return None
+            del self._trechos[arquivo]
+        resultado = mesclar_trechos([t[0] for t in trechos])
+        templates = {chave: sum(t[3][chave] for t in trechos) for chave in trechos[0][3]}
+        rastro = None
+        if trechos[0][4] is not None:
+            perfis = [t[4]["perfil"] for t in trechos if t[4]["perfil"]]
+            rastro = {"eventos": [e for t in trechos for e in t[4]["eventos"]], "perfil": "\n".join(perfis) or None}
+        # segundos: soma dos trechos, o trabalho que o modelo de custo estima
+        return resultado, trechos[0][1], sum(t[2] for t in trechos), templates, rastro
+
+    def _concluir(self, arquivo, resultado):
+        extraido, nome, segundos, templates, rastro = resultado
+        meta = self.metadados[arquivo]
+        registro = {
+            "arquivo": arquivo,
+            "hash": self.hashes[arquivo],
+            "matricula": meta["matricula"],
+            # Cabeçalho fora do padrão: o nome vem da busca no texto completo da página 1
+            "nome": meta["nome"] or nome,
+            "curso": meta["curso"],
+            "resultado": extraido,
+        }
+        self._gravar_journal(registro)
+        with self._lock:
+            self.estimador.registrar(meta.get("paginas"), self.tamanhos[arquivo], segundos)
+            for chave, valor in templates.items():
+                self.templates[chave] += valor
+            if rastro:
+                self.eventos_rastro.extend(rastro["eventos"])
+                if rastro["perfil"]:
+                    self.perfis[arquivo] = rastro["perfil"]
+        if self.acervo:
+            self.acervo.guardar(registro)
+        print(f"Concluído: {arquivo} ({segundos:.2f}s)")
+        self._registrar_resultado(arquivo, registro)
+
+    def _gravar_journal(self, registro):
+        if not self.journal_path:
+            return
+        with self._lock:
+            if self._arquivo_journal is None:
+                self._arquivo_journal = abrir_journal(self.journal_path)
+            registrar_no_journal(self._arquivo_journal, registro)
+
+    def _registrar_resultado(self, arquivo, registro):
+        with self._lock:
+            self.resultados[arquivo] = registro
+            atual, total = len(self.resultados), len(self.admitidos)
+            # Reporta progresso se callback fornecido
+            if self.progress_callback:
+                self.progress_callback(atual, total)
+
+    # --- rastreamento ---
+
+    def _registrar_evento(self, nome, inicio_us, args=None):
+        if self.rastrear:
+            with self._lock:
+                self.eventos_rastro.append(evento_trace(nome, inicio_us, agora_us(), args))
+
+    def salvar_rastro(self):
+        """Grava o rastreamento do lote (formato Chrome trace) e os perfis dos
+        PDFs lentos na pasta de relatórios."""
+        with self._lock:
+            eventos = list(self.eventos_rastro)
+            perfis = dict(self.perfis)
+        servidor = os.getpid()
+        nomes_threads = {self._thread.ident: "despachante", threading.get_ident(): "requisição"}
+        escalonador = getattr(self.escalonador, "_thread", None)
+        if escalonador is not None:
+            nomes_threads[escalonador.ident] = "escalonador"
+        metadados = []
+        for pid in sorted({e["pid"] for e in eventos} | {servidor}):
+            nome = "servidor" if pid == servidor else f"worker {pid}"
+            metadados.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": nome}})
+        for tid, nome in nomes_threads.items():
+            if tid is not None:
+                metadados.append({"name": "thread_name", "ph": "M", "pid": servidor, "tid": tid, "args": {"name": nome}})
+        metadados.append({"name": "thread_name", "ph": "M", "pid": servidor, "tid": 0, "args": {"name": "fila"}})
+
+        caminho = os.path.join(self.output_report_folder, NOME_RASTRO)
+        with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": metadados + eventos, "displayTimeUnit": "ms",
+                       "otherData": {"perfis": sorted(perfis), "limite_perfil_s": self.limite_perfil}},
+                      f, ensure_ascii=False)
+        os.replace(caminho + '.tmp', caminho)
+        for arquivo, texto in perfis.items():
+            with open(os.path.join(self.output_report_folder, nome_arquivo_perfil(arquivo)), 'w', encoding='utf-8') as f:
+                f.write(texto)
+        print(f"Rastreamento gravado em '{caminho}' ({len(eventos)} eventos, {len(perfis)} perfil(is)).")
+
+    def situacao(self):
+        """Contagens do lote e tempos de espera na fila do escalonador (s)."""
+        with self._lock:
+            agora = time.monotonic()
+            esperas = list(self.esperas)
+            mais_antigo = agora - min(self._entrada_backlog.values()) if self._entrada_backlog else 0.0
+            return {
+                "recebidos": self.recebidos,
+                "admitidos": len(self.admitidos),
+                "concluidos": len(self.resultados),
+                "na_fila": len(self._backlog),
+                "em_execucao": self._em_execucao,
+                "rejeitados": len(self.rejeitados),
+                "descartados": len(self.descartados),
+                "reaproveitados": self.reaproveitados,
+                "espera_media": sum(esperas) / len(esperas) if esperas else 0.0,
+                "espera_maxima": max(esperas + [mais_antigo]),
+                "espera_atual": mais_antigo,
+            }
+
+    # --- encerramento ---
+
+    def _encerrar(self):
+        self.escalonador.remover(self)
+        with self._lock:
+            fechar_journal(self.journal_path, self._arquivo_journal)
+            self._arquivo_journal = None
+        if self.cost_model_path and self.estimador.amostras:
+            self.estimador.salvar(self.cost_model_path)
+
+    def abortar(self):
+        """Interrompe o lote sem gerar relatórios; o journal é mantido para retomada.
+        PDFs já em extração são abandonados como num cancelamento."""
+        self._abortado = True
+        self.cancelamento.cancelar("lote abortado")
+        try:
+            self._fila.put_nowait(None)
+        except queue.Full:
+            pass
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.escalonador is not None:
+            self._encerrar()
+        with self._lock:
+            self._backlog.clear()
+            self._entrada_backlog.clear()
+            self._conteudos.clear()
+            self.memoria_em_uso = 0
+
+    def finalizar(self, excel_percentual_path=None, excel_conteudo=None):
+        """Fecha a entrada de PDFs, espera a extração e grava o modelo de linhas.
+        `excel_conteudo`: bytes da planilha de percentuais, se ela ficou em memória.
+        Retorna o dicionário com os nomes dos relatórios, que ainda não existem
+        na pasta: cada um é gerado sob demanda por renderizar_relatorio."""
+        try:
+            self._entregar(None)
+        except BaseException as e:
+            # despachante parado por erro: o erro é levantado abaixo, depois do encerramento
+            if e is not self._erro:
+                raise
+        self._thread.join()
+        with self._lock:
+            while not self._erro and (self._backlog or self._em_execucao):
+                self._mudou.wait()
+            # Com erro, os PDFs ainda no backlog não são mais despachados
+            self._backlog.clear()
+            self._entrada_backlog.clear()
+        self._encerrar()
+        if self._erro:
+            raise self._erro
+        if self.cancelamento.cancelado:
+            if not self.cancelamento.finalizar_parcial:
+                print(f"Lote cancelado ({self.cancelamento.motivo}): {len(self.resultados)} PDF(s) extraídos, "
+                      f"{len(self.descartados)} descartados; relatórios não gerados (o journal foi mantido).")
+                raise ExtracaoCancelada(self.cancelamento.motivo)
+            self.parcial = True
+            print(f"Lote cancelado ({self.cancelamento.motivo}): gerando relatórios parciais com "
+                  f"{len(self.resultados)} PDF(s); {len(self.descartados)} descartados.")
+        if self.rejeitados:
+            print(f"{len(self.rejeitados)} arquivo(s) rejeitado(s) na triagem; {len(self.admitidos)} extraídos.")
+        consultas = self.templates["acertos"] + self.templates["falhas"]
+        if consultas:
+            print(f"Cache de templates de layout: {self.templates['acertos']}/{consultas} tabelas reconhecidas.")
+
+        # Carrega percentuais (se informado)
+        inicio_us = agora_us()
+        if excel_percentual_path:
+            print(f"Carregando percentuais de '{excel_percentual_path}'...")
+            percentuais_dict = carregar_percentuais(excel_percentual_path, excel_conteudo)
+            print(f"   → {len(percentuais_dict)} percentuais carregados.\n")
+        else:
+            print("Nenhum arquivo de percentuais fornecido — extração seguirá sem percentuais.")
+            percentuais_dict = {}
+        self._registrar_evento("percentuais", inicio_us)
+
+        # Monta o modelo de linhas (ordem alfabética, independente do despacho)
+        # e o grava na pasta de relatórios; os formatos são renderizados sob
+        # demanda (ver renderizar_relatorio)
+        inicio_us = agora_us()
+        resultados = [self.resultados[a] for a in sorted(self.resultados)]
+        linhas = montar_linhas_relatorio(resultados, percentuais_dict)
+        salvar_modelo_relatorio(self.output_report_folder, linhas)
+        self._registrar_evento("gravação do modelo do relatório", inicio_us, {"linhas": len(linhas)})
+        if self.rastrear:
+            self._registrar_evento("lote", self._inicio_us, {"pdfs": len(self.admitidos)})
+            self.salvar_rastro()
+
+        # Modelo gravado: o journal deste lote não é mais necessário. Um journal
+        # retomado só sai se o lote cobriu todos os PDFs dele; os que sobram
+        # ficam para um próximo lote (ou para a limpeza por idade).
+        if self.journal_path and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        cobertos = {registro['hash'] for registro in self.resultados.values()}
+        for caminho in self.journals_reaproveitados:
+            if not os.path.exists(caminho):
+                continue
+            pendentes = set(carregar_journal(caminho)) - cobertos
+            if pendentes:
+                print(f"Journal '{os.path.basename(caminho)}' mantido: {len(pendentes)} PDF(s) dele não estavam neste lote.")
+            else:
+                os.remove(caminho)
+
+        print(f"\nProcessamento concluído! {len(linhas)} linhas prontas para os relatórios em '{self.output_report_folder}'.")
+        return dict(RELATORIOS)
+
+
+# --- FUNÇÃO PRINCIPAL ADAPTADA ---
+# Esta é a função que o app.py irá chamar.
+
+def run_extraction_process_web_mode(pdf_upload_folder, excel_percentual_path, output_report_folder, progress_callback=None, journal_folder=None, triage_callback=None, max_workers=None, cost_model_path=None, cancelamento=None):
+    """
+    Executa o processo de extração principal.
+    Recebe os caminhos das pastas (do servidor), grava o modelo de linhas e
+    renderiza todos os relatórios a partir dele.
+    Retorna um dicionário com os nomes dos arquivos gerados.
+    progress_callback: função opcional que recebe (current, total) para reportar progresso
+    journal_folder: pasta opcional onde o journal da execução é gravado; PDFs
+    já concluídos em execuções interrompidas não são reprocessados
+    triage_callback: função opcional chamada com a lista de (arquivo, motivo)
+    dos PDFs rejeitados na triagem, antes de a extração começar
+    max_workers: número de processos de extração (padrão: número de CPUs); os
+    processos ficam aquecidos e são reaproveitados pelas próximas chamadas
+    cost_model_path: arquivo JSON opcional onde o modelo de custo usado no
+    agendamento é lido e atualizado com os tempos medidos
+    cancelamento: TokenCancelamento opcional; se for cancelado, a extração
+    para e a função levanta ExtracaoCancelada (ou grava relatórios parciais,
+    se o cancelamento pediu finalizar_parcial)
+    """
+    pipeline = PipelineExtracao(
+        pdf_upload_folder, output_report_folder,
+        progress_callback=progress_callback,
+        journal_folder=journal_folder,
+        triage_callback=triage_callback,
+        max_workers=max_workers,
+        cost_model_path=cost_model_path,
+        tamanho_fila=0,
+        cancelamento=cancelamento,
+    )
+
+    # Lista os PDFs (da pasta de upload) e entrega todos antes de iniciar o
+    # despachante: assim a triagem do lote inteiro acontece antes da extração
+    # e o agendamento vê todos os custos
+    pdfs_encontrados = sorted([f for f in os.listdir(pdf_upload_folder) if f.lower().endswith(".pdf")])
+    print(f"Encontrados {len(pdfs_encontrados)} arquivos PDF na pasta de upload. Iniciando extração...")
+    for arquivo in pdfs_encontrados:
+        pipeline.adicionar(arquivo)
+    pipeline.iniciar()
+    relatorios = pipeline.finalizar(excel_percentual_path)
+    # Quem chama esta função espera os arquivos prontos na pasta; o servidor,
+    # que usa o pipeline diretamente, os renderiza só no primeiro download
+    for nome_arquivo in relatorios.values():
+        renderizar_relatorio(output_report_folder, nome_arquivo)
+    return relatorios
@@ -10,8 +10,32 @@ const progressText = document.getElementById('progressText');
 const progressPercentage = document.getElementById('progressPercentage');
 const progressFill = document.getElementById('progressFill');
 const skipPercentuaisCheckbox = document.getElementById('skipPercentuais');
+const cancelButton = document.getElementById('cancelButton');
+const previewArea = document.getElementById('previewArea');
+const previewField = document.getElementById('previewField');
+const previewSearch = document.getElementById('previewSearch');
+const previewBody = document.getElementById('previewBody');
+const previewPageInfo = document.getElementById('previewPageInfo');
+const previewPrev = document.getElementById('previewPrev');
+const previewNext = document.getElementById('previewNext');
 
 let eventSource = null;
+let currentJobId = null;
+let cancelRequested = false;
+
+// Pré-visualização dos resultados (GET /jobs/<job_id>/preview): a paginação,
+// a ordenação e a busca são feitas no servidor; a tabela só mostra a página
+const PREVIEW_PAGE_SIZE = 20;
+const preview = { url: null, page: 1, pages: 1, sort: 'seq', order: 'asc', request: 0 };
+let previewSearchTimer = null;
+
+// Identificador do lote: liga o stream de progresso ao upload correspondente
+function newJobId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID().replace(/-/g, '');
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2, 12);
+}
 
 function updateMessages(message) {
     messagesTextArea.value += message + '\n';
@@ -25,8 +49,13 @@ function setProcessingState(isProcessing) {
         // Limpa resultados anteriores
         resultsArea.style.display = 'none';
         downloadLinksDiv.innerHTML = '';
+        previewArea.style.display = 'none';
+        previewBody.innerHTML = '';
+        preview.url = null;
         // Mostra container de progresso
         progressContainer.style.display = 'block';
+        cancelButton.disabled = false;
+        cancelButton.textContent = 'Cancelar extração';
         updateProgress(0, 0);
     } else {
         extractButton.disabled = false;
@@ -50,12 +79,12 @@ function updateProgress(current, total) {
     progressFill.style.width = `${percentage}%`;
 }
 
-function startProgressListener() {
+function startProgressListener(jobId) {
     if (eventSource) {
         eventSource.close();
     }
     
-    eventSource = new EventSource('/progress');
+    eventSource = new EventSource(`/progress?job_id=${jobId}`);
     
     eventSource.onmessage = function(event) {
         const data = event.data;
@@ -69,6 +98,14 @@ function startProgressListener() {
         if (data === 'ping') {
             return;
         }
+
+        // Arquivo rejeitado na triagem ("REJEITADO: arquivo — motivo") ou
+        // cancelamento em andamento ("CANCELANDO: ..."); o "CANCELADO: ..."
+        // final chega também na resposta do upload, que é a mensagem exibida
+        if (data.startsWith('REJEITADO:') || data.startsWith('CANCELANDO:')) {
+            updateMessages(data);
+            return;
+        }
         
         // Formato esperado: "current/total"
         const match = data.match(/(\d+)\/(\d+)/);
@@ -88,6 +125,211 @@ function startProgressListener() {
     };
 }
 
+// Pede ao servidor que pare o lote atual; o upload em andamento recebe a
+// resposta "cancelled" (com links se os relatórios parciais foram gerados)
+async function cancelExtraction() {
+    if (!currentJobId) {
+        return;
+    }
+    const finalize = confirm("Gerar relatórios com os PDFs já processados?\n\nOK: gera relatórios parciais\nCancelar: descarta tudo");
+    cancelRequested = true;
+    cancelButton.disabled = true;
+    cancelButton.textContent = 'Cancelando...';
+    try {
+        const response = await fetch(`/jobs/${currentJobId}/cancel${finalize ? '?finalize=1' : ''}`, { method: 'POST' });
+        const result = await response.json();
+        if (!response.ok) {
+            updateMessages(`Não foi possível cancelar: ${result.message}`);
+        }
+    } catch (error) {
+        updateMessages(`Não foi possível cancelar: ${error.message}`);
+    }
+}
+
+function showDownloadLinks(downloadLinks) {
+    if (!downloadLinks) {
+        return;
+    }
+    resultsArea.style.display = 'block';
+
+    if (downloadLinks.excel_report) {
+        const link = document.createElement('a');
+        link.href = downloadLinks.excel_report;
+        link.textContent = 'Baixar Relatório Excel (.xlsx)';
+        link.target = '_blank'; // Abre em nova aba
+        downloadLinksDiv.appendChild(link);
+    }
+    if (downloadLinks.csv_report) {
+        const link = document.createElement('a');
+        link.href = downloadLinks.csv_report;
+        link.textContent = 'Baixar Relatório CSV (.csv)';
+        link.target = '_blank';
+        downloadLinksDiv.appendChild(link);
+    }
+    if (downloadLinks.bundle) {
+        const link = document.createElement('a');
+        link.href = downloadLinks.bundle;
+        link.textContent = 'Baixar Todos os Relatórios (.zip)';
+        link.target = '_blank';
+        downloadLinksDiv.appendChild(link);
+    }
+}
+
+function showPreview(previewUrl) {
+    if (!previewUrl) {
+        return;
+    }
+    resultsArea.style.display = 'block';
+    previewArea.style.display = 'block';
+    Object.assign(preview, { url: previewUrl, page: 1, sort: 'seq', order: 'asc' });
+    previewSearch.value = '';
+    loadPreviewPage();
+}
+
+async function loadPreviewPage() {
+    if (!preview.url) {
+        return;
+    }
+    const params = new URLSearchParams({
+        page: preview.page, per_page: PREVIEW_PAGE_SIZE, sort: preview.sort, order: preview.order
+    });
+    const term = previewSearch.value.trim();
+    if (term) {
+        params.set(previewField.value, term);
+    }
+    // Descarta respostas que chegam depois de uma busca mais nova
+    const request = ++preview.request;
+    try {
+        const response = await fetch(`${preview.url}?${params}`);
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.message || `Erro do servidor: ${response.status}`);
+        }
+        if (request === preview.request) {
+            renderPreview(result);
+        }
+    } catch (error) {
+        if (request === preview.request) {
+            previewPageInfo.textContent = `Pré-visualização indisponível: ${error.message}`;
+        }
+    }
+}
+
+function renderPreview(result) {
+    preview.pages = result.pages;
+    previewBody.innerHTML = '';
+    for (const student of result.students) {
+        const row = previewBody.insertRow();
+        const components = student.components.length ? student.components.join('\n') : 'não contém';
+        for (const value of [student.seq, student.matricula, student.name, components,
+                             student.pending_hours, student.percentage]) {
+            // textContent: nomes e componentes vêm dos PDFs
+            row.insertCell().textContent = value ?? '';
+        }
+    }
+    if (!result.students.length) {
+        const cell = previewBody.insertRow().insertCell();
+        cell.colSpan = 6;
+        cell.textContent = 'Nenhum aluno encontrado.';
+    }
+    previewPageInfo.textContent = `Página ${result.page} de ${result.pages} (${result.matched} de ${result.total} alunos)`;
+    previewPrev.disabled = result.page <= 1;
+    previewNext.disabled = result.page >= result.pages;
+    document.querySelectorAll('.preview-table th').forEach(th => {
+        th.classList.toggle('sorted-asc', th.dataset.sort === preview.sort && preview.order === 'asc');
+        th.classList.toggle('sorted-desc', th.dataset.sort === preview.sort && preview.order === 'desc');
+    });
+}
+
+function changePreviewPage(delta) {
+    const page = preview.page + delta;
+    if (page < 1 || page > preview.pages) {
+        return;
+    }
+    preview.page = page;
+    loadPreviewPage();
+}
+
+// Busca com um pequeno atraso para não pedir uma página a cada tecla
+function searchPreview() {
+    clearTimeout(previewSearchTimer);
+    previewSearchTimer = setTimeout(() => {
+        preview.page = 1;
+        loadPreviewPage();
+    }, 250);
+}
+
+function sortPreview(field) {
+    if (preview.sort === field) {
+        preview.order = preview.order === 'asc' ? 'desc' : 'asc';
+    } else {
+        preview.sort = field;
+        preview.order = 'asc';
+    }
+    preview.page = 1;
+    loadPreviewPage();
+}
+
+// Quando o lote é cancelado durante o upload, o servidor para de ler o corpo
+// e o navegador pode dar o envio como falho; a situação final vem de /jobs
+async function showCancelledJob(jobId) {
+    for (let attempt = 0; attempt < 20; attempt++) {
+        const response = await fetch(`/jobs/${jobId}`);
+        const job = await response.json();
+        if (response.ok && job.status !== 'receiving' && job.status !== 'processing') {
+            updateMessages(job.message || `Lote ${job.status}.`);
+            showDownloadLinks(job.download_links);
+            showPreview(job.preview_url);
+            return;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500));
+    }
+    updateMessages("Cancelamento pedido; a situação final do lote ainda não está disponível.");
+}
+
+// SHA-256 (hex) do conteúdo de um arquivo, calculado no navegador (Web Crypto)
+async function sha256Hex(file) {
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Negociação antes do upload: calcula o SHA-256 de cada PDF e pergunta ao
+// servidor quais ele já extraiu; esses vão só como hash (campo known_files),
+// sem os bytes. Retorna um Map índice do arquivo -> hash dos já conhecidos.
+// Sem Web Crypto (página fora de HTTPS/localhost) ou se a consulta falhar,
+// todos os PDFs são enviados.
+async function findKnownFiles(pdfFiles) {
+    const known = new Map();
+    if (!(window.crypto && crypto.subtle)) {
+        return known;
+    }
+    try {
+        const hashes = [];
+        for (let i = 0; i < pdfFiles.length; i++) {
+            progressText.textContent = `Verificando arquivos: ${i + 1}/${pdfFiles.length}`;
+            hashes.push(await sha256Hex(pdfFiles[i]));
+        }
+        const response = await fetch('/known_files', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ hashes: hashes })
+        });
+        if (!response.ok) {
+            return known;
+        }
+        const serverHashes = new Set((await response.json()).known);
+        hashes.forEach((hash, i) => {
+            if (serverHashes.has(hash)) {
+                known.set(i, hash);
+            }
+        });
+    } catch (error) {
+        console.error('Falha na verificação prévia dos arquivos:', error);
+        known.clear();
+    }
+    return known;
+}
+
 async function startExtraction() {
     const pdfFiles = pdfFilesInput.files;
     const excelFile = excelFileInput.files[0];
@@ -107,61 +349,82 @@ async function startExtraction() {
     updateMessages("Iniciando upload e extração...");
     
     // Inicia o listener de progresso
-    startProgressListener();
-
-    const formData = new FormData();
-    for (let i = 0; i < pdfFiles.length; i++) {
-        formData.append('pdf_files', pdfFiles[i]);
-    }
-    if (!skipPercentuais && excelFile) {
-        formData.append('excel_file', excelFile);
-    } else if (skipPercentuais) {
-        // Indica explicitamente ao backend que ele deve pular percentuais
-        formData.append('skip_percentuals', '1');
-    }
+    const jobId = newJobId();
+    currentJobId = jobId;
+    cancelRequested = false;
+    startProgressListener(jobId);
 
     try {
+        const knownFiles = await findKnownFiles(pdfFiles);
+        if (cancelRequested) {
+            updateMessages("Extração cancelada antes do envio dos arquivos.");
+            return;
+        }
+        if (knownFiles.size > 0) {
+            updateMessages(`${knownFiles.size} de ${pdfFiles.length} PDFs já estão no servidor e não serão enviados.`);
+        }
+        updateProgress(0, 0);
+
+        // O Excel (ou a flag) e os PDFs já conhecidos vão antes dos demais
+        // PDFs: o servidor começa a extrair cada PDF assim que ele termina de chegar
+        const formData = new FormData();
+        if (!skipPercentuais && excelFile) {
+            formData.append('excel_file', excelFile);
+        } else if (skipPercentuais) {
+            // Indica explicitamente ao backend que ele deve pular percentuais
+            formData.append('skip_percentuals', '1');
+        }
+        if (knownFiles.size > 0) {
+            const entries = [];
+            knownFiles.forEach((hash, i) => {
+                entries.push({ name: pdfFiles[i].name, sha256: hash, size: pdfFiles[i].size });
+            });
+            formData.append('known_files', JSON.stringify(entries));
+        }
+        for (let i = 0; i < pdfFiles.length; i++) {
+            if (!knownFiles.has(i)) {
+                formData.append('pdf_files', pdfFiles[i]);
+            }
+        }
+
         // Envia os arquivos para o endpoint /upload_and_extract no backend Flask
-        const response = await fetch('/upload_and_extract', {
+        const response = await fetch(`/upload_and_extract?job_id=${jobId}`, {
             method: 'POST',
             body: formData 
         });
 
         const result = await response.json();
 
+        if (response.status === 429) {
+            // Servidor saturado ou limite de lotes simultâneos atingido
+            const retryAfter = response.headers.get('Retry-After') || result.retry_after;
+            throw new Error(`${result.message} (tente novamente em ~${retryAfter}s)`);
+        }
         if (!response.ok) {
             // Se o servidor retornar um erro (ex: 400, 500)
             throw new Error(result.message || `Erro do servidor: ${response.status}`);
         }
 
-        // Se o backend processar com sucesso (status "success")
-        updateMessages("Extração concluída com sucesso!");
-        updateMessages(result.message);
+        if (result.status === 'cancelled') {
+            updateMessages(result.message);
+        } else {
+            // Se o backend processar com sucesso (status "success")
+            updateMessages("Extração concluída com sucesso!");
+            updateMessages(result.message);
+        }
 
         // Mostra a área de resultados e cria os links de download
-        if (result.download_links) {
-            resultsArea.style.display = 'block';
-            
-            if (result.download_links.excel_report) {
-                const link = document.createElement('a');
-                link.href = result.download_links.excel_report;
-                link.textContent = 'Baixar Relatório Excel (.xlsx)';
-                link.target = '_blank'; // Abre em nova aba
-                downloadLinksDiv.appendChild(link);
-            }
-            if (result.download_links.csv_report) {
-                const link = document.createElement('a');
-                link.href = result.download_links.csv_report;
-                link.textContent = 'Baixar Relatório CSV (.csv)';
-                link.target = '_blank';
-                downloadLinksDiv.appendChild(link);
-            }
-        }
+        showDownloadLinks(result.download_links);
+        showPreview(result.preview_url);
 
     } catch (error) {
-        // Pega erros de rede ou erros retornados pelo backend
-        updateMessages(`FALHA NA OPERAÇÃO: ${error.message}`);
-        console.error("Erro completo:", error);
+        if (cancelRequested) {
+            await showCancelledJob(jobId);
+        } else {
+            // Pega erros de rede ou erros retornados pelo backend
+            updateMessages(`FALHA NA OPERAÇÃO: ${error.message}`);
+            console.error("Erro completo:", error);
+        }
     } finally {
         // Fecha o EventSource se ainda estiver aberto
         if (eventSource) {
@@ -169,6 +432,7 @@ async function startExtraction() {
             eventSource = null;
         }
         // Reabilita o botão, independentemente do resultado
+        currentJobId = null;
         setProcessingState(false);
     }
 }
@@ -176,6 +440,10 @@ async function startExtraction() {
 // Inicializa a área de mensagens
 document.addEventListener('DOMContentLoaded', () => {
     updateMessages("Pronto para começar. Selecione os arquivos e clique em 'Iniciar Extração'.");
+    // Clique no cabeçalho ordena a pré-visualização (de novo: inverte a ordem)
+    document.querySelectorAll('.preview-table th').forEach(th => {
+        th.addEventListener('click', () => sortPreview(th.dataset.sort));
+    });
     // Caso o checkbox exista, atualiza o estado do input do Excel
     if (skipPercentuaisCheckbox) {
         const toggleExcelState = () => {
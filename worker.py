@@ -0,0 +1,73 @@
+"""Worker do modo distribuído da extração (servidor com EXTRACTION_DISTRIBUTED=1).
+
+Reivindica os PDFs que o servidor web coloca na fila compartilhada
+(<pasta base>/fila/tarefas.sqlite), extrai cada um e publica o resultado;
+o servidor junta os resultados nos relatórios. Pode rodar em quantas
+máquinas forem necessárias, todas montando a pasta base do servidor.
+
+Uso:
+    python worker.py --base-dir /mnt/extracao [--processos 4] [--lease 60]
+
+Se um worker cair no meio de um PDF, o lease da tarefa vence e outro worker
+a retoma. Ctrl+C devolve à fila os PDFs em andamento.
+"""
+import os
+import time
+import signal
+import argparse
+import multiprocessing
+
+from seu_script_de_extracao import executar_worker_distribuido, PASTA_FILA_DISTRIBUIDA, LEASE_PADRAO
+
+
+def processo_worker(pasta, lease, max_tarefas):
+    try:
+        executar_worker_distribuido(pasta, lease=lease, max_tarefas=max_tarefas)
+    except KeyboardInterrupt:
+        pass
+
+
+def iniciar_processo(pasta, args):
+    processo = multiprocessing.Process(target=processo_worker, args=(pasta, args.lease, args.max_tarefas or None))
+    processo.start()
+    return processo
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker do modo distribuído da extração de históricos')
+    parser.add_argument('--base-dir', default=os.getenv('EXTRACTION_BASE_DIR') or os.getcwd(),
+                        help='Pasta base do servidor (compartilhada)')
+    parser.add_argument('--processos', type=int, default=os.cpu_count() or 1, help='Processos de extração nesta máquina')
+    parser.add_argument('--lease', type=float, default=LEASE_PADRAO,
+                        help='Segundos sem sinal de vida até a tarefa de um worker caído ser retomada por outro')
+    parser.add_argument('--max-tarefas', type=int, default=500,
+                        help='PDFs extraídos por processo antes de ele ser substituído por um novo (0: sem limite)')
+    args = parser.parse_args()
+
+    pasta = os.path.join(os.path.abspath(args.base_dir), PASTA_FILA_DISTRIBUIDA)
+    processos = [iniciar_processo(pasta, args) for _ in range(args.processos)]
+    print(f"{len(processos)} processo(s) de extração consumindo a fila em '{pasta}'.")
+    try:
+        while True:
+            time.sleep(1)
+            for i, processo in enumerate(processos):
+                if processo.is_alive():
+                    continue
+                # Reciclado (max-tarefas) ou caído: sobe outro no lugar
+                if processo.exitcode != 0:
+                    print(f"Processo {processo.pid} terminou com código {processo.exitcode}; iniciando outro.")
+                processos[i] = iniciar_processo(pasta, args)
+    except KeyboardInterrupt:
+        print("Encerrando os workers...")
+        for processo in processos:
+            # Ctrl+C no terminal já chega aos filhos; um SIGINT só no pai, não
+            if processo.is_alive():
+                os.kill(processo.pid, signal.SIGINT)
+        for processo in processos:
+            processo.join(timeout=10)
+            if processo.is_alive():
+                processo.terminate()
+
+
+if __name__ == '__main__':
+    main()